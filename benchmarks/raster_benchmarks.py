@@ -0,0 +1,229 @@
+"""
+Micro-benchmarks of the raster primitives: clip, rasterize, mosaic, reproject and colormap rendering.
+
+The benchmarks run on generated CyAN like GeoTIFF tiles, uint8 DN values with a colormap in an Albers equal area crs,
+so a raster layer change can be measured without an aggregation run or the image volume. Each benchmark records the
+median and p95 runtime of the repeated runs, the first (cold) run, and the peak python allocations of a separate
+traced run. Allocations made by GDAL outside of numpy are not included.
+
+Usage, from the project root:
+    python benchmarks/raster_benchmarks.py --size 2000 --tiles 2 --repeat 20 --output results.json
+    python benchmarks/raster_benchmarks.py --baseline baseline.json
+    python benchmarks/raster_benchmarks.py --save-baseline baseline.json
+"""
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import Point
+from affine import Affine
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from io import BytesIO
+import rasterio
+import tracemalloc
+import argparse
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+TILE_CRS = "EPSG:5070"
+RESOLUTION = 300.0
+ORIGIN = (-1500000.0, 2500000.0)
+
+
+def generate_colormap():
+    """
+    CyAN like colormap, DN 0 below detection, 1-253 a blue to red ramp, 254 land and 255 no data.
+    """
+    colormap = {0: (0, 0, 0, 255), 254: (175, 175, 175, 255), 255: (0, 0, 0, 0)}
+    for value in range(1, 254):
+        ratio = (value - 1) / 252
+        colormap[value] = (int(255 * ratio), int(180 * (1 - abs(2 * ratio - 1))), int(255 * (1 - ratio)), 255)
+    return colormap
+
+
+def generate_tiles(directory: str, size: int, n_tiles: int, seed: int = 0):
+    """
+    Write an n_tiles x n_tiles grid of adjacent size x size tiles, with a mix of below detection, CI, land and no data
+    values in the proportions of the daily images.
+    :return: List of the tile paths and the colormap.
+    """
+    rng = np.random.default_rng(seed)
+    colormap = generate_colormap()
+    paths = []
+    for row in range(n_tiles):
+        for col in range(n_tiles):
+            data = rng.choice([0, 254, 255], size=(size, size), p=[0.55, 0.3, 0.15]).astype(np.uint8)
+            ci = rng.random((size, size)) < 0.1
+            data[ci] = rng.integers(1, 254, size=int(ci.sum()), dtype=np.uint8)
+            transform = Affine(RESOLUTION, 0.0, ORIGIN[0] + col * size * RESOLUTION,
+                               0.0, -RESOLUTION, ORIGIN[1] - row * size * RESOLUTION)
+            path = os.path.join(directory, f"L2022001.L3m_DAY_CYAN_CI_cyano_CYAN_CONUS_300m_{row + 1}_{col + 1}.tif")
+            with rasterio.open(path, "w", driver="GTiff", height=size, width=size, count=1, dtype="uint8",
+                               crs=TILE_CRS, transform=transform, nodata=255, tiled=True, blockxsize=256,
+                               blockysize=256, compress="deflate") as dst:
+                dst.write(data, 1)
+                dst.write_colormap(1, colormap)
+            paths.append(path)
+    return paths, colormap
+
+
+def generate_boundary(size: int, fraction: float = 0.2):
+    """
+    Circular waterbody boundary in EPSG:4326 centered on the first tile, with a diameter of fraction of the tile.
+    """
+    center = Point(ORIGIN[0] + size * RESOLUTION / 2, ORIGIN[1] - size * RESOLUTION / 2)
+    polygon = center.buffer(size * RESOLUTION * fraction / 2, resolution=64)
+    return gpd.GeoSeries([polygon], crs=TILE_CRS).to_crs("EPSG:4326")
+
+
+def run_benchmark(name: str, func, repeat: int):
+    """
+    Time repeat runs of func after a cold run, and trace the peak allocations of one more run.
+    :return: Dictionary of the benchmark results, times in milliseconds and allocations in kilobytes.
+    """
+    t0 = time.perf_counter()
+    func()
+    cold = time.perf_counter() - t0
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    times = np.array(times) * 1000
+    result = {
+        "median_ms": round(float(np.median(times)), 3),
+        "p95_ms": round(float(np.percentile(times, 95)), 3),
+        "cold_ms": round(cold * 1000, 3),
+        "peak_kb": round(peak / 1024, 1),
+        "repeat": repeat
+    }
+    print(f"{name:<24} median: {result['median_ms']:>10.3f} ms, p95: {result['p95_ms']:>10.3f} ms, "
+          f"cold: {result['cold_ms']:>10.3f} ms, peak: {result['peak_kb']:>10.1f} KB")
+    return result
+
+
+def get_benchmarks(paths: list, colormap: dict, boundary):
+    """
+    Returns the benchmark functions, run in order.
+    """
+    from flaskr.raster import clip_raster, rasterize_boundary, mosaic_rasters, mosaic_raster_gdal, get_raster, \
+        get_colormap
+    from flaskr.render import get_lut, render_png, render_rgba
+
+    tile = paths[0]
+    boundary_crs = boundary.crs
+    with rasterio.open(tile) as src:
+        tile_crs = src.crs
+    clipped = clip_raster(tile, boundary, boundary_crs=boundary_crs, histogram=False)
+    clipped_data = np.expand_dims(clipped[0], 0)
+    conus = mosaic_raster_gdal(paths, dst_crs={"init": "EPSG:3857"}).read(1)
+
+    def get_image_colormap():
+        # wb_flask.get_image, lookup table from the image colormap and png render of the clipped waterbody
+        lut = get_lut(get_colormap(tile))
+        render_png(clipped[0], lut).getvalue()
+
+    def read_tile():
+        with rasterio.open(tile) as src:
+            src.read(1)
+
+    def conus_colormap():
+        # aggregate.generate_conus_image, lookup table gather and png save of the CONUS mosaic
+        lut = get_lut(colormap, transparent=(0, 254, 255))
+        png_metadata = PngInfo()
+        png_metadata.add_text("Bounds", "{}")
+        Image.fromarray(render_rgba(conus, lut), mode='RGBA').save(BytesIO(), 'PNG', pnginfo=png_metadata)
+
+    return {
+        "clip_raster": lambda: clip_raster(tile, boundary, boundary_crs=boundary_crs),
+        "clip_raster_reproject": lambda: clip_raster(tile, boundary, boundary_crs=boundary_crs,
+                                                     raster_crs={"init": "epsg:3857"}, histogram=False),
+        "rasterize_boundary": lambda: rasterize_boundary(clipped_data, boundary=boundary, affine=clipped[1],
+                                                         crs=tile_crs),
+        "mosaic_rasters": lambda: mosaic_rasters(paths, dst_crs={"init": "EPSG:3857"}),
+        "mosaic_raster_gdal": lambda: mosaic_raster_gdal(paths, dst_crs={"init": "EPSG:3857"}),
+        "get_raster": lambda: get_raster(tile),
+        "get_image_colormap": get_image_colormap,
+        "conus_colormap": conus_colormap,
+        "read_tile": read_tile,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """
+    Print the median and p95 ratios to the baseline.
+    :return: Names of the benchmarks with a median over threshold times the baseline median.
+    """
+    regressions = []
+    print(f"\nComparison to baseline, size: {baseline.get('size')}, tiles: {baseline.get('tiles')}")
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            print(f"{name:<24} not in baseline")
+            continue
+        median_ratio = result["median_ms"] / base["median_ms"] if base["median_ms"] > 0 else float("inf")
+        p95_ratio = result["p95_ms"] / base["p95_ms"] if base["p95_ms"] > 0 else float("inf")
+        flag = ""
+        if median_ratio > threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print(f"{name:<24} median: {median_ratio:>6.2f}x, p95: {p95_ratio:>6.2f}x, "
+              f"peak: {result['peak_kb'] - base['peak_kb']:>+10.1f} KB{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CyAN Waterbody raster primitive micro-benchmarks.")
+    parser.add_argument('--size', default=2000, type=int, help="Width and height in pixels of each generated tile.")
+    parser.add_argument('--tiles', default=2, type=int, help="Generate a tiles x tiles grid of tiles for the mosaics.")
+    parser.add_argument('--repeat', default=20, type=int, help="Number of timed runs of each benchmark.")
+    parser.add_argument('--filter', default=None, type=str, help="Only run the benchmarks containing this text.")
+    parser.add_argument('--output', default=None, type=str, help="Write the results to this json file.")
+    parser.add_argument('--baseline', default=None, type=str, help="Compare the results to this baseline json file.")
+    parser.add_argument('--save-baseline', default=None, type=str, help="Write the results as a new baseline json file.")
+    parser.add_argument('--threshold', default=1.1, type=float,
+                        help="Median ratio to the baseline reported as a regression.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="wb_raster_bench_")
+    # module level directories are read on import, keep the reprojection index maps out of static/
+    os.environ["IMAGE_DIR"] = work_dir
+    os.environ["REPROJECT_DIR"] = os.path.join(work_dir, "reproject")
+    sys.path.insert(0, PROJECT_ROOT)
+    try:
+        paths, colormap = generate_tiles(work_dir, size=args.size, n_tiles=args.tiles)
+        boundary = generate_boundary(size=args.size)
+        results = {"size": args.size, "tiles": args.tiles, "benchmarks": {}}
+        print(f"Raster benchmarks, tile size: {args.size}x{args.size}, tiles: {args.tiles}x{args.tiles}, "
+              f"repeat: {args.repeat}")
+        for name, func in get_benchmarks(paths, colormap, boundary).items():
+            if args.filter and args.filter not in name:
+                continue
+            results["benchmarks"][name] = run_benchmark(name, func, repeat=args.repeat)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for output in (args.output, args.save_baseline):
+        if output:
+            with open(output, "w") as output_file:
+                json.dump(results, output_file, indent=4)
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("size") != args.size or baseline.get("tiles") != args.tiles:
+            print("WARNING: baseline was recorded with a different tile size or count.")
+        regressions = compare(results, baseline, threshold=args.threshold)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
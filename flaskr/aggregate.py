@@ -1,11 +1,15 @@
 import numpy as np
 import numpy.ma as ma
 from pathlib import PurePath
-from flaskr.raster import get_images, clip_raster, mosaic_rasters, get_colormap, get_raster, get_dataset_reader, rasterize_boundary, mosaic_raster_gdal
-from flaskr.geometry import get_waterbody, get_waterbody_by_fids, convert_coordinates
-from flaskr.db import get_tiles_by_objectid, get_conn, save_data, get_waterbody_fid
+from flaskr.raster import get_images, clip_raster, mosaic_rasters, get_colormap, get_raster, rasterize_boundary, mosaic_raster_gdal, reproject_nearest, get_bbox, get_crs
+from flaskr.geometry import get_waterbody, get_waterbody_by_fids, convert_coordinates, to_geometries, to_geoseries
+from flaskr.db import get_tiles_by_objectid, get_conn, save_data
+from flaskr.tiles import generate_tiles
+from flaskr.composite import update_composites
+from flaskr.render import get_lut, render_rgba
+from flaskr.chips import chips_enabled, write_chips, read_chip, OUTSIDE_VALUE
+from flaskr.registry import get_registry
 import geopandas as gpd
-from shapely.geometry import Polygon, MultiPolygon
 import multiprocessing as mp
 import logging
 import time
@@ -54,33 +58,36 @@ def aggregate(year: int, day: int, daily: bool = True, objectid: str = None, off
     f_results = {}
     image_base = PurePath(images[0]).parts[-1].split(".tif")
     image_base = "_".join(image_base[0].split("_")[:-2])
+    keep_chips = chips_enabled()
+    chips = {}
     df_data = []
+    geometries = to_geometries(features)
     for i in tqdm(range(len(features)), desc="Aggregating waterbodies..."):
         f = features[i]
         objectid = f["properties"]["OBJECTID"]
         f_results[objectid] = []
-        if f["geometry"]["type"] == "MultiPolygon":
-            poly_geos = []
-            for p in f["geometry"]["coordinates"]:
-                poly_geos.append(Polygon(p[0]))
-            poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-        else:
-            poly = gpd.GeoSeries(Polygon(f["geometry"]["coordinates"][0]), crs=crs)
+        poly = gpd.GeoSeries([geometries[i]], crs=crs)
         f_images = get_tiles_by_objectid(objectid, image_base)
         if len(f_images) == 0:
             f_results[objectid] = [np.zeros(257), "FAILED", "No images found for provided OBJECTID"]
             continue
         results = np.zeros(257)
+        parts = []
         for i in f_images:
             data = clip_raster(i, poly, boundary_crs=crs)
             if data:
                 results = np.add(results, np.histogram(data[0], bins=257)[0])
+                if keep_chips:
+                    parts.append((data[0], data[1]))
+                    chips[objectid] = (parts, data[4].crs)
         f_results[objectid] = [results, "PROCESSED", ""]
         # df_data.append(list([objectid, f['properties']['AREASQKM'], np.sum(poly.area) * 10**4, round(np.sum(results) * 0.03, 4)]))
     # columns = ["objectid", "wb_area", "wb_geo_area", "wb_pixel_area"]
     # df = pd.DataFrame(df_data, columns=columns)
     # df.plot(x='wb_area', y=['wb_geo_area', 'wb_pixel_area'])
     # plt.show()
+    if keep_chips:
+        write_chips(chips, year=year, day=day, colormap=get_colormap(images[0]), daily=daily)
     return f_results, offset, completed
 
 
@@ -119,34 +126,45 @@ def p_aggregate(year: int, day: int, daily: bool = True, objectid: str = None, o
     pool = mp.Pool(cpus)
     logger.info("Running async, cores: {}".format(cpus))
 
-    results_objects = [pool.apply_async(p_feature_aggregate, args=(f, image_base, crs)) for f in features]
+    keep_chips = chips_enabled()
+    results_objects = [pool.apply_async(p_feature_aggregate, args=(f, image_base, crs, keep_chips)) for f in features]
     results = {}
+    chips = {}
     for i in tqdm(range(len(results_objects)), desc="Aggregating {} data by waterbodies...".format("daily" if daily else "weekly"), ascii=False):
         r = results_objects[i].get()
         results[r[0]] = [r[1], r[2], r[3]]
+        if r[4] is not None:
+            chips[r[0]] = r[4]
+    if keep_chips:
+        write_chips(chips, year=year, day=day, colormap=get_colormap(images[0]), daily=daily)
     return results, offset, completed
 
 
-def p_feature_aggregate(feature, image_base, crs):
+def p_feature_aggregate(feature, image_base, crs, keep_chip: bool = False):
+    """
+    Aggregate a single waterbody feature.
+    :param keep_chip: Return the clipped waterbody pixels for the chip store.
+    :return: The objectid, histogram of pixel values, status, comments and the chip (parts, crs) or None.
+    """
     objectid = feature["properties"]["OBJECTID"]
     results = np.zeros(257)
     f_images = get_tiles_by_objectid(objectid, image_base)
     if len(f_images) == 0:
-        return objectid, results, "FAILED", "No images found for the objectID"
-    if feature["geometry"]["type"] == "MultiPolygon":
-        poly_geos = []
-        for p in feature["geometry"]["coordinates"]:
-            poly_geos.append(Polygon(p[0]))
-        poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-    else:
-        poly = gpd.GeoSeries(Polygon(feature["geometry"]["coordinates"][0]), crs=crs)
-    if poly.geometry is None:
-        return objectid, results, "FAILED", "Geometry unable to be loaded for objectid."
+        return objectid, results, "FAILED", "No images found for the objectID", None
+    poly = to_geoseries(feature, crs)
+    if poly.iloc[0] is None:
+        return objectid, results, "FAILED", "Geometry unable to be loaded for objectid.", None
+    parts = []
+    chip_crs = None
     for i in f_images:
         data = clip_raster(i, poly, boundary_crs=crs)
         if data:
             results = np.add(results, np.histogram(data[0], bins=257)[0])
-    return objectid, results, "PROCESSED", ""
+            if keep_chip:
+                parts.append((data[0], data[1]))
+                chip_crs = data[4].crs
+    chip = (parts, chip_crs) if keep_chip and len(parts) > 0 else None
+    return objectid, results, "PROCESSED", "", chip
 
 
 def retry_failed(daily: bool = True):
@@ -175,24 +193,23 @@ def retry_failed(daily: bool = True):
 
 
 def get_waterbody_raster(objectid: int, year: int, day: int, get_bounds: bool = True, retry: int = 5, reproject: bool = True, daily: bool = True):
-    fid = get_waterbody_fid(objectid=objectid)
+    fid = get_registry().get_fid(objectid)
+    if fid is None:
+        return None, None
     features, crs = get_waterbody_by_fids(fid=fid)
     if len(features) == 0:
         return None, None
+    f = features[0]
+    objectid = f["properties"]["OBJECTID"]
+    poly = to_geoseries(f, crs)
+    chip = read_chip(objectid=objectid, year=year, day=day, daily=daily)
+    if chip is not None:
+        return get_chip_raster(chip, poly, get_bounds=get_bounds, reproject=reproject)
     images = get_images(year=year, day=day, daily=daily)
     if len(images) == 0:
         return None, None
     image_base = PurePath(images[0]).parts[-1].split(".tif")
     image_base = "_".join(image_base[0].split("_")[:-2])
-    f = features[0]
-    objectid = f["properties"]["OBJECTID"]
-    if f["geometry"]["type"] == "MultiPolygon":
-        poly_geos = []
-        for p in f["geometry"]["coordinates"]:
-            poly_geos.append(Polygon(p[0]))
-        poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-    else:
-        poly = gpd.GeoSeries(Polygon(f["geometry"]["coordinates"][0]), crs=crs)
     f_images = get_tiles_by_objectid(objectid, image_base)
     if len(f_images) > 1:
         mosaic = mosaic_rasters(f_images)
@@ -210,30 +227,45 @@ def get_waterbody_raster(objectid: int, year: int, day: int, get_bounds: bool =
     return data, colormap
 
 
+def get_chip_raster(chip, boundary, get_bounds: bool = True, reproject: bool = True):
+    """
+    Returns the waterbody raster from a stored chip, in the same form as clip_raster.
+    :param chip: Chip, transform, crs and colormap from read_chip.
+    :param boundary: Waterbody boundary GeoSeries.
+    """
+    data, transform, crs, colormap = chip
+    if data.dtype == np.uint8:
+        # chips stored before the outside value was kept, 0 outside of the waterbody
+        data = rasterize_boundary(data[np.newaxis], boundary=boundary, affine=transform, crs=crs,
+                                  value=OUTSIDE_VALUE)[0].astype(np.uint16)
+    raster_crs = crs
+    bbox = None
+    if reproject:
+        raster_crs = {'init': 'epsg:3857'}
+        data, transform = reproject_nearest(data, src_crs=crs, src_transform=transform, dst_crs=raster_crs,
+                                            nodata=OUTSIDE_VALUE)
+        if get_bounds:
+            bbox = get_bbox(data.shape, transform, get_crs(raster_crs))
+    return [data, transform, raster_crs, bbox, boundary.to_crs(crs)], colormap
+
+
 def generate_conus_image(year: int, day: int, daily: bool, save_bounds: bool = True):
     t0 = time.time()
     images = get_images(year=year, day=day, daily=daily, filtered=True)
     logger.info(f"CyANO CONUS Image Generator started - year: {year}, day: {day}, daily: {daily}, n images: {len(images)}")
 
-    colormap = get_colormap(images[0])
-    colormap[0] = (0, 0, 0, 0)
-    colormap[254] = (0, 0, 0, 0)
-    colormap[255] = (0, 0, 0, 0)
-
     if len(images) == 0:
         logger.warn("No images found for conus image generator.")
         return
 
-    mosaic, mosaic_file = mosaic_raster_gdal(images, dst_crs={"init": "EPSG:3857"})
+    lut = get_lut(get_colormap(images[0]), transparent=(0, 254, 255))
+
+    mosaic = mosaic_raster_gdal(images, dst_crs={"init": "EPSG:3857"})
     logger.info("CyANO CONUS Image Rasters Merged")
-    bounds = None
-    data = None
-    crs = None
-    for r in mosaic:
-        bounds = r.bounds
-        crs = r.crs.data["init"]
-        data = r.read()[0]
-    mosaic.close()
+    bounds = mosaic.bounds
+    crs = f"epsg:{mosaic.crs.to_epsg()}"
+    transform = mosaic.transform
+    data = mosaic.read(1)
 
     proj_x1, proj_y1 = convert_coordinates(y=bounds[1], x=bounds[0], in_crs=crs)
     proj_x2, proj_y2 = convert_coordinates(y=bounds[3], x=bounds[2], in_crs=crs)
@@ -247,12 +279,8 @@ def generate_conus_image(year: int, day: int, daily: bool, save_bounds: bool = T
     # str_bounds = {"bottom": bounds.bottom, "left": bounds.left, "right": bounds.right, "top": bounds.top}
 
     logger.info(f"Starting CyANO CONUS Image colormapping, size: {data.shape}")
-    converted_data = np.full((data.shape[0], data.shape[1], 4,), (0, 0, 0, 0), dtype=np.uint8)
-    for color, color_value in colormap.items():
-        converted_data[data == color] = color_value
-
+    converted_data = render_rgba(data, lut)
     logger.info("Completed CyANO CONUS Image colormapping")
-    converted_data = np.array(converted_data, dtype=np.uint8)
 
     png_metadata = PngInfo()
     png_metadata.add_text("Bounds", str(str_bounds))
@@ -279,7 +307,12 @@ def generate_conus_image(year: int, day: int, daily: bool, save_bounds: bool = T
     if os.path.exists(previous_file):
         os.remove(previous_file)
 
-    os.remove(mosaic_file)
+    generate_tiles(data, transform, lut, year=year, day=day, daily=daily)
+    logger.info("Completed CyANO CONUS Image tile pyramid")
+
+    if daily:
+        update_composites(data, transform, lut, year=year, day=day, str_bounds=str_bounds)
+
     if save_bounds:
         with open(os.path.join("static", "conus_raster_bounds.json"), "w") as json_file:
             json_file.write(json.dumps(str_bounds, indent=4))
@@ -0,0 +1,108 @@
+import geopandas as gpd
+import threading
+import logging
+import time
+
+from flaskr.geometry import GEOMETRY_LAYERS, get_layer_store
+from flaskr.geometry_store import LAYER_KEYS, SOURCE_FID
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+BOUNDARY_LAYERS = ("counties", "states", "tribes")
+BOUNDARY_TOLERANCES = (0.0005, 0.002, 0.01)        # simplification tolerances, in degrees of the census crs
+KEY_WIDTHS = {"counties": 5, "tribes": 4}          # zero padded GEOID widths
+
+_boundaries = {}
+_lock = threading.Lock()
+
+
+class BoundaryLayer:
+    """
+    A census boundary layer held in memory, the full geometries and simplified variants at each of the
+    BOUNDARY_TOLERANCES, keyed by GEOID or STUSPS.
+    """
+
+    def __init__(self, layer: str, data: gpd.GeoDataFrame):
+        self.layer = layer
+        self.crs = data.crs
+        keys = data[LAYER_KEYS[layer]].astype(str).to_numpy()
+        self._rows = {key: i for i, key in enumerate(keys)}
+        geometries = data.geometry.reset_index(drop=True)
+        self.geometries = {0.0: geometries.to_numpy()}
+        for tolerance in BOUNDARY_TOLERANCES:
+            self.geometries[tolerance] = geometries.simplify(tolerance, preserve_topology=True).to_numpy()
+
+    def get_row(self, key: str):
+        key = str(key)
+        row = self._rows.get(key)
+        if row is None and self.layer in KEY_WIDTHS:
+            row = self._rows.get(key.zfill(KEY_WIDTHS[self.layer]))
+        return row
+
+    def get(self, key: str, tolerance: float = 0.0):
+        """
+        Returns the boundary geometry of a key at the largest precomputed tolerance not over tolerance, None if the
+        key is not in the layer.
+        """
+        row = self.get_row(key)
+        if row is None:
+            return None
+        tolerance = max([t for t in self.geometries.keys() if t <= tolerance], default=0.0)
+        return self.geometries[tolerance][row]
+
+
+def load_boundary_layer(layer: str):
+    """
+    Load a boundary layer from the geometry store when built, or the census shapefile.
+    """
+    t0 = time.time()
+    store = get_layer_store(layer)
+    if store is not None:
+        data = gpd.read_file(store.path).sort_values(SOURCE_FID)
+    else:
+        data = gpd.read_file(GEOMETRY_LAYERS[layer])
+    boundary_layer = BoundaryLayer(layer, data)
+    t1 = time.time()
+    logger.info(f"Loaded boundary layer: {layer}, {len(data)} boundaries, runtime: {round(t1 - t0, 3)} sec")
+    return boundary_layer
+
+
+def get_boundary_layer(layer: str):
+    """
+    Returns a boundary layer, loaded once per process.
+    """
+    boundary_layer = _boundaries.get(layer)
+    if boundary_layer is None:
+        with _lock:
+            boundary_layer = _boundaries.get(layer)
+            if boundary_layer is None:
+                boundary_layer = load_boundary_layer(layer)
+                _boundaries[layer] = boundary_layer
+    return boundary_layer
+
+
+def get_boundary(layer: str, key: str, tolerance: float = 0.0):
+    """
+    Returns a county (GEOID), state (STUSPS) or tribe (GEOID) boundary as a single geometry GeoSeries, None if not found.
+    :param layer: 'counties', 'states' or 'tribes'.
+    :param key: GEOID or state abbreviation.
+    :param tolerance: Simplification tolerance, the largest precomputed tolerance not over it is used.
+    """
+    boundary_layer = get_boundary_layer(layer)
+    geometry = boundary_layer.get(key, tolerance=tolerance)
+    if geometry is None:
+        return None
+    return gpd.GeoSeries([geometry], crs=boundary_layer.crs)
+
+
+def get_plot_boundary(layer: str, key: str, pixels: int = 1000):
+    """
+    Returns a boundary GeoSeries simplified for plotting about pixels wide, at the largest tolerance under the size of
+    a pixel. None if not found.
+    """
+    geometry = get_boundary_layer(layer).get(key)
+    if geometry is None:
+        return None
+    minx, miny, maxx, maxy = geometry.bounds
+    return get_boundary(layer, key, tolerance=max(maxx - minx, maxy - miny) / pixels)
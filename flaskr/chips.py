@@ -0,0 +1,112 @@
+import numpy as np
+from rasterio.crs import CRS
+from affine import Affine
+import logging
+import os
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+CHIP_DIR = os.getenv("WATERBODY_CHIP_DIR")        # chip store is disabled when not set
+OUTSIDE_VALUE = 256                               # rasterize_boundary value for pixels outside of the waterbody
+
+
+def chips_enabled():
+    return h5py is not None and CHIP_DIR is not None
+
+
+def get_chip_path(year: int, day: int, daily: bool = True):
+    return os.path.join(CHIP_DIR, 'daily' if daily else 'weekly', str(year), f"{day}.h5")
+
+
+def merge_parts(parts: list):
+    """
+    Merge the clipped parts of a waterbody, one per tile, into a single chip. The tiles share a crs and pixel grid so
+    each part is placed by its pixel offset from the merged upper left corner.
+    :param parts: List of (data, transform), data is a 2d array with OUTSIDE_VALUE for pixels outside the waterbody.
+    :return: The merged uint16 chip, OUTSIDE_VALUE outside of the waterbody as in clip_raster, and its affine transform.
+    """
+    if len(parts) == 1:
+        data, transform = parts[0]
+        return data.astype(np.uint16), transform
+    res_x = parts[0][1].a
+    res_y = parts[0][1].e
+    left = min(t.c for _, t in parts)
+    top = max(t.f for _, t in parts)
+    right = max(t.c + d.shape[1] * t.a for d, t in parts)
+    bottom = min(t.f + d.shape[0] * t.e for d, t in parts)
+    width = int(round((right - left) / res_x))
+    height = int(round((bottom - top) / res_y))
+    chip = np.full((height, width), OUTSIDE_VALUE, dtype=np.uint16)
+    for data, transform in parts:
+        col = int(round((transform.c - left) / res_x))
+        row = int(round((transform.f - top) / res_y))
+        view = chip[row:row + data.shape[0], col:col + data.shape[1]]
+        inside = data != OUTSIDE_VALUE
+        view[inside] = data[inside]
+    return chip, Affine(res_x, 0.0, left, 0.0, res_y, top)
+
+
+def write_chips(chips: dict, year: int, day: int, colormap: dict = None, daily: bool = True):
+    """
+    Write the waterbody chips of an aggregation to the chip store, replacing existing chips for the date.
+    :param chips: Dictionary of objectid to (parts, crs), parts as accepted by merge_parts.
+    :param year: Year of the images.
+    :param day: Day of the year of the images.
+    :param colormap: Colormap of the images, stored once per date.
+    :param daily: Daily or weekly images.
+    :return: Number of chips written.
+    """
+    if not chips_enabled() or len(chips) == 0:
+        return 0
+    chip_path = get_chip_path(year=year, day=day, daily=daily)
+    os.makedirs(os.path.dirname(chip_path), exist_ok=True)
+    n = 0
+    with h5py.File(chip_path, "a") as store:
+        if colormap is not None and "colormap" not in store:
+            cm = np.zeros((256, 4), dtype=np.uint8)
+            for value, color in colormap.items():
+                cm[value] = color
+            store.create_dataset("colormap", data=cm)
+        for objectid, (parts, crs) in chips.items():
+            if len(parts) == 0:
+                continue
+            chip, transform = merge_parts(parts)
+            name = str(objectid)
+            if name in store:
+                del store[name]
+            dataset = store.create_dataset(name, data=chip, compression="gzip", compression_opts=4)
+            dataset.attrs["transform"] = tuple(transform)[:6]
+            dataset.attrs["crs"] = CRS.from_user_input(crs).to_wkt()
+            n += 1
+    logger.info(f"Wrote {n} waterbody chips for {'daily' if daily else 'weekly'} year: {year}, day: {day}")
+    return n
+
+
+def read_chip(objectid: int, year: int, day: int, daily: bool = True):
+    """
+    Read the chip of a single waterbody from the chip store.
+    :return: The uint16 chip, OUTSIDE_VALUE outside of the waterbody, its affine transform, crs and the image colormap.
+    None if the chip is not in the store. Chips written as uint8, with 0 outside of the waterbody, are returned as
+    stored.
+    """
+    if not chips_enabled():
+        return None
+    chip_path = get_chip_path(year=year, day=day, daily=daily)
+    if not os.path.exists(chip_path):
+        return None
+    with h5py.File(chip_path, "r") as store:
+        name = str(objectid)
+        if name not in store or "colormap" not in store:
+            return None
+        dataset = store[name]
+        chip = dataset[()]
+        transform = Affine(*dataset.attrs["transform"])
+        crs = CRS.from_wkt(dataset.attrs["crs"])
+        colormap = {i: tuple(int(c) for c in color) for i, color in enumerate(store["colormap"][()])}
+    return chip, transform, crs, colormap
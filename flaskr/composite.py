@@ -0,0 +1,239 @@
+import numpy as np
+from affine import Affine
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import datetime
+import logging
+import json
+import os
+
+from flaskr.render import render_rgba
+from flaskr.tiles import generate_tiles
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+COMPOSITE_DIR = os.getenv("COMPOSITE_DIR", os.path.join("static", "composites"))
+COMPOSITE_DAYS = (7, 30)
+PLOT_DIR = os.path.join("static", "raster_plots")
+
+
+def get_product(n_days: int):
+    """
+    Returns the product name of an n day composite, used for the png and tile pyramid names.
+    """
+    return f"max{n_days}"
+
+
+def get_composite_file(year: int, day: int, n_days: int, tries: int = 3):
+    """
+    Returns the path of the n day composite png ending on year/day, falling back to the previous days.
+    """
+    date = datetime.date(year, 1, 1) + datetime.timedelta(days=day - 1)
+    for i in range(tries):
+        c_date = date - datetime.timedelta(days=i)
+        c_path = os.path.join(PLOT_DIR, f"{get_product(n_days)}-conus-{c_date.year}-{c_date.timetuple().tm_yday}.png")
+        if os.path.exists(c_path):
+            return c_path
+    return None
+
+
+def _day_path(date: datetime.date):
+    return os.path.join(COMPOSITE_DIR, "days", f"{date.year}-{date.timetuple().tm_yday}.npy")
+
+
+def _valid(data):
+    return np.where((data >= 1) & (data <= 253), data, 0).astype(np.uint8)
+
+
+def _load_day(date: datetime.date):
+    day_path = _day_path(date)
+    if not os.path.exists(day_path):
+        return None
+    return _valid(np.load(day_path))
+
+
+def get_day_mosaic(year: int, day: int):
+    """
+    Returns a daily CONUS mosaic from the composite buffer, the DN values in EPSG:3857 and their affine transform.
+    None if the day is not in the buffer.
+    """
+    day_path = _day_path(datetime.date(year, 1, 1) + datetime.timedelta(days=day - 1))
+    state = _load_state()
+    if state is None or not os.path.exists(day_path):
+        return None
+    return np.load(day_path), Affine(*state["transform"])
+
+
+def _load_state():
+    state_path = os.path.join(COMPOSITE_DIR, "state.json")
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, "r") as state_file:
+        return json.load(state_file)
+
+
+def _save_state(state: dict):
+    with open(os.path.join(COMPOSITE_DIR, "state.json"), "w") as state_file:
+        json.dump(state, state_file, indent=4)
+
+
+def _align(data, transform, grid: Affine, shape, fill: int = 255):
+    """
+    Place a mosaic onto the composite grid, the daily CONUS mosaics share a resolution but the extent can change
+    with the available tiles.
+    """
+    height, width = shape
+    if tuple(transform)[:6] == tuple(grid)[:6] and data.shape == (height, width):
+        return data
+    aligned = np.full((height, width), fill, dtype=np.uint8)
+    col = int(round((transform.c - grid.c) / grid.a))
+    row = int(round((transform.f - grid.f) / grid.e))
+    r0, c0 = max(row, 0), max(col, 0)
+    r1, c1 = min(row + data.shape[0], height), min(col + data.shape[1], width)
+    if r1 > r0 and c1 > c0:
+        aligned[r0:r1, c0:c1] = data[r0 - row:r1 - row, c0 - col:c1 - col]
+    return aligned
+
+
+def _grow_grid(data, transform, state: dict):
+    """
+    Grow the composite grid to the union of its extent and a day's mosaic, when the mosaic extends past it, and move
+    the buffered days and the composites onto the grown grid.
+    """
+    grid = Affine(*state["transform"])
+    height, width = state["shape"]
+    col = int(round((transform.c - grid.c) / grid.a))
+    row = int(round((transform.f - grid.f) / grid.e))
+    c0, r0 = min(col, 0), min(row, 0)
+    c1, r1 = max(col + data.shape[1], width), max(row + data.shape[0], height)
+    if (c0, r0, c1, r1) == (0, 0, width, height):
+        return state
+    new_grid = grid * Affine.translation(c0, r0)
+    new_shape = [r1 - r0, c1 - c0]
+    for f in os.listdir(os.path.join(COMPOSITE_DIR, "days")):
+        f_path = os.path.join(COMPOSITE_DIR, "days", f)
+        np.save(f_path, _align(np.load(f_path), grid, new_grid, new_shape, fill=255))
+    for n_days in COMPOSITE_DAYS:
+        composite_path = os.path.join(COMPOSITE_DIR, f"{get_product(n_days)}.npy")
+        if os.path.exists(composite_path):
+            np.save(composite_path, _align(np.load(composite_path), grid, new_grid, new_shape, fill=0))
+    logger.info(f"Grew the composite grid from {height}x{width} to {new_shape[0]}x{new_shape[1]}")
+    state["transform"] = tuple(new_grid)[:6]
+    state["shape"] = new_shape
+    return state
+
+
+def _build_composite(date: datetime.date, n_days: int):
+    """
+    Rebuild the n day composite ending on date from the days in the ring buffer.
+    """
+    composite = None
+    for w_date in [date - datetime.timedelta(days=i) for i in range(n_days)]:
+        w_data = _load_day(w_date)
+        if w_data is not None:
+            composite = w_data if composite is None else np.maximum(composite, w_data)
+    return composite
+
+
+def _save_composite(composite, state: dict, lut, date: datetime.date, n_days: int, str_bounds: dict = None):
+    """
+    Render an n day composite ending on date to the png and the tile pyramid.
+    """
+    product = get_product(n_days)
+    year, day = date.year, date.timetuple().tm_yday
+    png_metadata = PngInfo()
+    png_metadata.add_text("Bounds", str(str_bounds))
+    png_metadata.add_text("Days", str(n_days))
+    png_metadata.add_text("Year", str(year))
+    png_metadata.add_text("Day", str(day))
+    Image.fromarray(render_rgba(composite, lut), mode='RGBA').save(
+        os.path.join(PLOT_DIR, f"{product}-conus-{year}-{day}.png"), 'PNG', pnginfo=png_metadata)
+    generate_tiles(composite, Affine(*state["transform"]), lut, year=year, day=day, product=product)
+
+
+def update_composites(data, transform, lut, year: int, day: int, str_bounds: dict = None):
+    """
+    Fold a day's CONUS mosaic into the rolling maximum composites of valid values (DN 1-253). The daily mosaics are
+    kept in a ring buffer of daily arrays, each composite is updated with the new day and only the pixels where an
+    expiring day held the maximum are recomputed from the days remaining in the window. A day older than the latest
+    composite replaces its day in the buffer and rebuilds the latest composite when it falls within its window, the
+    composite keeps its date.
+    :param data: 2d array of the day's CONUS mosaic in EPSG:3857.
+    :param transform: Affine transform of data.
+    :param lut: RGBA lookup table used to render the composites.
+    :param year: Year of the mosaic.
+    :param day: Day of the year of the mosaic.
+    :param str_bounds: Bounds of the mosaic, stored in the png metadata.
+    """
+    os.makedirs(os.path.join(COMPOSITE_DIR, "days"), exist_ok=True)
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    date = datetime.date(year, 1, 1) + datetime.timedelta(days=day - 1)
+
+    state = _load_state()
+    if state is None:
+        state = {"transform": tuple(transform)[:6], "shape": list(data.shape), "composites": {}}
+    state = _grow_grid(data, transform, state)
+    data = _align(data, transform, Affine(*state["transform"]), state["shape"])
+    latest = max([datetime.date.fromisoformat(c["date"]) for c in state["composites"].values()] + [date])
+    if date > latest - datetime.timedelta(days=max(COMPOSITE_DAYS)):
+        np.save(_day_path(date), data)
+    valid = _valid(data)
+
+    for n_days in COMPOSITE_DAYS:
+        product = get_product(n_days)
+        composite_path = os.path.join(COMPOSITE_DIR, f"{product}.npy")
+        window = [date - datetime.timedelta(days=i) for i in range(n_days)]
+        previous = state["composites"].get(product)
+        previous_date = datetime.date.fromisoformat(previous["date"]) if previous else None
+        if previous_date is not None and date < previous_date:
+            # an earlier day was re-aggregated, the composite keeps its date and the pngs of other windows are kept
+            if date > previous_date - datetime.timedelta(days=n_days):
+                composite = _build_composite(previous_date, n_days)
+                np.save(composite_path, composite)
+                _save_composite(composite, state, lut, previous_date, n_days, str_bounds=str_bounds)
+            continue
+        if previous_date is not None and previous_date < date and os.path.exists(composite_path):
+            composite = np.load(composite_path)
+            expiring = [previous_date - datetime.timedelta(days=i) for i in range(n_days)]
+            expiring = [d for d in expiring if d < window[-1]]
+            recompute = np.zeros(composite.shape, dtype=bool)
+            for e_date in expiring:
+                e_data = _load_day(e_date)
+                if e_data is not None:
+                    recompute |= (e_data == composite) & (e_data > 0)
+            if recompute.any():
+                # only the pixels where an expiring day held the maximum are rebuilt from the remaining days
+                composite[recompute] = 0
+                for w_date in window[1:]:
+                    w_data = _load_day(w_date)
+                    if w_data is not None:
+                        composite[recompute] = np.maximum(composite[recompute], w_data[recompute])
+            # days in the buffer after the previous composite, only present if an earlier day was re-aggregated
+            for w_date in window[1:]:
+                if w_date > previous_date:
+                    w_data = _load_day(w_date)
+                    if w_data is not None:
+                        np.maximum(composite, w_data, out=composite)
+            np.maximum(composite, valid, out=composite)
+        else:
+            # first composite, or the latest day re-aggregated, rebuild from the ring buffer
+            composite = _build_composite(date, n_days)
+        np.save(composite_path, composite)
+        state["composites"][product] = {"date": date.isoformat()}
+        _save_composite(composite, state, lut, date, n_days, str_bounds=str_bounds)
+        if previous_date is not None and previous_date < date:
+            # the previous composite png is superseded by this one
+            previous_file = os.path.join(PLOT_DIR, f"{product}-conus-{previous_date.year}-"
+                                                   f"{previous_date.timetuple().tm_yday}.png")
+            if os.path.exists(previous_file):
+                os.remove(previous_file)
+    _save_state(state)
+
+    # drop days which have left the longest window from the ring buffer
+    oldest = latest - datetime.timedelta(days=max(COMPOSITE_DAYS) - 1)
+    for f in os.listdir(os.path.join(COMPOSITE_DIR, "days")):
+        f_year, f_day = f.split(".")[0].split("-")
+        if datetime.date(int(f_year), 1, 1) + datetime.timedelta(days=int(f_day) - 1) < oldest:
+            os.remove(os.path.join(COMPOSITE_DIR, "days", f))
+    logger.info(f"Updated the {', '.join(str(n) for n in COMPOSITE_DAYS)} day CONUS composites, year: {year}, day: {day}")
@@ -0,0 +1,118 @@
+import numpy as np
+from rasterio import windows
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from affine import Affine
+import logging
+import os
+
+from flaskr.storage import open_image
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+DATACUBE_DIR = os.getenv("DATACUBE_DIR")       # datacube store is disabled when not set
+CHUNK_DAYS = 32
+CHUNK_SIZE = 256
+
+
+def datacube_enabled():
+    return h5py is not None and DATACUBE_DIR is not None
+
+
+def get_cube_path(tile: str, daily: bool = True):
+    return os.path.join(DATACUBE_DIR, 'daily' if daily else 'weekly', f"{tile}.h5")
+
+
+def get_tile_name(image_path: str):
+    tile_parts = str(image_path).split("_")
+    return (tile_parts[-2] + "_" + tile_parts[-1]).split(".")[0]
+
+
+def append_images(images: list, year: int, day: int, daily: bool = True):
+    """
+    Append the tile images of a date to the per tile datacubes, replacing the date if it is already in a datacube.
+    :param images: List of tile image paths for the date.
+    :param year: Year of the images.
+    :param day: Day of the year of the images.
+    :param daily: Daily or weekly images.
+    :return: Number of images appended.
+    """
+    if not datacube_enabled():
+        return 0
+    os.makedirs(os.path.join(DATACUBE_DIR, 'daily' if daily else 'weekly'), exist_ok=True)
+    date = int(year) * 1000 + int(day)
+    n = 0
+    for image in images:
+        tile = get_tile_name(image)
+        with open_image(image) as src:
+            data = src.read(1)
+            transform = src.transform
+            crs = src.crs
+        with h5py.File(get_cube_path(tile, daily=daily), "a") as cube:
+            if "data" not in cube:
+                height, width = data.shape
+                cube.create_dataset("data", shape=(0, height, width), maxshape=(None, height, width), dtype=np.uint8,
+                                    chunks=(CHUNK_DAYS, min(CHUNK_SIZE, height), min(CHUNK_SIZE, width)),
+                                    compression="lzf")
+                cube.create_dataset("dates", shape=(0,), maxshape=(None,), dtype=np.int32)
+                cube.attrs["transform"] = tuple(transform)[:6]
+                cube.attrs["crs"] = crs.to_wkt()
+            elif cube["data"].shape[1:] != data.shape:
+                logger.warning(f"Datacube tile: {tile} image shape {data.shape} does not match the datacube "
+                               f"{cube['data'].shape[1:]}, skipping year: {year}, day: {day}")
+                continue
+            dates = cube["dates"][:]
+            existing = np.flatnonzero(dates == date)
+            if existing.size > 0:
+                i = int(existing[0])
+            else:
+                i = dates.size
+                cube["data"].resize(i + 1, axis=0)
+                cube["dates"].resize(i + 1, axis=0)
+            cube["data"][i] = data
+            cube["dates"][i] = date
+        n += 1
+    logger.info(f"Appended {n} images to the {'daily' if daily else 'weekly'} datacube, year: {year}, day: {day}")
+    return n
+
+
+def read_window(tile: str, start_year: int, start_day: int, end_year: int, end_day: int, window: Window = None,
+                daily: bool = True):
+    """
+    Read a window of a tile across a date range from the tile datacube in a single read.
+    :param tile: Tile name, such as '1_2'.
+    :param window: rasterio Window of the tile to read, defaults to the full tile.
+    :return: List of (year, day) dates in order, a (dates, rows, cols) uint8 array, the window affine transform and the
+    tile crs. None if the tile has no datacube.
+    """
+    if not datacube_enabled():
+        return None
+    cube_path = get_cube_path(tile, daily=daily)
+    if not os.path.exists(cube_path):
+        return None
+    start = int(start_year) * 1000 + int(start_day)
+    end = int(end_year) * 1000 + int(end_day)
+    with h5py.File(cube_path, "r") as cube:
+        dates = cube["dates"][:]
+        transform = Affine(*cube.attrs["transform"])
+        crs = CRS.from_wkt(cube.attrs["crs"])
+        selected = np.flatnonzero((dates >= start) & (dates <= end))
+        if window is None:
+            window = Window(0, 0, cube["data"].shape[2], cube["data"].shape[1])
+        rows = slice(int(window.row_off), int(window.row_off + window.height))
+        cols = slice(int(window.col_off), int(window.col_off + window.width))
+        if selected.size == 0:
+            data = np.zeros((0, rows.stop - rows.start, cols.stop - cols.start), dtype=np.uint8)
+        else:
+            i0, i1 = int(selected[0]), int(selected[-1]) + 1
+            data = cube["data"][i0:i1, rows, cols][selected - i0]
+    order = np.argsort(dates[selected], kind="stable")
+    data = data[order]
+    selected_dates = [(int(d) // 1000, int(d) % 1000) for d in dates[selected][order]]
+    return selected_dates, data, windows.transform(window, transform), crs
@@ -3,22 +3,25 @@ import sqlite3
 import numpy as np
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Point, Polygon, MultiPolygon, shape
-from flaskr.geometry import get_waterbody, get_waterbody_count, get_waterbody_by_fids, get_waterbody_fids, get_waterbody_elevation
-from flaskr.raster import get_images, clip_raster, get_images_by_tile, get_raster_bounds
+from shapely.geometry import shape, box
+from shapely.strtree import STRtree
+from flaskr.geometry import get_waterbody, get_waterbody_count, get_waterbody_fids, get_waterbody_elevation, \
+    to_geometries, read_waterbody_geometries, SHAPELY_2
+from flaskr.raster import get_images, get_images_by_tile, get_raster_bounds
+from flaskr.image_cache import invalidate_cached_images
+from flaskr.storage import get_storage, open_image
+from flaskr.spatial import get_waterbody_index
 import datetime
 from tqdm import tqdm
 import multiprocessing as mp
 import logging
+import time
 import csv
 
-from pyproj import Proj, transform
-
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("cyan-waterbody")
 
-IMAGE_DIR = os.getenv('IMAGE_DIR', "D:\\data\cyan_rare\\mounts\\images")
 DB_FILE = os.path.join(os.getenv("WATERBODY_DB", "D:\\data\cyan_rare\\mounts\\database"), "waterbody-data_0.2.sqlite")
 N_VALUES = 256
 
@@ -30,7 +33,7 @@ def get_conn():
     return conn
 
 
-def get_tiles_by_objectid(objectid: str, image_base: str):
+def get_tile_names_by_objectid(objectid: str):
     conn = sqlite3.connect(DB_FILE)
     cur = conn.cursor()
     query = "SELECT tileName FROM GeometryTile WHERE OBJECTID=?"
@@ -38,9 +41,13 @@ def get_tiles_by_objectid(objectid: str, image_base: str):
     cur.execute(query, values)
     tiles = cur.fetchall()
     conn.close()
+    return [i[0] for i in tiles]
+
+
+def get_tiles_by_objectid(objectid: str, image_base: str):
     images = []
-    for i in tiles:
-        images.append(os.path.join(IMAGE_DIR, image_base + "_" + i[0] + ".tif"))
+    for tile in get_tile_names_by_objectid(objectid):
+        images.append(get_storage().get_path(image_base + "_" + tile + ".tif"))
     return images
 
 
@@ -186,46 +193,9 @@ def get_waterbody_fid(objectid: int):
 
 
 def get_waterbody_bypoint(lat: float, lng: float, return_fid: bool=False):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    query = "SELECT OBJECTID, FID FROM WaterbodyBounds WHERE y_max>=? AND x_min<=? AND y_min<=? AND x_max>=?"
-    values = (lat, lng, lat, lng,)
-    cur.execute(query, values)
-    lakes = cur.fetchall()
-    crs = None
-    if len(lakes) > 0:
-        features = []
-        for lake in lakes:
-            # w = get_waterbody(int(lake[0]))
-            w = get_waterbody_by_fids(fid=lake[1])
-            features.append(w[0][0])
-            crs = w[1]
-        wb = (features, crs)
-    else:
-        return None, None, None
-    objectid = None
-    gnis_name = None
-
-    out_proj = Proj(wb[1])
-    _lng, _lat = out_proj(lng, lat)
-    point = gpd.GeoSeries(Point(_lng, _lat), crs=wb[1])
-
-    for features in wb[0]:
-        if features["geometry"]["type"] == "MultiPolygon":
-            poly_geos = []
-            for p in features["geometry"]["coordinates"]:
-                poly_geos.append(Polygon(p[0]))
-            poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=wb[1])
-        else:
-            poly = gpd.GeoSeries(Polygon(features["geometry"]["coordinates"][0]), crs=wb[1])
-        in_wb = poly.contains(point)
-        if in_wb.loc[0]:
-            objectid = features["properties"]["OBJECTID"]
-            gnis_name = features["properties"]["GNIS_NAME"]
-            break
-    conn.close()
+    objectid, fid, gnis_name = get_waterbody_index().find(lat=lat, lng=lng)
     if return_fid and objectid is not None:
-        return objectid, get_waterbody_fid(objectid), gnis_name
+        return objectid, fid, gnis_name
     else:
         return objectid, None, gnis_name
 
@@ -241,6 +211,8 @@ def get_waterbody_bounds(objectid: str):
 
 
 def save_data(year, day, data, daily: bool = True):
+    # rendered images of this date are stale once the date is re-aggregated
+    invalidate_cached_images(year=year, day=day, daily=daily)
     conn = sqlite3.connect(DB_FILE)
     cur = conn.cursor()
     cur.execute("BEGIN")
@@ -275,101 +247,85 @@ def save_data(year, day, data, daily: bool = True):
     conn.close()
 
 
-def set_geometry_tiles(year: int, day: int):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    # clear existing GeometryTile table
-    cur.execute("DELETE FROM GeometryTile")
-    cur.execute("COMMIT")
-    cur.execute("BEGIN")
-    features, crs = get_waterbody()
-    images = get_images(year, day)
-    insert_i = 1
-    max_i = 400
-    for i in tqdm(range(len(features)), desc="Settings geometry to tiff tile mappings...", ascii=False):
-        f = features[i]
-        objectid = int(f["properties"]["OBJECTID"])
-        if f["geometry"]["type"] == "MultiPolygon":
-            poly_geos = []
-            for p in f["geometry"]["coordinates"]:
-                poly_geos.append(Polygon(p[0]))
-            poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-        else:
-            poly = gpd.GeoSeries(Polygon(f["geometry"]["coordinates"][0]), crs=crs)
-        for i in images:
-            data = clip_raster(i, poly, boundary_crs=crs)
-            if data is not None:
-                tile_parts = i.split("_")
-                tile_name = (tile_parts[-2] + "_" + tile_parts[-1]).split(".")[0]
-                query = "INSERT INTO GeometryTile(OBJECTID, tileName) VALUES(?,?)"
-                values = (objectid, tile_name,)
-                cur.execute(query, values)
-            if insert_i % max_i == 0:
-                cur.execute("COMMIT")
-                cur.execute("BEGIN")
-                insert_i = 1
-            else:
-                insert_i += 1
-    cur.execute("COMMIT")
-    conn.close()
+def get_tile_name(image_path: str):
+    tile_parts = image_path.split("_")
+    return (tile_parts[-2] + "_" + tile_parts[-1]).split(".")[0]
 
 
-def p_set_geometry_tiles(year: int, day: int, objectid: int = None):
+def get_geometry_tiles(geometries, crs, images: list):
+    """
+    Map waterbody polygons to the image tiles they overlap. The polygon bounds are intersected with an STRtree of the
+    tile footprints, in the tile crs. Polygons with bounds inside a tile are mapped to it directly, only the polygons
+    crossing a tile edge are tested against the tile footprint with an exact intersects.
+    :param geometries: GeoSeries of the waterbody polygons.
+    :param crs: Crs of the polygons.
+    :param images: Image paths of the tiles, one image per tile.
+    :return: List of (position, tile name) pairs, the position of the polygon in geometries.
+    """
+    tiles = {}
+    for image in images:
+        with open_image(image) as src:
+            tiles.setdefault(src.crs.to_string(), []).append((get_tile_name(image), box(*src.bounds), src.crs))
+    geometries = gpd.GeoSeries(geometries, crs=crs).reset_index(drop=True)
+    valid = (geometries.notna() & ~geometries.is_empty).to_numpy()
+    mapping = []
+    for tile_crs, crs_tiles in tiles.items():
+        tile_geometries = geometries[valid].to_crs(crs_tiles[0][2]).to_numpy()
+        positions = np.flatnonzero(valid)
+        boxes = [t[1] for t in crs_tiles]
+        tree = STRtree(boxes)
+        if SHAPELY_2:
+            geometry_i, tile_i = tree.query(tile_geometries)
+        else:
+            box_positions = {id(b): i for i, b in enumerate(boxes)}
+            pairs = [(i, box_positions[id(b)]) for i, g in enumerate(tile_geometries) for b in tree.query(g)]
+            geometry_i = np.array([p[0] for p in pairs], dtype=np.int64)
+            tile_i = np.array([p[1] for p in pairs], dtype=np.int64)
+        if len(geometry_i) == 0:
+            continue
+        geometry_bounds = np.array([g.bounds for g in tile_geometries])[geometry_i]
+        tile_bounds = np.array([b.bounds for b in boxes])[tile_i]
+        inside = (geometry_bounds[:, 0] >= tile_bounds[:, 0]) & (geometry_bounds[:, 1] >= tile_bounds[:, 1]) & \
+                 (geometry_bounds[:, 2] <= tile_bounds[:, 2]) & (geometry_bounds[:, 3] <= tile_bounds[:, 3])
+        overlaps = inside.copy()
+        for n in np.flatnonzero(~inside):
+            overlaps[n] = tile_geometries[geometry_i[n]].intersects(boxes[tile_i[n]])
+        mapping.extend((int(positions[geometry_i[n]]), crs_tiles[tile_i[n]][0]) for n in np.flatnonzero(overlaps))
+    return mapping
+
+
+def set_geometry_tiles(year: int, day: int, objectids: list = None):
+    """
+    Set the waterbody to tile mapping of GeometryTile, for all waterbodies or only the added or changed objectids.
+    :param year: Year of the reference images, used for the tile footprints.
+    :param day: Day of the year of the reference images.
+    :param objectids: Optional list of OBJECTIDs to update, the mappings of other waterbodies are kept.
+    :return: Number of waterbody to tile mappings written.
+    """
+    t0 = time.time()
+    images = get_images(year, day)
+    if objectids:
+        features, crs = get_waterbody(objectids=[int(o) for o in objectids])
+        wb_objectids = np.array([int(f["properties"]["OBJECTID"]) for f in features], dtype=np.int64)
+        geometries = to_geometries(features)
+    else:
+        wb_objectids, fids, geometries = read_waterbody_geometries()
+        crs = geometries.crs
+    mapping = get_geometry_tiles(geometries, crs, images)
+    values = [(int(wb_objectids[i]), tile_name) for i, tile_name in mapping]
     conn = sqlite3.connect(DB_FILE)
     cur = conn.cursor()
-    # clear existing GeometryTile table
-    cur.execute("DELETE FROM GeometryTile")
-    cur.execute("COMMIT")
-    cur.execute("BEGIN")
-    if objectid:
-        features, crs = get_waterbody(objectid=objectid)
+    if objectids:
+        cur.executemany("DELETE FROM GeometryTile WHERE OBJECTID=?", [(int(o),) for o in objectids])
     else:
-        features, crs = get_waterbody()
-    images = get_images(year, day)
-
-    cpus = mp.cpu_count() - 2 if mp.cpu_count() - 2 >= 2 else mp.cpu_count()
-    pool = mp.Pool(cpus)
-    logger.info("Running async, cores: {}".format(cpus))
-
-    results_objects = [pool.apply_async(p_set_tiles, args=(f, crs, images)) for f in features]
-    results = []
-    for i in tqdm(range(len(results_objects)), desc="Searching for geometry and tif overlapping...", ascii=False):
-        results.append(results_objects[i].get())
-    insert_i = 1
-    max_i = 400
-    for i in tqdm(range(len(results)), desc="Uploading tile to geometry mapping to DB...", ascii=False):
-        r = results[i]
-        for img in r[1]:
-            query = "INSERT INTO GeometryTile(OBJECTID, tileName) VALUES(?,?)"
-            values = (r[0], img,)
-            cur.execute(query, values)
-            if insert_i % max_i == 0:
-                cur.execute("COMMIT")
-                cur.execute("BEGIN")
-                insert_i = 1
-            else:
-                insert_i += 1
-    cur.execute("COMMIT")
+        cur.execute("DELETE FROM GeometryTile")
+    cur.executemany("INSERT INTO GeometryTile(OBJECTID, tileName) VALUES(?,?)", values)
+    conn.commit()
     conn.close()
-
-
-def p_set_tiles(feature, crs, images: list):
-    objectid = int(feature["properties"]["OBJECTID"])
-    if feature["geometry"]["type"] == "MultiPolygon":
-        poly_geos = []
-        for p in feature["geometry"]["coordinates"]:
-            poly_geos.append(Polygon(p[0]))
-        poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-    else:
-        poly = gpd.GeoSeries(Polygon(feature["geometry"]["coordinates"][0]), crs=crs)
-    image_tiles = []
-    for i in images:
-        data = clip_raster(i, poly, boundary_crs=crs)
-        if data is not None:
-            tile_parts = i.split("_")
-            tile_name = (tile_parts[-2] + "_" + tile_parts[-1]).split(".")[0]
-            image_tiles.append(tile_name)
-    return objectid, image_tiles
+    t1 = time.time()
+    logger.info(f"Set geometry to tile mapping for {len(wb_objectids)} waterbodies, {len(values)} mappings, "
+                f"runtime: {round(t1 - t0, 3)} sec")
+    return len(values)
 
 
 def update_status(cur, year: int, day: int, objectid: str, daily: bool, status: str, comments: str = None):
@@ -389,8 +345,7 @@ def set_tile_bounds(year: int, day: int):
     cur.execute("DELETE FROM TileBounds")
     images = get_images(year, day)
     for i in images:
-        tile_parts = i.split("_")
-        tile_name = (tile_parts[-2] + "_" + tile_parts[-1]).split(".")[0]
+        tile_name = get_tile_name(i)
         bounds = get_raster_bounds(i)
         query = "INSERT INTO TileBounds(tile, x_min, x_max, y_min, y_max) VALUES(?,?,?,?,?)"
         values = (tile_name, bounds[0], bounds[2], bounds[1], bounds[3])
@@ -399,6 +354,20 @@ def set_tile_bounds(year: int, day: int):
     conn.close()
 
 
+def get_tiles_bypoint(lat: float, lng: float):
+    """
+    Returns the names of the tiles whose EPSG:4326 bounds contain the point.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cur = conn.cursor()
+    query = "SELECT tile FROM TileBounds WHERE y_max>=? AND x_min<=? AND y_min<=? AND x_max>=?"
+    values = (lat, lng, lat, lng,)
+    cur.execute(query, values)
+    tiles = [r[0] for r in cur.fetchall()]
+    conn.close()
+    return tiles
+
+
 def set_index(objectid_i: list):
     conn = sqlite3.connect(DB_FILE)
     cur = conn.cursor()
@@ -743,8 +712,7 @@ def set_wb_report_file(state, year, month, upload_date, file_url, status):
     conn.close()
 
 
-def set_waterbody_details_table(input_file: str = None):
-    conn = sqlite3.connect(DB_FILE)
+def add_waterbody_details_table(conn):
     cur = conn.cursor()
     try:
         # attempt to create new column
@@ -759,6 +727,12 @@ def set_waterbody_details_table(input_file: str = None):
     except Exception:
         print("Waterbody database already has the waterbody details table")
 
+
+def set_waterbody_details_table(input_file: str = None):
+    conn = sqlite3.connect(DB_FILE)
+    cur = conn.cursor()
+    add_waterbody_details_table(conn)
+
     waterbody_dict = get_waterbody_fids(return_dict=True)
 
     cpus = mp.cpu_count() - 2 if mp.cpu_count() - 2 >= 2 else mp.cpu_count()
@@ -0,0 +1,68 @@
+import numpy as np
+import logging
+
+from flaskr.aggregate import get_waterbody_raster
+from flaskr.raster import get_images, mosaic_raster_gdal, rasterize_boundary, align_to_grid
+from flaskr.composite import get_day_mosaic
+from flaskr.render import render_diff_png, OUTSIDE_VALUE
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+
+def get_waterbody_diff(objectid: int, year_a: int, day_a: int, year_b: int, day_b: int, daily: bool = True):
+    """
+    Render the per-pixel change in DN of a waterbody from date a to date b. The image of date b is aligned to the grid
+    of date a before the change is colored.
+    :return: BytesIO of the png, None if either date has no image of the waterbody.
+    """
+    raster_a, _ = get_waterbody_raster(objectid=objectid, year=year_a, day=day_a, get_bounds=False, daily=daily)
+    if raster_a is None:
+        return None
+    raster_b, _ = get_waterbody_raster(objectid=objectid, year=year_b, day=day_b, get_bounds=False, daily=daily)
+    if raster_b is None:
+        return None
+    data_a = get_boundary_values(raster_a)
+    data_b = align_to_grid(get_boundary_values(raster_b), raster_b[1], raster_a[1], data_a.shape, nodata=OUTSIDE_VALUE)
+    return render_diff_png(data_a, data_b)
+
+
+def get_boundary_values(raster):
+    """
+    Returns the DN values of a waterbody raster, from get_waterbody_raster, with OUTSIDE_VALUE outside the boundary.
+    """
+    data, transform, crs, bounds, boundary = raster
+    data = np.reshape(data, (1, data.shape[0], data.shape[1]))
+    return rasterize_boundary(data, boundary=boundary, affine=transform, crs=crs, value=OUTSIDE_VALUE)[0]
+
+
+def get_conus_mosaic(year: int, day: int, daily: bool = True):
+    """
+    Returns the CONUS mosaic of a date in EPSG:3857 and its affine transform, from the composite buffer when available.
+    None if there are no images for the date.
+    """
+    if daily:
+        mosaic = get_day_mosaic(year=year, day=day)
+        if mosaic is not None:
+            return mosaic
+    images = get_images(year=year, day=day, daily=daily, filtered=True)
+    if len(images) == 0:
+        return None
+    mosaic = mosaic_raster_gdal(images, dst_crs={"init": "EPSG:3857"})
+    return mosaic.read(1), mosaic.transform
+
+
+def get_conus_diff(year_a: int, day_a: int, year_b: int, day_b: int, daily: bool = True):
+    """
+    Render the per-pixel change in DN across CONUS from date a to date b, land is transparent.
+    :return: BytesIO of the png, None if either date has no images.
+    """
+    mosaic_a = get_conus_mosaic(year=year_a, day=day_a, daily=daily)
+    if mosaic_a is None:
+        return None
+    mosaic_b = get_conus_mosaic(year=year_b, day=day_b, daily=daily)
+    if mosaic_b is None:
+        return None
+    data_a, transform_a = mosaic_a
+    data_b = align_to_grid(mosaic_b[0], mosaic_b[1], transform_a, data_a.shape, nodata=255)
+    return render_diff_png(data_a, data_b, land=False)
@@ -0,0 +1,145 @@
+import numpy as np
+import rasterio
+from rasterio import features
+from rasterio.windows import Window
+from collections import defaultdict
+import sqlite3
+import logging
+import time
+import os
+
+from flaskr.geometry import read_waterbody_geometries
+from flaskr.db import DB_FILE, add_waterbody_details_table
+from flaskr.registry import reset_registry
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+DEM_FILE = os.getenv("DEM_FILE", os.path.join("static", "dem", "dem.tif"))
+DEM_UNITS = os.getenv("DEM_UNITS", "meters")         # vertical units of the DEM, 'meters' or 'feet'
+DEM_CHUNK_SIZE = int(os.getenv("DEM_CHUNK_SIZE", 2048))      # DEM pixels per side of a windowed read
+MISSING_ELEVATION = -9999.0      # WaterbodyDetails elevation of waterbodies without DEM data
+
+
+def get_windows(bounds: np.ndarray, transform, width: int, height: int):
+    """
+    Returns the (row_start, row_stop, col_start, col_stop) DEM pixel windows of an array of (minx, miny, maxx, maxy)
+    bounds, clipped to the DEM. Windows outside of the DEM are empty.
+    """
+    inverse = ~transform
+    cols_a, rows_a = inverse * (bounds[:, 0], bounds[:, 1])
+    cols_b, rows_b = inverse * (bounds[:, 2], bounds[:, 3])
+    col_start = np.clip(np.floor(np.minimum(cols_a, cols_b)), 0, width).astype(np.int64)
+    col_stop = np.clip(np.ceil(np.maximum(cols_a, cols_b)), 0, width).astype(np.int64)
+    row_start = np.clip(np.floor(np.minimum(rows_a, rows_b)), 0, height).astype(np.int64)
+    row_stop = np.clip(np.ceil(np.maximum(rows_a, rows_b)), 0, height).astype(np.int64)
+    return np.column_stack((row_start, row_stop, col_start, col_stop))
+
+
+def get_zonal_minimum(geometry, data: np.ma.MaskedArray, transform):
+    """
+    Returns the minimum of the valid DEM pixels within a polygon, pixels touched by the polygon are used for polygons
+    smaller than a pixel. None if there is no valid pixel.
+    """
+    for all_touched in (False, True):
+        inside = features.geometry_mask([geometry], out_shape=data.shape, transform=transform, invert=True,
+                                        all_touched=all_touched)
+        inside &= ~np.ma.getmaskarray(data)
+        if inside.any():
+            return float(data.data[inside].min())
+    return None
+
+
+def get_chunked_zonal_minimum(dem, geometry, window, chunk_size: int):
+    """
+    Returns the minimum of the valid DEM pixels within a polygon larger than a chunk, reading its (row_start, row_stop,
+    col_start, col_stop) window in chunk sized windows. None if there is no valid pixel.
+    """
+    row_start, row_stop, col_start, col_stop = (int(w) for w in window)
+    for all_touched in (False, True):
+        minimum = None
+        for r0 in range(row_start, row_stop, chunk_size):
+            for c0 in range(col_start, col_stop, chunk_size):
+                sub_window = Window(c0, r0, min(chunk_size, col_stop - c0), min(chunk_size, row_stop - r0))
+                data = dem.read(1, window=sub_window, masked=True)
+                inside = features.geometry_mask([geometry], out_shape=data.shape,
+                                                transform=dem.window_transform(sub_window), invert=True,
+                                                all_touched=all_touched)
+                inside &= ~np.ma.getmaskarray(data)
+                if inside.any():
+                    chunk_minimum = float(data.data[inside].min())
+                    minimum = chunk_minimum if minimum is None else min(minimum, chunk_minimum)
+        if minimum is not None:
+            return minimum
+    return None
+
+
+def get_dem_elevations(dem_file: str = None, chunk_size: int = None):
+    """
+    Compute the elevation of every waterbody as the minimum DEM value within its polygon, the water surface of a hydro
+    flattened DEM. The waterbodies are grouped by the DEM chunk of their window, and each group is read from the DEM
+    with one windowed read. Waterbodies larger than a chunk are read on their own, one chunk at a time.
+    :param dem_file: Path to the DEM GeoTIFF, or VRT of DEM tiles, defaults to DEM_FILE.
+    :param chunk_size: DEM pixels per side of a chunk, defaults to DEM_CHUNK_SIZE.
+    :return: Arrays of the OBJECTIDs, FIDs and elevations in feet, MISSING_ELEVATION where the DEM has no data.
+    """
+    t0 = time.time()
+    dem_file = dem_file if dem_file else DEM_FILE
+    chunk_size = chunk_size if chunk_size else DEM_CHUNK_SIZE
+    objectids, fids, geometries = read_waterbody_geometries()
+    elevations = np.full(len(objectids), MISSING_ELEVATION, dtype=np.float64)
+    to_feet = 3.281 if DEM_UNITS == "meters" else 1.0
+    with rasterio.open(dem_file) as dem:
+        geometries = geometries.to_crs(dem.crs)
+        valid = (geometries.notna() & ~geometries.is_empty).to_numpy()
+        geometries = geometries.to_numpy()
+        windows = np.zeros((len(geometries), 4), dtype=np.int64)
+        windows[valid] = get_windows(np.array([g.bounds for g in geometries[valid]]), dem.transform, dem.width,
+                                     dem.height)
+        valid = valid & (windows[:, 1] > windows[:, 0]) & (windows[:, 3] > windows[:, 2])
+        large = valid & (((windows[:, 1] - windows[:, 0]) > chunk_size) |
+                         ((windows[:, 3] - windows[:, 2]) > chunk_size))
+
+        groups = defaultdict(list)
+        for i in np.flatnonzero(valid & ~large):
+            groups[(int(windows[i, 0] // chunk_size), int(windows[i, 2] // chunk_size))].append(i)
+        groups = list(groups.values())
+        logger.info(f"Computing DEM elevations for {int(valid.sum())} waterbodies in {len(groups)} windowed reads, "
+                    f"{int(large.sum())} waterbodies larger than a chunk")
+
+        for i in np.flatnonzero(large):
+            elevation = get_chunked_zonal_minimum(dem, geometries[i], windows[i], chunk_size)
+            if elevation is not None:
+                elevations[i] = round(elevation * to_feet, 2)
+        for group in groups:
+            row_start, col_start = windows[group, 0].min(), windows[group, 2].min()
+            window = Window(col_start, row_start, windows[group, 3].max() - col_start,
+                            windows[group, 1].max() - row_start)
+            data = dem.read(1, window=window, masked=True)
+            for i in group:
+                r0, r1, c0, c1 = windows[i] - (row_start, row_start, col_start, col_start)
+                sub_transform = dem.window_transform(Window(col_start + c0, row_start + r0, c1 - c0, r1 - r0))
+                elevation = get_zonal_minimum(geometries[i], data[r0:r1, c0:c1], sub_transform)
+                if elevation is not None:
+                    elevations[i] = round(elevation * to_feet, 2)
+    t1 = time.time()
+    logger.info(f"Computed DEM elevations, {int((elevations != MISSING_ELEVATION).sum())} of {len(objectids)} "
+                f"waterbodies, runtime: {round(t1 - t0, 3)} sec")
+    return objectids, fids, elevations
+
+
+def set_dem_elevations(dem_file: str = None):
+    """
+    Rebuild the WaterbodyDetails table from the local DEM, replacing all elevations in one transaction.
+    """
+    objectids, fids, elevations = get_dem_elevations(dem_file=dem_file)
+    conn = sqlite3.connect(DB_FILE)
+    add_waterbody_details_table(conn)
+    cur = conn.cursor()
+    cur.execute("DELETE FROM WaterbodyDetails")
+    cur.executemany("INSERT INTO WaterbodyDetails (OBJECTID, fid, elevation) VALUES (?,?,?)",
+                    zip(objectids.tolist(), fids.tolist(), elevations.tolist()))
+    conn.commit()
+    conn.close()
+    reset_registry()
+    logger.info(f"Updated waterbody details table with DEM elevations for {len(objectids)} waterbodies")
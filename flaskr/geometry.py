@@ -8,15 +8,112 @@ import random
 import requests
 import json
 import numpy as np
-from shapely.geometry import Polygon, MultiPolygon, Point
+import shapely
+from shapely.geometry import Point, shape
 from pyproj import Proj, transform
 
 import time
 
+from flaskr.geometry_store import get_store, SOURCE_FID
+
 WATERBODY_DBF = os.path.join(os.getenv("WATERBODY_DBF", "D:\\data\cyan_rare\\mounts\\geometry"), "waterbodies_9.dbf")
 COUNTY_DBF = os.path.join(os.getenv("COUNTY_DBF", "D:\\data\cyan_rare\\mounts\\geometry"), "cb_2020_us_county_500k.dbf")
 STATE_DBF = os.path.join(os.getenv("STATE_DBF", "D:\\data\cyan_rare\\mounts\\geometry"), "cb_2020_us_state_500k.dbf")
 TRIBE_DBF = os.path.join(os.getenv("TRIBE_DBF", "D:\\data\cyan_rare\\mounts\\geometry"), "cb_2020_us_aiannh_500k.dbf")
+GEOMETRY_LAYERS = {
+    "waterbodies": WATERBODY_DBF,
+    "counties": COUNTY_DBF,
+    "states": STATE_DBF,
+    "tribes": TRIBE_DBF
+}
+SHAPELY_2 = int(shapely.__version__.split(".")[0]) >= 2
+
+
+def get_layer_store(layer: str):
+    """
+    Returns the geometry store reader of a layer, None when the store has not been built and the shapefile is read.
+    """
+    return get_store(layer, source_path=GEOMETRY_LAYERS[layer])
+
+
+def read_waterbody_geometries():
+    """
+    Returns the waterbody OBJECTIDs, FIDs and polygons, from the geometry store when built or the shapefile.
+    """
+    store = get_layer_store("waterbodies")
+    if store is not None:
+        waterbodies = gpd.read_file(store.path).sort_values(SOURCE_FID)
+        fids = waterbodies[SOURCE_FID].to_numpy(dtype=np.int64)
+    else:
+        waterbodies = gpd.read_file(WATERBODY_DBF)
+        fids = np.arange(len(waterbodies), dtype=np.int64)
+    return waterbodies["OBJECTID"].to_numpy(dtype=np.int64), fids, waterbodies.geometry
+
+
+def to_geometries(features: list):
+    """
+    Convert a batch of Polygon and MultiPolygon features to an array of shapely geometries, with all of their rings,
+    holes included. On shapely 2 the rings of all features are concatenated into one coordinate array and the
+    geometries are built with a single from_ragged_array call.
+    :param features: List of features, as read with fiona.
+    :return: Object array of geometries, None for features without a geometry.
+    """
+    geometries = np.empty(len(features), dtype=object)
+    if not SHAPELY_2:
+        for i, f in enumerate(features):
+            geometries[i] = shape(f["geometry"]) if f["geometry"] else None
+        return geometries
+    rings = []
+    ring_offsets = [0]
+    polygon_offsets = [0]
+    part_offsets = [0]
+    valid = []
+    is_polygon = []
+    for i, f in enumerate(features):
+        if not f["geometry"] or not f["geometry"]["coordinates"]:
+            continue
+        polygons = f["geometry"]["coordinates"]
+        if f["geometry"]["type"] == "Polygon":
+            polygons = [polygons]
+        for polygon in polygons:
+            for ring in polygon:
+                rings.append(np.asarray(ring, dtype=np.float64)[:, :2])
+                ring_offsets.append(ring_offsets[-1] + len(rings[-1]))
+            polygon_offsets.append(len(ring_offsets) - 1)
+        part_offsets.append(len(polygon_offsets) - 1)
+        valid.append(i)
+        is_polygon.append(f["geometry"]["type"] == "Polygon")
+    if len(valid) == 0:
+        return geometries
+    offsets = (np.array(ring_offsets), np.array(polygon_offsets), np.array(part_offsets))
+    multipolygons = shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON, np.concatenate(rings), offsets)
+    # keep the Polygon features as Polygons
+    is_polygon = np.array(is_polygon)
+    multipolygons[is_polygon] = shapely.get_geometry(multipolygons[is_polygon], 0)
+    geometries[valid] = multipolygons
+    return geometries
+
+
+def to_geoseries(feature: dict, crs):
+    """
+    Returns the geometry of a feature as a single geometry GeoSeries, holes included.
+    """
+    return gpd.GeoSeries(to_geometries([feature]), crs=crs)
+
+
+def read_waterbodies_by_fids(fids: list):
+    """
+    Returns the waterbody features of a list of FIDs, in order, and the crs.
+    """
+    store = get_layer_store("waterbodies")
+    if store is not None:
+        return store.get_by_fids(fids)
+    features = []
+    with fiona.open(WATERBODY_DBF) as waterbodies:
+        crs = waterbodies.crs
+        for fid in fids:
+            features.append(waterbodies.get(fid))
+    return features, crs
 
 
 def get_waterbody_fids(return_dict: bool = False):
@@ -38,97 +135,56 @@ def get_waterbody_by_fids(fid: int = None, fids: list = None, tojson: bool = Fal
     names = {}
     if fid is None and fids is None:
         return features
+    fid_list = ([fid] if fid is not None else []) + (list(fids) if fids is not None else [])
+    features, crs = read_waterbodies_by_fids(fid_list)
     if tojson:
-        with fiona.open(WATERBODY_DBF) as waterbodies:
-            crs = waterbodies.crs
-            if fid is not None:
-                f = waterbodies.get(fid)
-                features.append(f)
-            if fids is not None:
-                for _fid in fids:
-                    f = waterbodies.get(_fid)
-                    features.append(f)
-            geojson = []
-            for feature in features:
-                if feature["geometry"]["type"] == "MultiPolygon":
-                    poly_geos = []
-                    for p in feature["geometry"]["coordinates"]:
-                        poly_geos.append(Polygon(p[0]))
-                    poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-                else:
-                    poly = gpd.GeoSeries(Polygon(feature["geometry"]["coordinates"][0]), crs=crs)
-                geojson.append(poly.to_json())
-            return geojson
+        return [gpd.GeoSeries([geometry], crs=crs).to_json() for geometry in to_geometries(features)]
     else:
-        with fiona.open(WATERBODY_DBF) as waterbodies:
-            crs = waterbodies.crs
-            if fid is not None:
-                f = waterbodies.get(fid)
-                features.append(f)
-                names[int(f["properties"]["OBJECTID"])] = f["properties"]["GNIS_NAME"]
-            if fids is not None:
-                for _fid in fids:
-                    f = waterbodies.get(_fid)
-                    features.append(f)
-                    names[int(f["properties"]["OBJECTID"])] = f["properties"]["GNIS_NAME"]
+        for f in features:
+            names[int(f["properties"]["OBJECTID"])] = f["properties"]["GNIS_NAME"]
         if name_only:
             return names
         return features, crs
 
 
-def get_waterbody(objectid: int = None, objectids: list = None, tojson: bool = False, all: bool = False):
+def read_waterbodies(objectid: int = None, objectids: list = None):
+    """
+    Returns the waterbody features of an objectid, a list of objectids or all waterbodies, in FID order, and the crs.
+    """
+    store = get_layer_store("waterbodies")
+    if store is not None:
+        if objectid:
+            features, crs = store.get_by_keys([objectid])
+            return features[:1], crs
+        elif objectids:
+            features, crs = store.get_by_keys(set(objectids))
+            features.sort(key=lambda f: int(f["id"]))
+            return features, crs
+        return store.get_all()
     features = []
-    if tojson:
-        with fiona.open(WATERBODY_DBF) as waterbodies:
-            crs = waterbodies.crs
-            for f in waterbodies:
-                if objectid:
-                    if objectid == f["properties"]["OBJECTID"]:
-                        features.append(f)
-                        break
-                elif objectids:
-                    if f["properties"]["OBJECTID"] in objectids:
-                        features.append(f)
-                        continue
-                else:
+    with fiona.open(WATERBODY_DBF) as waterbodies:
+        crs = waterbodies.crs
+        for f in waterbodies:
+            if objectid:
+                if objectid == f["properties"]["OBJECTID"]:
                     features.append(f)
-            geojson = []
-            for feature in features:
-                if feature["geometry"]["type"] == "MultiPolygon":
-                    poly_geos = []
-                    for p in feature["geometry"]["coordinates"]:
-                        poly_geos.append(Polygon(p[0]))
-                    poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-                else:
-                    poly = gpd.GeoSeries(Polygon(feature["geometry"]["coordinates"][0]), crs=crs)
-                geojson.append(poly.to_json())
-            return geojson
-    else:
-        i = 0
-        features_list = []
-        with fiona.open(WATERBODY_DBF) as waterbodies:
-            crs = waterbodies.crs
-            for f in waterbodies:
-                i += 1
-                if objectid:
-                    if objectid == f["properties"]["OBJECTID"]:
-                        features.append(f)
-                        break
-                elif objectids:
-                    if f["properties"]["OBJECTID"] in objectids:
-                        features.append(f)
-                        continue
-                elif all:
-                    features_list.append(f)
-                else:
+                    break
+            elif objectids:
+                if f["properties"]["OBJECTID"] in objectids:
                     features.append(f)
-        if all:
-            feature_dict = {
-                "type": "FeatureCollection",
-                "features": features_list
-            }
-            features = gpd.GeoDataFrame.from_features(feature_dict, crs=crs)
-        return features, crs
+            else:
+                features.append(f)
+    return features, crs
+
+
+def get_waterbody(objectid: int = None, objectids: list = None, tojson: bool = False, all: bool = False):
+    features, crs = read_waterbodies(objectid=objectid, objectids=objectids)
+    if tojson:
+        return [gpd.GeoSeries([geometry], crs=crs).to_json() for geometry in to_geometries(features)]
+    if all:
+        features = gpd.GeoDataFrame([dict(f["properties"]) for f in features], geometry=to_geometries(features),
+                                    crs=crs)
+    return features, crs
 
 
 def get_waterbody_byname(gnis_name: str):
@@ -220,8 +276,20 @@ def get_waterbody_count():
     return n
 
 
+def get_layer_boundary(layer: str, keys: list):
+    """
+    Returns the first feature of a boundary layer matching one of the keys, and the crs, from the geometry store.
+    """
+    features, crs = get_layer_store(layer).get_by_keys(keys)
+    if len(features) == 0:
+        return None, None
+    return features[0], crs
+
+
 def get_county_boundary(geoid, retry: bool = False):
     geoid_alt = geoid.zfill(5)
+    if get_layer_store("counties") is not None:
+        return get_layer_boundary("counties", [geoid, geoid_alt])
     with fiona.open(COUNTY_DBF) as counties:
         crs = counties.crs
         for c in counties:
@@ -231,6 +299,8 @@ def get_county_boundary(geoid, retry: bool = False):
 
 
 def get_state_boundary(state):
+    if get_layer_store("states") is not None:
+        return get_layer_boundary("states", [state])
     with fiona.open(STATE_DBF) as states:
         crs = states.crs
         for c in states:
@@ -241,6 +311,8 @@ def get_state_boundary(state):
 
 def get_tribe_boundary(tribe):
     tribe_alt = tribe.zfill(4)
+    if get_layer_store("tribes") is not None:
+        return get_layer_boundary("tribes", [tribe, tribe_alt])
     with fiona.open(TRIBE_DBF) as tribes:
         crs = tribes.crs
         for c in tribes:
@@ -251,14 +323,7 @@ def get_tribe_boundary(tribe):
 
 def get_waterbody_elevation(fid: int, n: int = 10, delay: int = 2, countdown: int = 0):
     waterbody, crs = get_waterbody_by_fids(fid=fid)
-    waterbody = waterbody[0]
-    if waterbody["geometry"]["type"] == "MultiPolygon":
-        poly_geos = []
-        for p in waterbody["geometry"]["coordinates"]:
-            poly_geos.append(Polygon(p[0]))
-        poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-    else:
-        poly = gpd.GeoSeries(Polygon(waterbody["geometry"]["coordinates"][0]), crs=crs)
+    poly = to_geoseries(waterbody[0], crs)
     points = []
     m = 0
     poly_bounds = poly.geometry.bounds
@@ -0,0 +1,184 @@
+import numpy as np
+import logging
+import json
+import time
+import os
+
+from flaskr.geometry import WATERBODY_DBF, read_waterbodies_by_fids, to_geoseries
+from flaskr.image_cache import get_cache_name, get_cached_image, put_cached_image
+from flaskr.registry import get_registry
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+GEOMETRY_TOLERANCES = (0.00001, 0.0001, 0.001)     # simplification levels, in degrees of EPSG:4326
+GEOMETRY_FORMATS = ("geojson", "topojson", "polyline")
+COORDINATE_PRECISION = 6                            # decimal places of the geojson and polyline coordinates
+TOPOJSON_QUANTIZATION = 100000                      # topojson grid size across the waterbody bounds
+
+
+def get_level(tolerance: float = None, zoom: float = None):
+    """
+    Returns the simplification level, 0 for the full geometry or 1 + the position in GEOMETRY_TOLERANCES, at the largest
+    tolerance not over the requested tolerance, or the size of a web map pixel at the zoom level.
+    """
+    if tolerance is None and zoom is not None:
+        # degrees per pixel of a 256 pixel web mercator tile at the equator
+        tolerance = 360.0 / (256 * 2 ** float(zoom))
+    if tolerance is None:
+        return 0
+    return len([t for t in GEOMETRY_TOLERANCES if t <= float(tolerance)])
+
+
+def get_level_tolerance(level: int):
+    return GEOMETRY_TOLERANCES[level - 1] if level > 0 else 0.0
+
+
+def get_polygons(geometry):
+    """
+    Returns the rings of a Polygon or MultiPolygon, as a list of polygons each a list of (n, 2) coordinate arrays,
+    the exterior ring first then the holes.
+    """
+    parts = geometry.geoms if geometry.geom_type == "MultiPolygon" else [geometry]
+    polygons = []
+    for polygon in parts:
+        if polygon.is_empty:
+            continue
+        rings = [np.asarray(polygon.exterior.coords)[:, :2]]
+        rings.extend(np.asarray(ring.coords)[:, :2] for ring in polygon.interiors)
+        polygons.append(rings)
+    return polygons
+
+
+def get_waterbody_geometry(objectid: int, level: int = 0):
+    """
+    Returns the geometry of a waterbody in EPSG:4326, simplified at a level of GEOMETRY_TOLERANCES, None if not found.
+    """
+    fid = get_registry().get_fid(objectid)
+    if fid is None:
+        return None
+    features, crs = read_waterbodies_by_fids([fid])
+    if len(features) == 0 or features[0]["geometry"] is None:
+        return None
+    geometry = to_geoseries(features[0], crs).to_crs(4326)
+    if level > 0:
+        geometry = geometry.simplify(get_level_tolerance(level), preserve_topology=True)
+    return geometry.iloc[0]
+
+
+def to_geojson(objectid: int, geometry):
+    """
+    Encode a geometry as a single GeoJSON Feature, coordinates rounded to COORDINATE_PRECISION.
+    """
+    polygons = [[np.round(ring, COORDINATE_PRECISION).tolist() for ring in rings] for rings in get_polygons(geometry)]
+    if len(polygons) == 1:
+        geojson_geometry = {"type": "Polygon", "coordinates": polygons[0]}
+    else:
+        geojson_geometry = {"type": "MultiPolygon", "coordinates": polygons}
+    return {"type": "Feature", "id": objectid, "properties": {"OBJECTID": objectid}, "geometry": geojson_geometry}
+
+
+def to_topojson(objectid: int, geometry):
+    """
+    Encode a geometry as a TopoJSON Topology, with one quantized and delta encoded arc per ring.
+    """
+    polygons = get_polygons(geometry)
+    minx, miny, maxx, maxy = geometry.bounds
+    kx = (maxx - minx) / (TOPOJSON_QUANTIZATION - 1) if maxx > minx else 1.0
+    ky = (maxy - miny) / (TOPOJSON_QUANTIZATION - 1) if maxy > miny else 1.0
+    arcs = []
+    arc_polygons = []
+    for rings in polygons:
+        arc_rings = []
+        for i, ring in enumerate(rings):
+            q = np.column_stack((np.round((ring[:, 0] - minx) / kx), np.round((ring[:, 1] - miny) / ky))).astype(np.int64)
+            # drop the points which quantize to the previous point
+            keep = np.ones(len(q), dtype=bool)
+            keep[1:] = np.any(q[1:] != q[:-1], axis=1)
+            q = q[keep]
+            if len(q) < 4:
+                if i == 0:
+                    break
+                continue
+            q[1:] = np.diff(q, axis=0)
+            arc_rings.append([len(arcs)])
+            arcs.append(q.tolist())
+        if arc_rings:
+            arc_polygons.append(arc_rings)
+    if len(arc_polygons) == 1:
+        topology_geometry = {"type": "Polygon", "arcs": arc_polygons[0]}
+    else:
+        topology_geometry = {"type": "MultiPolygon", "arcs": arc_polygons}
+    topology_geometry["id"] = objectid
+    topology_geometry["properties"] = {"OBJECTID": objectid}
+    return {
+        "type": "Topology",
+        "transform": {"scale": [kx, ky], "translate": [minx, miny]},
+        "bbox": [minx, miny, maxx, maxy],
+        "objects": {"waterbody": {"type": "GeometryCollection", "geometries": [topology_geometry]}},
+        "arcs": arcs
+    }
+
+
+def encode_polyline(coordinates, precision: int = COORDINATE_PRECISION):
+    """
+    Encode a ring with the encoded polyline algorithm, as (lat, lng) pairs, vectorized over all of the coordinates.
+    :param coordinates: (n, 2) array of (lng, lat) coordinates.
+    :param precision: Decimal places kept, 5 for the original algorithm or 6 for polyline6.
+    """
+    values = np.round(np.asarray(coordinates)[:, ::-1] * 10 ** precision).astype(np.int64)
+    values[1:] = np.diff(values, axis=0)
+    values = values.ravel()
+    values = (values << 1) ^ (values >> 63)
+    # split each value into 5 bit chunks, least significant first, with a continuation bit on all but the last
+    shifts = np.arange(13, dtype=np.int64) * 5
+    n_chunks = np.sum(values[:, None] >= (1 << shifts[1:])[None, :], axis=1) + 1
+    shifts = shifts[:n_chunks.max()]
+    chunks = (values[:, None] >> shifts[None, :]) & 0x1f
+    chunk_i = np.arange(len(shifts))[None, :]
+    chunks = chunks | np.where(chunk_i < n_chunks[:, None] - 1, 0x20, 0)
+    chunks = (chunks + 63)[chunk_i < n_chunks[:, None]]
+    return chunks.astype(np.uint8).tobytes().decode("ascii")
+
+
+def to_polyline(objectid: int, geometry):
+    """
+    Encode a geometry as a list of polygons, each a list of encoded polyline rings, the exterior ring first.
+    """
+    polygons = [[encode_polyline(ring) for ring in rings] for rings in get_polygons(geometry)]
+    return {"objectid": objectid, "type": "MultiPolygon", "precision": COORDINATE_PRECISION, "polygons": polygons}
+
+
+ENCODERS = {
+    "geojson": to_geojson,
+    "topojson": to_topojson,
+    "polyline": to_polyline
+}
+
+
+def get_encoded_geometry(objectid: int, format: str = "geojson", tolerance: float = None, zoom: float = None):
+    """
+    Returns the path of a cached waterbody geometry encoding, encoding and caching it on the first request.
+    :param objectid: Waterbody objectid.
+    :param format: One of GEOMETRY_FORMATS.
+    :param tolerance: Simplification tolerance in degrees, the largest of GEOMETRY_TOLERANCES not over it is used.
+    :param zoom: Web map zoom level, used for the tolerance when tolerance is not provided.
+    :return: Path to the encoded json, None if the waterbody was not found.
+    """
+    t0 = time.time()
+    level = get_level(tolerance=tolerance, zoom=zoom)
+    # geometries are only updated with the shapefile, the cached encodings of a previous shapefile are not used
+    version = int(os.path.getmtime(WATERBODY_DBF)) if os.path.exists(WATERBODY_DBF) else 0
+    cache_name = get_cache_name("geometry", objectid, year=0, day=0, variant=f"{format}-{level}-{version}", ext="json")
+    path = get_cached_image(cache_name)
+    if path is not None:
+        return path
+    geometry = get_waterbody_geometry(objectid, level=level)
+    if geometry is None or geometry.is_empty:
+        return None
+    data = json.dumps(ENCODERS[format](objectid, geometry), separators=(",", ":")).encode("utf-8")
+    path = put_cached_image(cache_name, data)
+    t1 = time.time()
+    logger.info(f"Encoded waterbody geometry: {objectid}, format: {format}, tolerance: {get_level_tolerance(level)}, "
+                f"{len(data)} bytes, runtime: {round(t1 - t0, 3)} sec")
+    return path
@@ -0,0 +1,201 @@
+import numpy as np
+import geopandas as gpd
+import threading
+import logging
+import fiona
+import time
+import os
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+GEOMETRY_STORE_DIR = os.getenv("GEOMETRY_STORE_DIR", os.path.join("static", "geometry_store"))
+SOURCE_FID = "SRC_FID"          # position of the feature in the source shapefile, the shapefile FID
+
+# Attribute used for the key lookup of each layer
+LAYER_KEYS = {
+    "waterbodies": "OBJECTID",
+    "counties": "GEOID",
+    "states": "STUSPS",
+    "tribes": "GEOID"
+}
+
+_lookups = {}
+_lock = threading.Lock()
+
+
+def get_store_path(layer: str):
+    return os.path.join(GEOMETRY_STORE_DIR, f"{layer}.fgb")
+
+
+def get_lookup_path(layer: str):
+    return os.path.join(GEOMETRY_STORE_DIR, f"{layer}_lookup.npz")
+
+
+def build_layer(layer: str, source_path: str):
+    """
+    Convert a shapefile layer to FlatGeobuf, written with a packed Hilbert R-tree so features can be read by bbox or
+    by position without reading the whole file. The R-tree orders the features along the Hilbert curve, so the source
+    FID of each feature is stored as an attribute and in a lookup of source FID and key attribute to store position.
+    :param layer: Layer name, one of LAYER_KEYS.
+    :param source_path: Path to the source shapefile, or its dbf.
+    :return: Path to the FlatGeobuf file.
+    """
+    t0 = time.time()
+    os.makedirs(GEOMETRY_STORE_DIR, exist_ok=True)
+    store_path = get_store_path(layer)
+    tmp_path = store_path + ".tmp"
+    with fiona.open(source_path) as src:
+        # keep the Polygon and MultiPolygon features of the shapefile as they are read from it
+        schema = {"properties": dict(src.schema["properties"]), "geometry": "Unknown"}
+        schema["properties"][SOURCE_FID] = "int"
+        with fiona.open(tmp_path, "w", driver="FlatGeobuf", crs=src.crs, schema=schema, SPATIAL_INDEX="YES") as dst:
+            n = 0
+            for f in src:
+                properties = dict(f["properties"])
+                properties[SOURCE_FID] = int(f["id"])
+                dst.write({"type": "Feature", "properties": properties, "geometry": f["geometry"]})
+                n += 1
+    os.replace(tmp_path, store_path)
+
+    # store positions after the Hilbert sort
+    attributes = gpd.read_file(store_path, ignore_geometry=True)
+    source_fids = attributes[SOURCE_FID].to_numpy(dtype=np.int64)
+    positions = np.empty(len(source_fids), dtype=np.int64)
+    positions[source_fids] = np.arange(len(source_fids), dtype=np.int64)
+    keys = attributes[LAYER_KEYS[layer]].to_numpy()
+    if keys.dtype == object:
+        keys = keys.astype(str)
+    key_order = np.argsort(keys, kind="stable")
+    np.savez(get_lookup_path(layer), positions=positions, keys=keys[key_order], key_positions=key_order,
+             source_mtime=os.path.getmtime(source_path))
+    with _lock:
+        _lookups.pop(layer, None)
+    t1 = time.time()
+    logger.info(f"Built geometry store layer: {layer}, {n} features, runtime: {round(t1 - t0, 3)} sec")
+    return store_path
+
+
+def build_geometry_store(layers: dict):
+    """
+    Build the geometry store for each layer.
+    :param layers: Dictionary of layer name to source shapefile path.
+    """
+    for layer, source_path in layers.items():
+        if os.path.exists(source_path):
+            build_layer(layer, source_path)
+        else:
+            logger.warning(f"Geometry store source for layer: {layer} not found at: {source_path}")
+
+
+def get_lookup(layer: str, source_path: str = None):
+    """
+    Returns the position lookup of a store layer, loaded once per process. None if the layer has not been built, or
+    the source shapefile has changed since the layer was built.
+    """
+    lookup = _lookups.get(layer)
+    if lookup is not None:
+        return lookup
+    with _lock:
+        if layer in _lookups:
+            return _lookups[layer]
+        if not os.path.exists(get_store_path(layer)) or not os.path.exists(get_lookup_path(layer)):
+            return None
+        with np.load(get_lookup_path(layer)) as lookup_data:
+            lookup = {k: lookup_data[k] for k in lookup_data.files}
+        if source_path and os.path.exists(source_path) and \
+                os.path.getmtime(source_path) > float(lookup["source_mtime"]):
+            logger.warning(f"Geometry store layer: {layer} is older than its source, rebuild with main.py "
+                           f"--build_geometry_store")
+            return None
+        _lookups[layer] = lookup
+        return lookup
+
+
+def to_feature(feature):
+    """
+    Returns a store feature as a plain feature dict, with the source FID as the id as when read from the shapefile.
+    """
+    properties = dict(feature["properties"])
+    source_fid = properties.pop(SOURCE_FID)
+    return {
+        "type": "Feature",
+        "id": str(source_fid),
+        "properties": properties,
+        "geometry": dict(feature["geometry"]) if feature["geometry"] is not None else None
+    }
+
+
+class GeometryStore:
+    """
+    Reader of a geometry store layer, features are read by source FID, FID range, key attribute or bbox without
+    reading the full file.
+    """
+
+    def __init__(self, layer: str, lookup: dict):
+        self.layer = layer
+        self.lookup = lookup
+        self.path = get_store_path(layer)
+
+    def get_positions_by_fids(self, fids):
+        fids = np.asarray(fids, dtype=np.int64)
+        valid = (fids >= 0) & (fids < len(self.lookup["positions"]))
+        return self.lookup["positions"][fids[valid]]
+
+    def get_positions_by_keys(self, keys):
+        sorted_keys = self.lookup["keys"]
+        positions = []
+        for key in keys:
+            i = np.searchsorted(sorted_keys, key)
+            while i < len(sorted_keys) and sorted_keys[i] == key:
+                positions.append(int(self.lookup["key_positions"][i]))
+                i += 1
+        return positions
+
+    def read(self, positions):
+        """
+        Read the features at store positions, in the given order.
+        :return: List of features and the layer crs.
+        """
+        with fiona.open(self.path) as src:
+            crs = src.crs
+            features = [to_feature(src.get(int(p))) for p in positions]
+        return features, crs
+
+    def get_by_fids(self, fids):
+        return self.read(self.get_positions_by_fids(fids))
+
+    def get_by_fid_range(self, start: int, stop: int):
+        return self.read(self.get_positions_by_fids(np.arange(start, stop)))
+
+    def get_by_keys(self, keys):
+        return self.read(self.get_positions_by_keys(keys))
+
+    def get_by_bbox(self, bbox: tuple):
+        """
+        Read the features intersecting a (minx, miny, maxx, maxy) bbox, in the layer crs, with the packed R-tree.
+        """
+        with fiona.open(self.path) as src:
+            crs = src.crs
+            features = [to_feature(f) for f in src.filter(bbox=bbox)]
+        return features, crs
+
+    def get_all(self):
+        """
+        Read all features, in source FID order.
+        """
+        with fiona.open(self.path) as src:
+            crs = src.crs
+            features = [to_feature(f) for f in src]
+        features.sort(key=lambda f: int(f["id"]))
+        return features, crs
+
+
+def get_store(layer: str, source_path: str = None):
+    """
+    Returns the geometry store reader of a layer, None if the layer has not been built or is out of date.
+    """
+    lookup = get_lookup(layer, source_path=source_path)
+    if lookup is None:
+        return None
+    return GeometryStore(layer, lookup)
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from pathlib import Path
+import threading
+import logging
+import uuid
+import time
+import os
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(Path(os.path.abspath(__file__)).parent.parent, "static", "image_cache"))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+_index = None           # cache file name -> size in bytes, least recently used first
+_index_bytes = 0
+_lock = threading.Lock()
+
+
+def get_cache_name(kind: str, objectid, year: int, day: int, daily: bool = True, variant: str = None,
+                   end_year: int = None, end_day: int = None, ext: str = "png"):
+    """
+    Returns the cache file name for a rendered image. The name records the date, or date range, of the imagery used
+    so the entry can be invalidated when one of those dates is re-aggregated.
+    :param kind: Type of rendered image, such as 'image' or 'report'.
+    :param objectid: Waterbody objectid, or another identifier of the image area.
+    :param year: Year of the imagery.
+    :param day: Day of the year of the imagery.
+    :param daily: Daily or weekly imagery.
+    :param variant: Rendering options, such as the color thresholds, defaults to 'default'.
+    :param end_year: End year for images rendered from a range of dates.
+    :param end_day: End day of the year for images rendered from a range of dates.
+    :param ext: File extension.
+    """
+    start = int(year) * 1000 + int(day)
+    end = int(end_year) * 1000 + int(end_day) if end_year and end_day else start
+    variant = variant if variant else "default"
+    return f"{kind}_{objectid}_{'daily' if daily else 'weekly'}_{start}_{end}_{variant}.{ext}"
+
+
+def _load_index():
+    global _index, _index_bytes
+    if _index is not None:
+        return _index
+    os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+    entries = []
+    for f in os.scandir(IMAGE_CACHE_DIR):
+        if f.is_file() and not f.name.endswith(".tmp"):
+            stat = f.stat()
+            entries.append((stat.st_atime, f.name, stat.st_size))
+    _index = OrderedDict((name, size) for _, name, size in sorted(entries))
+    _index_bytes = sum(_index.values())
+    return _index
+
+
+def get_cached_image(name: str):
+    """
+    Returns the path of a cached image, or None if the image is not in the cache.
+    """
+    global _index_bytes
+    path = os.path.join(IMAGE_CACHE_DIR, name)
+    with _lock:
+        index = _load_index()
+        if not os.path.exists(path):
+            # not cached, or removed by another process such as an invalidation during aggregation
+            if name in index:
+                _remove(name)
+            return None
+        if name not in index:
+            # cached by another process
+            index[name] = os.path.getsize(path)
+            _index_bytes += index[name]
+        index.move_to_end(name)
+    # update the access time only, the modification time is used for the etag
+    os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+    return path
+
+
+def put_cached_image(name: str, image):
+    """
+    Add an image to the cache, evicting the least recently used images when over IMAGE_CACHE_MAX_BYTES.
+    :param name: Cache file name from get_cache_name.
+    :param image: Image bytes or a file-like object, such as a BytesIO.
+    :return: Path to the cached image.
+    """
+    global _index_bytes
+    data = image if isinstance(image, bytes) else image.read()
+    path = os.path.join(IMAGE_CACHE_DIR, name)
+    with _lock:
+        index = _load_index()
+        tmp_path = os.path.join(IMAGE_CACHE_DIR, f"{uuid.uuid4()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if name in index:
+            _index_bytes -= index[name]
+        index[name] = len(data)
+        index.move_to_end(name)
+        _index_bytes += len(data)
+        while _index_bytes > IMAGE_CACHE_MAX_BYTES and len(index) > 1:
+            oldest = next(iter(index))
+            _remove(oldest)
+    return path
+
+
+def invalidate_cached_images(year: int, day: int, daily: bool = True):
+    """
+    Remove all cached images which were rendered from imagery of the specified date. The cache directory is scanned,
+    rather than the in-process index, as images may have been cached by other processes.
+    :return: Number of images removed.
+    """
+    date = int(year) * 1000 + int(day)
+    period = 'daily' if daily else 'weekly'
+    removed = 0
+    with _lock:
+        _load_index()
+        for name in os.listdir(IMAGE_CACHE_DIR):
+            parts = name.split(".")[0].split("_")
+            if len(parts) < 6 or parts[2] != period:
+                continue
+            if int(parts[3]) <= date <= int(parts[4]):
+                _remove(name)
+                removed += 1
+    if removed > 0:
+        logger.info(f"Invalidated {removed} cached images for {period} year: {year}, day: {day}")
+    return removed
+
+
+def _remove(name: str):
+    global _index_bytes
+    _index_bytes -= _index.pop(name, 0)
+    path = os.path.join(IMAGE_CACHE_DIR, name)
+    if os.path.exists(path):
+        os.remove(path)
+
@@ -0,0 +1,146 @@
+import numpy as np
+import geopandas as gpd
+from rasterio import features
+from affine import Affine
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import sqlite3
+import logging
+import time
+import os
+
+from flaskr.geometry import WATERBODY_DBF
+from flaskr.db import DB_FILE
+from flaskr.render import rgba
+from flaskr.tiles import generate_tiles
+from flaskr.utils import DEFAULT_RANGE
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+LAKE_INDEX_DIR = os.getenv("LAKE_INDEX_DIR", os.path.join("static", "lake_index"))
+LAKE_INDEX_RESOLUTION = int(os.getenv("LAKE_INDEX_RESOLUTION", 1000))      # meters per pixel in EPSG:3857
+PLOT_DIR = os.path.join("static", "raster_plots")
+PRODUCT = "categories"
+
+# Category colors, 0 is outside of all waterbodies, matching the report category colors
+category_rgba = np.array([
+    (0, 0, 0, 0),
+    (51, 136, 255, 255),        # no detection
+    rgba['low'],
+    rgba['medium'],
+    rgba['high'],
+    rgba['vhigh']
+], dtype=np.uint8)
+
+_lake_index = None
+
+
+def get_lake_index_path():
+    return os.path.join(LAKE_INDEX_DIR, "lake_index.npz")
+
+
+def build_lake_index(resolution: int = None):
+    """
+    Build the national lake index raster, in EPSG:3857, where each pixel holds the position + 1 of its waterbody in the
+    sorted objectid array, 0 outside of all waterbodies. Smaller waterbodies are burned last so they are not hidden by
+    larger waterbodies around them.
+    :param resolution: Pixel size in meters, defaults to LAKE_INDEX_RESOLUTION.
+    :return: Path to the lake index file.
+    """
+    global _lake_index
+    t0 = time.time()
+    if resolution is None:
+        resolution = LAKE_INDEX_RESOLUTION
+    waterbodies = gpd.read_file(WATERBODY_DBF).to_crs("EPSG:3857")
+    waterbodies = waterbodies[~waterbodies.geometry.is_empty & waterbodies.geometry.notna()]
+    objectids = np.sort(waterbodies["OBJECTID"].to_numpy(dtype=np.int64))
+    positions = np.searchsorted(objectids, waterbodies["OBJECTID"].to_numpy(dtype=np.int64)) + 1
+    order = np.argsort(-waterbodies["AREASQKM"].to_numpy(dtype=np.float64), kind="stable")
+
+    left, bottom, right, top = waterbodies.total_bounds
+    left = np.floor(left / resolution) * resolution
+    top = np.ceil(top / resolution) * resolution
+    width = int(np.ceil((right - left) / resolution))
+    height = int(np.ceil((top - bottom) / resolution))
+    transform = Affine(resolution, 0.0, left, 0.0, -resolution, top)
+    geometries = waterbodies.geometry.to_numpy()
+    lake_index = features.rasterize(
+        ((geometries[i], int(positions[i])) for i in order),
+        out_shape=(height, width), transform=transform, fill=0, all_touched=True, dtype=np.uint32
+    )
+    os.makedirs(LAKE_INDEX_DIR, exist_ok=True)
+    np.savez(get_lake_index_path(), index=lake_index, objectids=objectids, transform=np.array(tuple(transform)[:6]))
+    _lake_index = None
+    t1 = time.time()
+    logger.info(f"Built lake index, {len(objectids)} waterbodies, size: {lake_index.shape}, runtime: {round(t1 - t0, 3)} sec")
+    return get_lake_index_path()
+
+
+def get_lake_index():
+    """
+    Returns the lake index raster, the sorted objectid array and the raster affine transform, loaded once per process.
+    None if the lake index has not been built.
+    """
+    global _lake_index
+    if _lake_index is None:
+        if not os.path.exists(get_lake_index_path()):
+            return None
+        with np.load(get_lake_index_path()) as lake_data:
+            _lake_index = (lake_data["index"], lake_data["objectids"], Affine(*lake_data["transform"]))
+    return _lake_index
+
+
+def get_lake_categories(objectids, year: int, day: int, daily: bool = True):
+    """
+    Returns the category of each waterbody, from the max detected DN value of the date: 1 no detection, 2 low,
+    3 medium, 4 high and 5 very high. Position i + 1 holds the category of objectids[i], position 0 is outside of all
+    waterbodies.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cur = conn.cursor()
+    query = f"SELECT OBJECTID, MAX(value) FROM {'DailyData' if daily else 'WeeklyData'} WHERE year=? AND day=? " \
+            f"AND count>0 AND value>=1 AND value<254 GROUP BY OBJECTID"
+    cur.execute(query, (year, day,))
+    rows = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 2)
+    conn.close()
+    categories = np.ones(len(objectids) + 1, dtype=np.uint8)
+    categories[0] = 0
+    positions = np.searchsorted(objectids, rows[:, 0])
+    known = positions < len(objectids)
+    known[known] = objectids[positions[known]] == rows[known, 0]
+    thresholds = [DEFAULT_RANGE[1][0], DEFAULT_RANGE[2][0], DEFAULT_RANGE[2][1]]
+    categories[positions[known] + 1] = np.digitize(rows[known, 1], thresholds) + 2
+    return categories
+
+
+def get_category_file(year: int, day: int, daily: bool = True):
+    return os.path.join(PLOT_DIR, f"{PRODUCT}-{'daily' if daily else 'weekly'}-conus-{year}-{day}.png")
+
+
+def generate_category_image(year: int, day: int, daily: bool = True, tiles: bool = True):
+    """
+    Render the national waterbody category image for a date from the lake index raster, with a single lookup of the
+    per-waterbody colors, and the category tile pyramid for daily data.
+    :return: Path to the png, None if the lake index has not been built.
+    """
+    t0 = time.time()
+    lake_index = get_lake_index()
+    if lake_index is None:
+        logger.warning("Lake index has not been built, run main.py --build_lake_index")
+        return None
+    index, objectids, transform = lake_index
+    lake_colors = category_rgba[get_lake_categories(objectids, year=year, day=day, daily=daily)]
+    png_metadata = PngInfo()
+    png_metadata.add_text("Transform", str(tuple(transform)[:6]))
+    png_metadata.add_text("Daily", str(daily))
+    png_metadata.add_text("Year", str(year))
+    png_metadata.add_text("Day", str(day))
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    category_file = get_category_file(year=year, day=day, daily=daily)
+    Image.fromarray(lake_colors[index], mode='RGBA').save(category_file, 'PNG', pnginfo=png_metadata)
+    if tiles and daily:
+        generate_tiles(index, transform, lake_colors, year=year, day=day, product=PRODUCT)
+    t1 = time.time()
+    logger.info(f"Generated waterbody category image, year: {year}, day: {day}, runtime: {round(t1 - t0, 3)} sec")
+    return category_file
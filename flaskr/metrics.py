@@ -1,8 +1,8 @@
 from datetime import datetime, timedelta
 import pandas as pd
 from flaskr.utils import convert_dn
-from flaskr.geometry import get_waterbody_fids, get_waterbody_by_fids
 from flaskr.db import get_waterbody_data
+from flaskr.registry import get_registry
 import time
 
 
@@ -148,15 +148,18 @@ def calculate_magnitude(data: pd.DataFrame, detect_columns: list, all_columns: l
     for k, v in magnitude_wb.items():
         wb_magnitude_update[int(k)] = round(v, 4)
 
-    waterbody_fids = get_waterbody_fids(return_dict=True)
+    registry = get_registry()
 
     # Area-normalized magnitude = bloom magnitude / lake surface area (km2)
     area_normalized_magnitude = {}
     objectids = [int(oid) for oid in list(data.OBJECTID.unique())]
 
     for comid in objectids:
-        wb_data = get_waterbody_by_fids(waterbody_fids[comid])
-        area_normalized_magnitude[int(comid)] = round(magnitude_wb[str(comid)] / wb_data[0][0]['properties']['AREASQKM'], 4)
+        i = registry.get_position(comid)
+        if i is None:
+            continue
+        area = float(registry.areas[i])
+        area_normalized_magnitude[int(comid)] = round(magnitude_wb[str(comid)] / area, 4)
 
     chia_area_normalized_bloom = {}
     for k, v in area_normalized_magnitude.items():
@@ -0,0 +1,50 @@
+import numpy as np
+from pyproj import Transformer
+from rasterio.windows import Window
+import datetime
+import logging
+
+from flaskr.db import get_tiles_bypoint
+from flaskr.raster import get_tile_grid, get_tile_timeseries
+from flaskr.utils import convert_dn
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+
+def get_pixel_timeseries(lat: float, lng: float, start_year: int, start_day: int, end_year: int, end_day: int,
+                         daily: bool = True):
+    """
+    Returns the DN and cell concentration of the pixel at a point for every available date in a date range. The tile
+    and pixel are located once from the cached tile grid and the single pixel window is read for all dates.
+    :param lat: Latitude of the point, EPSG:4326.
+    :param lng: Longitude of the point, EPSG:4326.
+    :return: Dictionary of the tile, pixel row/col and the data by date, None if the point is not in a tile with images
+    in the date range.
+    """
+    for tile in get_tiles_bypoint(lat=lat, lng=lng):
+        grid = get_tile_grid(tile, start_year, start_day, end_year, end_day, daily=daily)
+        if grid is None:
+            continue
+        transform, crs, (height, width) = grid
+        x, y = Transformer.from_crs("EPSG:4326", crs, always_xy=True).transform(lng, lat)
+        col, row = ~transform * (x, y)
+        row, col = int(np.floor(row)), int(np.floor(col))
+        if not (0 <= row < height and 0 <= col < width):
+            continue
+        dates, data, _, _ = get_tile_timeseries(tile, start_year, start_day, end_year, end_day,
+                                                window=Window(col, row, 1, 1), daily=daily)
+        results = {}
+        if data is not None and len(dates) > 0:
+            dn = [int(v) for v in data[:, 0, 0]]
+            cell_concentration = convert_dn(dn)
+            for (year, day), d, cc in zip(dates, dn, cell_concentration):
+                date = datetime.date(year, 1, 1) + datetime.timedelta(days=day - 1)
+                # 0 is below detection, 254 is land and 255 is no data
+                results[f"{year} {day}"] = {
+                    "date": date.isoformat(),
+                    "dn": d,
+                    "cell_concentration": 0 if d == 0 else (None if d >= 254 else float(cc))
+                }
+        return {"tile": tile, "row": row, "col": col, "data": results}
+    return None
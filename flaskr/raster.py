@@ -3,32 +3,42 @@ import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 from pathlib import Path
-from rasterio import mask, warp, crs, MemoryFile, features, plot
+from rasterio import mask, warp, crs, features, plot
 from rasterio.warp import calculate_default_transform
 from rasterio.merge import merge
-from rasterio.enums import Resampling
-from rasterio.profiles import DefaultGTiffProfile
+from rasterio.coords import BoundingBox
 
 from osgeo import gdal
 import uuid
 from matplotlib import pyplot
 import matplotlib.pyplot as plt
 # from osgeo import gdal, osr
-from pyproj import Proj, CRS
+from pyproj import Proj, CRS, Transformer
 from pyproj import transform as pyt
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from affine import Affine
+from shapely.geometry import shape
 import numpy as np
-import types
-import copy
+import hashlib
 import rasterio
 import geopandas as gpd
 import os
 import datetime
 
+from flaskr.datacube import read_window
+from flaskr.storage import get_storage, open_image, resolve_image
+
 gdal.UseExceptions()
 
 
-IMAGE_DIR = os.getenv('IMAGE_DIR', "D:\\data\cyan_rare\\mounts\\images")
 DST_CRS = 'EPSG:4326'
+REPROJECT_DIR = os.getenv('REPROJECT_DIR', os.path.join("static", "reproject"))
+REPROJECT_CACHE_SIZE = 64       # Number of reprojection index maps held in memory
+TIMESERIES_THREADS = int(os.getenv('TIMESERIES_THREADS', 8))      # Threads for reading time-series images
+
+_reproject_indices = OrderedDict()
+_tile_grids = {}
 
 CONUS_TILES = ['1_1', '1_2', '1_3', '1_4', '2_1', '2_2', '2_3', '2_4', '3_1', '3_2', '3_3',
                '3_4', '3_5', '4_1', '4_2', '4_3', '4_4', '4_5', '5_1', '5_2', '5_3', '5_4', '5_5',
@@ -36,14 +46,9 @@ CONUS_TILES = ['1_1', '1_2', '1_3', '1_4', '2_1', '2_2', '2_3', '2_4', '3_1', '3
                '8_3', '8_4']
 
 
-def get_images(year: int, day: int, daily: bool=True, filtered: bool = False):
+def get_image_base(year: int, day: int, daily: bool = True):
     """
-    Returns the list of images in the IMAGE_DIR for the specified year and day,
-    defaults to daily otherwise will look for weekly images
-    :param year: Year of the image to be processed
-    :param day: Day of the year of the image to be processed
-    :param daily: Defaults to True, will look for daily data with the corresponding year and day values.
-    :return: A list of paths to .tif images in the IMAGE_DIR directory.
+    Returns the base image name, without the tile suffix, for the specified year and day.
     """
     if daily:
         base_image_name = "L{}{}.L3m_DAY_CYAN_CI_cyano_CYAN_CONUS_300m".format(year, f'{day:03}')
@@ -51,42 +56,123 @@ def get_images(year: int, day: int, daily: bool=True, filtered: bool = False):
         date0 = datetime.date(year, 1, 1) + datetime.timedelta(days=day-1)
         date1 = date0 + datetime.timedelta(days=6)
         base_image_name = "L{}{}{}{}.L3m_7D_CYAN_CI_cyano_CYAN_CONUS_300m".format(date0.year, f'{date0.timetuple().tm_yday:03}', date1.year, f'{date1.timetuple().tm_yday:03}')
+    return base_image_name
 
+
+def get_images(year: int, day: int, daily: bool=True, filtered: bool = False):
+    """
+    Returns the list of images in the image storage for the specified year and day,
+    defaults to daily otherwise will look for weekly images
+    :param year: Year of the image to be processed
+    :param day: Day of the year of the image to be processed
+    :param daily: Defaults to True, will look for daily data with the corresponding year and day values.
+    :return: A list of paths to .tif images in the image storage.
+    """
+    base_image_name = get_image_base(year=year, day=day, daily=daily)
+
+    storage = get_storage()
     if filtered:
-        image_files = [str(os.path.join(IMAGE_DIR, f)) for f in os.listdir(IMAGE_DIR) if
+        image_files = [storage.get_path(f) for f in storage.list_images() if
                        (".tif" in f and base_image_name in f and any(tile in f for tile in CONUS_TILES))]
     else:
-        image_files = [str(os.path.join(IMAGE_DIR, f)) for f in os.listdir(IMAGE_DIR) if
+        image_files = [storage.get_path(f) for f in storage.list_images() if
                        (".tif" in f and base_image_name in f)]
     return image_files
 
 
 def get_images_by_tile(tile: list, n_limit: int = 90):
     """
-    Returns the list of images in the IMAGE_DIR for the specified tile going back n_limit days from current date.
+    Returns the list of images in the image storage for the specified tile going back n_limit days from current date.
     :param tile: Tiles of the images to collect, example [1_2, 1_3]
     :param n_limit: The number of days from the current date to get available images for.
-    :return: A list of paths to .tif images in the IMAGE_DIR directory.
+    :return: A list of paths to .tif images in the image storage.
     """
     n_date = datetime.datetime.utcnow() + datetime.timedelta(days=(-1 * n_limit) - 1)
     image_files = []
-    for f in os.listdir(IMAGE_DIR):
+    storage = get_storage()
+    for f in storage.list_images():
         if any(t in f for t in tile) and ".tif" in f and "DAY" in f:
             i_year = f[1:5]
             i_yday = f[5:9]
             date0 = datetime.date(int(i_year), 1, 1) + datetime.timedelta(days=int(i_yday)-1)
             if date0 >= n_date:
-                image_files.append(str(os.path.join(IMAGE_DIR, f)))
+                image_files.append(storage.get_path(f))
     return image_files
 
 
+def get_image_path(tile: str, year: int, day: int, daily: bool = True):
+    """
+    Returns the path of the image of a tile for the specified year and day, the image may not exist.
+    """
+    return get_storage().get_path(f"{get_image_base(year=year, day=day, daily=daily)}_{tile}.tif")
+
+
+def get_tile_grid(tile: str, start_year: int, start_day: int, end_year: int, end_day: int, daily: bool = True):
+    """
+    Returns the grid of a tile, its affine transform, crs and (height, width), from the first image of the tile in the
+    date range. The tile grids do not change between dates so each tile grid is cached once found.
+    :return: The tile grid, None if there are no images of the tile in the date range.
+    """
+    if tile in _tile_grids:
+        return _tile_grids[tile]
+    current_date = datetime.date(start_year, 1, 1) + datetime.timedelta(days=start_day - 1)
+    end_date = datetime.date(end_year, 1, 1) + datetime.timedelta(days=end_day - 1)
+    while current_date <= end_date:
+        image_path = get_image_path(tile, year=current_date.year, day=current_date.timetuple().tm_yday, daily=daily)
+        if get_storage().exists(image_path):
+            with open_image(image_path) as src:
+                _tile_grids[tile] = (src.transform, src.crs, (src.height, src.width))
+            return _tile_grids[tile]
+        current_date += datetime.timedelta(days=1)
+    return None
+
+
+def get_tile_timeseries(tile: str, start_year: int, start_day: int, end_year: int, end_day: int, window=None,
+                        daily: bool = True):
+    """
+    Returns a window of a tile for every available date in a date range. Read from the tile datacube when the datacube
+    store is enabled, otherwise the GeoTIFF of each date is read in a thread pool.
+    :param tile: Tile name, such as '1_2'.
+    :param window: rasterio Window of the tile to read, defaults to the full tile.
+    :return: List of (year, day) dates, a (dates, rows, cols) array, the window affine transform and the tile crs.
+    """
+    try:
+        cube_data = read_window(tile, start_year, start_day, end_year, end_day, window=window, daily=daily)
+    except OSError as e:
+        # the datacube may be locked while new images are appended
+        print(f"Unable to read datacube for tile: {tile}, error: {e}")
+        cube_data = None
+    if cube_data is not None:
+        return cube_data
+    dates = []
+    current_date = datetime.date(start_year, 1, 1) + datetime.timedelta(days=start_day - 1)
+    end_date = datetime.date(end_year, 1, 1) + datetime.timedelta(days=end_day - 1)
+    while current_date <= end_date:
+        image_path = get_image_path(tile, year=current_date.year, day=current_date.timetuple().tm_yday, daily=daily)
+        if get_storage().exists(image_path):
+            dates.append((current_date.year, current_date.timetuple().tm_yday, image_path))
+        current_date += datetime.timedelta(days=1)
+    if len(dates) == 0:
+        return [], None, None, None
+
+    def read_image(image_path):
+        with open_image(image_path) as src:
+            image_transform = src.window_transform(window) if window is not None else src.transform
+            return src.read(1, window=window), image_transform, src.crs
+
+    with ThreadPool(min(TIMESERIES_THREADS, len(dates))) as pool:
+        results = pool.map(read_image, [d[2] for d in dates])
+    data = np.stack([r[0] for r in results])
+    return [(d[0], d[1]) for d in dates], data, results[0][1], results[0][2]
+
+
 def clip_raster(raster, boundary, boundary_layer=None, boundary_crs=None, verbose: bool = False,
                 raster_crs: dict = None, histogram: bool = True, get_bounds: bool = True, reproject: bool = True):
     """Clip the raster to the given boundary.
 
     Parameters
     ----------
-    raster : string, pathlib.Path or rasterio.io.DataSetReader
+    raster : string, pathlib.Path, rasterio.io.DataSetReader or InMemoryRaster
         Location of or already opened raster.
     boundary : string, pathlib.Path or geopandas.GeoDataFrame
         The polygon by which to clip the raster.
@@ -113,19 +199,11 @@ def clip_raster(raster, boundary, boundary_layer=None, boundary_crs=None, verbos
     if isinstance(raster, Path):
         raster = str(raster)
     if isinstance(raster, str):
-        raster = rasterio.open(raster)
+        raster = open_image(raster)
     if isinstance(boundary, dict):
         boundary = gpd.GeoDataFrame(boundary).set_geometry('geometry')
 
-    if isinstance(raster, types.GeneratorType):
-        crs_0 = DST_CRS
-        boundary = boundary.to_crs(crs=DST_CRS)
-
-        if isinstance(boundary, gpd.GeoDataFrame):
-            boundary_list = [feature["geometry"] for i, feature in boundary.iterrows()]
-            # boundary = boundary.to_json()
-            boundary = boundary_list
-    elif not (boundary_crs == raster.crs or boundary_crs == raster.crs.data):
+    if not (boundary_crs == raster.crs or boundary_crs == raster.crs.data):
         crs_0 = raster.crs
         boundary = boundary.to_crs(crs=raster.crs)
 
@@ -135,23 +213,17 @@ def clip_raster(raster, boundary, boundary_layer=None, boundary_crs=None, verbos
     # mask/clip the raster using rasterio.mask
     clipped, affine = None, None
     try:
-        if isinstance(raster, types.GeneratorType):
-            for r in raster:
-                bounds = r.bounds
-                height = r.height
-                width = r.width
-                clipped, affine = mask.mask(dataset=r, shapes=boundary, crop=True,)
-                if histogram:
-                    clipped = rasterize_boundary(clipped, boundary=boundary, affine=affine, crs=r.crs)
+        bounds = raster.bounds
+        height = raster.height
+        width = raster.width
+        if isinstance(raster, InMemoryRaster):
+            clipped, affine = raster.mask(boundary)
         else:
-            bounds = raster.bounds
-            height = raster.height
-            width = raster.width
             clipped, affine = mask.mask(dataset=raster, shapes=boundary, crop=True,)
-            if not reproject:
-                raster_crs = raster.crs
-            if histogram:
-                clipped = rasterize_boundary(clipped, boundary=boundary, affine=affine, crs=raster.crs)
+        if not reproject:
+            raster_crs = raster.crs
+        if histogram:
+            clipped = rasterize_boundary(clipped, boundary=boundary, affine=affine, crs=raster.crs)
     except Exception as e:
         if verbose:
             print("ERROR: {}".format(e))
@@ -162,33 +234,12 @@ def clip_raster(raster, boundary, boundary_layer=None, boundary_crs=None, verbos
 
     bbox = None
     if raster_crs and reproject:
-        source_raster = copy.copy(clipped)
         crs = rasterio.crs.CRS.from_dict(raster_crs)
-        # src_crs = rasterio.crs.CRS(init=crs_0)
-        # output = None
-        # transform, width, height = warp.calculate_default_transform(
-        #     crs_0, crs, width, height, *bounds)
-
-        reproject_raster, reproject_affine = warp.reproject(
-            source_raster,
-            # destination=output,
-            src_transform=affine,
-            src_crs=crs_0,
-            # dst_transform=transform,
-            dst_crs=crs,
-            resampling=Resampling.nearest
-        )
-        clipped = reproject_raster[0]
-        affine = reproject_affine
+        if crs_0 is None:
+            crs_0 = raster.crs
+        clipped, affine = reproject_nearest(clipped, src_crs=crs_0, src_transform=affine, dst_crs=crs)
         if get_bounds:
-            bounds = rasterio.transform.array_bounds(
-                height=reproject_raster.shape[0],
-                width=reproject_raster.shape[1],
-                transform=reproject_affine
-            )
-            proj0 = Proj(crs)
-            proj1 = Proj('epsg:4326')
-            bbox = [pyt(proj0, proj1, bounds[2], bounds[1]), pyt(proj0, proj1, bounds[0], bounds[3])]
+            bbox = get_bbox(clipped.shape, affine, crs)
 
     # plot.show(clipped, transform=affine)
     # plt.show()
@@ -196,9 +247,19 @@ def clip_raster(raster, boundary, boundary_layer=None, boundary_crs=None, verbos
     return clipped, affine, raster_crs, bbox, boundary
 
 
+def get_bbox(shape, affine, crs):
+    """
+    Returns the [(lat, lng) upper right, (lat, lng) lower left] bounding box of a 2d array in EPSG:4326.
+    """
+    bounds = rasterio.transform.array_bounds(height=shape[0], width=shape[1], transform=affine)
+    proj0 = Proj(crs)
+    proj1 = Proj('epsg:4326')
+    return [pyt(proj0, proj1, bounds[2], bounds[1]), pyt(proj0, proj1, bounds[0], bounds[3])]
+
+
 def get_raster_bounds(image_path):
     dst_crs = 'EPSG:4326'
-    raster = rasterio.open(image_path)
+    raster = open_image(image_path)
     bounds = warp.transform_bounds(src_crs=raster.crs, dst_crs=dst_crs, left=raster.bounds.left,
                                    bottom=raster.bounds.bottom, right=raster.bounds.right, top=raster.bounds.top)
     return bounds
@@ -206,96 +267,247 @@ def get_raster_bounds(image_path):
 
 def get_raster(image_path):
     dst_crs = 'EPSG:4326'
-    raster = rasterio.open(image_path)
+    raster = open_image(image_path)
     src_crs = raster.crs
     raster_data = raster.read(1)
 
-    data, out_trans = warp.reproject(
-        source=raster_data,
-        src_crs=src_crs,
-        src_transform=raster.transform,
-        dst_crs=dst_crs,
-        resampling=Resampling.nearest
-    )
+    data, out_trans = reproject_nearest(raster_data, src_crs=src_crs, src_transform=raster.transform, dst_crs=dst_crs,
+                                        persist=True)
     # bounds = warp.transform_bounds(src_crs=raster.crs, dst_crs=dst_crs, left=raster.bounds.left,
     #                                bottom=raster.bounds.bottom, right=raster.bounds.right, top=raster.bounds.top)
     bounds = warp.transform_bounds(src_crs=raster.crs, dst_crs='EPSG:4326', left=raster.bounds.left,
                                    bottom=raster.bounds.bottom, right=raster.bounds.right, top=raster.bounds.top)
-    return data[0], bounds, dst_crs
+    return data, bounds, dst_crs
 
 
 def mosaic_rasters(images, dst_crs=None):
     if dst_crs is None:
         dst_crs = DST_CRS
-    src_crs = rasterio.open(images[0]).crs
+    src_crs = open_image(images[0]).crs
     mosaic, out_trans = merge(images)
-    mosaic, out_trans = warp.reproject(
-        source=mosaic,
-        src_crs=src_crs,
-        src_transform=out_trans,
-        dst_crs=dst_crs,
-        resampling=Resampling.nearest
-    )
-    mosaic_reader_gen = get_dataset_reader(mosaic, out_trans, crs=dst_crs)
-    return mosaic_reader_gen
+    mosaic, out_trans = reproject_nearest(mosaic, src_crs=src_crs, src_transform=out_trans, dst_crs=dst_crs, persist=True)
+    return InMemoryRaster(mosaic, out_trans, crs=dst_crs)
 
 
 def mosaic_raster_gdal(image_list, dst_crs=None):
+    """
+    Mosaic the tile images with an in-memory gdal vrt, in the source crs, and reproject the mosaic with the cached
+    reprojection index map for the mosaic grid.
+    :param image_list: List of tile image paths.
+    :param dst_crs: Destination crs, as a dict such as {"init": "EPSG:3857"}
+    :return: The mosaic InMemoryRaster.
+    """
     if dst_crs is None:
-        dst_crs = DST_CRS
-    src_crs = rasterio.open(image_list[0]).crs
+        dst_crs = {"init": DST_CRS}
+    src_crs = open_image(image_list[0]).crs
     uid = str(uuid.uuid4())
-    mosaic_file = os.path.join("static", "temp", f"{uid}-temp.tif")
-    open(mosaic_file, 'w').close()
-    g = gdal.Warp(mosaic_file, image_list, format="GTiff", dstSRS=dst_crs['init'])
-    # g = gdal.Warp(mosaic_file, image_list, format="GTiff", dstSRS=dst_crs['init'], options=["COMPRESS=LZW", "TILED=YES"])
-    with rasterio.open(mosaic_file) as src:
-        src_crs = src.crs
-        transform, width, height = calculate_default_transform(
-            src_crs, dst_crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
-        kwargs.update({
-            'crs': dst_crs,
-            'transform': transform,
-            'width': width,
-            'height': height
-        })
-        mosaic, out_trans = warp.reproject(
-            source=rasterio.band(src, 1),
-            src_crs=src_crs,
-            dst_crs=dst_crs["init"],
-            src_transform=src.transform,
-            resampling=Resampling.nearest
-        )
-    mosaic_reader_gen = get_dataset_reader(mosaic, transform, crs=dst_crs)
-    g = None
-    return mosaic_reader_gen, mosaic_file
-
-
-def rasterize_boundary(image, boundary, affine, crs, value: int=256):
+    vrt = gdal.BuildVRT(f"/vsimem/{uid}.vrt", [resolve_image(image) for image in image_list])
+    source = vrt.GetRasterBand(1).ReadAsArray()
+    src_transform = Affine.from_gdal(*vrt.GetGeoTransform())
+    vrt = None
+    gdal.Unlink(f"/vsimem/{uid}.vrt")
+    mosaic, transform = reproject_nearest(source, src_crs=src_crs, src_transform=src_transform, dst_crs=dst_crs,
+                                          persist=True)
+    return InMemoryRaster(mosaic, transform, crs=dst_crs)
+
+
+def get_reproject_index(src_crs, src_transform, src_shape, dst_crs, persist: bool = False):
+    """
+    Returns the nearest neighbour source pixel index map for reprojecting a raster grid to dst_crs. The CyAN tiles,
+    and the windows clipped from them for a waterbody, are on the same grid every day so the index map is computed
+    once per grid, with the most recent maps held in memory. The maps of the fixed tile and mosaic grids are also
+    stored in REPROJECT_DIR, the per waterbody windows are only held in memory so the directory stays bounded.
+    :param src_crs: Source crs.
+    :param src_transform: Source affine transform.
+    :param src_shape: Source (height, width).
+    :param dst_crs: Destination crs.
+    :param persist: Store the map in REPROJECT_DIR, for tile and mosaic grids.
+    :return: The index map, flat int32 indices into the source array (-1 where there is no source pixel), and the
+    destination affine transform.
+    """
+    src_crs = get_crs(src_crs)
+    dst_crs = get_crs(dst_crs)
+    height, width = src_shape[-2], src_shape[-1]
+    key = hashlib.sha1(
+        f"{src_crs.to_wkt()}|{tuple(src_transform)[:6]}|{height}|{width}|{dst_crs.to_wkt()}".encode()
+    ).hexdigest()
+    if key in _reproject_indices:
+        _reproject_indices.move_to_end(key)
+        return _reproject_indices[key]
+    index_file = os.path.join(REPROJECT_DIR, f"{key}.npz")
+    if persist and os.path.exists(index_file):
+        with np.load(index_file) as index_data:
+            index = index_data["index"]
+            dst_transform = Affine(*index_data["transform"])
+    else:
+        left, bottom, right, top = rasterio.transform.array_bounds(height, width, src_transform)
+        dst_transform, dst_width, dst_height = calculate_default_transform(
+            src_crs, dst_crs, width, height, left=left, bottom=bottom, right=right, top=top)
+        transformer = Transformer.from_crs(dst_crs, src_crs, always_xy=True)
+        inverse = ~src_transform
+        index = np.full((dst_height, dst_width), -1, dtype=np.int32)
+        cols = np.arange(dst_width) + 0.5
+        # transform pixel centers in row blocks to bound memory use on the CONUS grid
+        for r0 in range(0, dst_height, 512):
+            rows = np.arange(r0, min(r0 + 512, dst_height)) + 0.5
+            dst_cols, dst_rows = np.meshgrid(cols, rows)
+            x, y = dst_transform * (dst_cols, dst_rows)
+            src_x, src_y = transformer.transform(x, y)
+            src_cols, src_rows = inverse * (src_x, src_y)
+            src_cols = np.floor(src_cols)
+            src_rows = np.floor(src_rows)
+            valid = (src_cols >= 0) & (src_cols < width) & (src_rows >= 0) & (src_rows < height)
+            index[r0:r0 + rows.size][valid] = (src_rows[valid] * width + src_cols[valid]).astype(np.int32)
+        if persist:
+            os.makedirs(REPROJECT_DIR, exist_ok=True)
+            np.savez_compressed(index_file, index=index, transform=np.array(tuple(dst_transform)[:6]))
+    _reproject_indices[key] = (index, dst_transform)
+    if len(_reproject_indices) > REPROJECT_CACHE_SIZE:
+        _reproject_indices.popitem(last=False)
+    return index, dst_transform
+
+
+def reproject_nearest(source, src_crs, src_transform, dst_crs, nodata: int = 0, persist: bool = False):
+    """
+    Nearest neighbour reprojection of a 2d (rows, cols) or 3d (bands, rows, cols) array as a single gather through the
+    cached reprojection index map.
+    :param persist: Store the index map in REPROJECT_DIR, for the fixed tile and mosaic grids.
+    :return: The reprojected array, same number of dimensions as source, and the destination affine transform.
+    """
+    index, dst_transform = get_reproject_index(src_crs, src_transform, source.shape, dst_crs, persist=persist)
+    missing = index < 0
+    flat_source = np.reshape(source, source.shape[:-2] + (-1,))
+    reprojected = np.take(flat_source, np.where(missing, 0, index), axis=-1)
+    reprojected[..., missing] = nodata
+    return reprojected, dst_transform
+
+
+def align_to_grid(data, transform, dst_transform, dst_shape, nodata: int = 0):
+    """
+    Nearest neighbour resample of a 2d array onto another grid in the same crs, as a single row/column gather.
+    :param data: 2d array.
+    :param transform: Affine transform of data.
+    :param dst_transform: Affine transform of the destination grid.
+    :param dst_shape: (height, width) of the destination grid.
+    :param nodata: Value of destination pixels outside of data.
+    :return: The aligned 2d array.
+    """
+    if tuple(transform)[:6] == tuple(dst_transform)[:6] and data.shape == tuple(dst_shape):
+        return data
+    height, width = dst_shape
+    xs = dst_transform.c + (np.arange(width) + 0.5) * dst_transform.a
+    ys = dst_transform.f + (np.arange(height) + 0.5) * dst_transform.e
+    cols = np.floor((xs - transform.c) / transform.a).astype(np.int64)
+    rows = np.floor((ys - transform.f) / transform.e).astype(np.int64)
+    valid = np.outer((rows >= 0) & (rows < data.shape[0]), (cols >= 0) & (cols < data.shape[1]))
+    aligned = data[np.ix_(np.clip(rows, 0, data.shape[0] - 1), np.clip(cols, 0, data.shape[1] - 1))]
+    aligned[~valid] = nodata
+    return aligned
+
+
+def get_crs(crs):
+    if isinstance(crs, dict):
+        return rasterio.crs.CRS.from_dict(crs)
+    return rasterio.crs.CRS.from_user_input(crs)
+
+
+def rasterize_boundary(image, boundary, affine=None, crs=None, value: int=256):
+    if isinstance(image, InMemoryRaster):
+        affine = image.transform if affine is None else affine
+        crs = image.crs if crs is None else crs
+        image = image.data
     boundary = boundary.to_crs(crs)
-    image = image.astype(np.int16)
     rasterized = features.rasterize(boundary, fill=value, all_touched=True, out_shape=image[0].shape, transform=affine)
-    result = np.where(rasterized < value, image[0], value)
+    result = np.where(rasterized < value, image[0].astype(np.int16), value)
     combined = np.reshape(result, (1, result.shape[0], result.shape[1]))
     return combined
 
 
 def get_colormap(image):
-    raster = rasterio.open(image)
+    raster = open_image(image)
     return raster.colormap(1)
 
 
-def get_dataset_reader(data, transform, crs):
-    profile = DefaultGTiffProfile(count=1)
-    profile.update(transform=transform, height=data.shape[1], width=data.shape[2], crs=crs)
-    dataset_reader = None
-    with MemoryFile() as memfile:
-        with memfile.open(**profile) as dataset:
-            dataset.write(data)
-            del data
-        with memfile.open() as dataset:
-            # dataset_reader = dataset
-            yield dataset
-    # return dataset_reader
+class InMemoryRaster:
+    """
+    A raster held in memory, the array with its affine transform, crs and nodata value. Accepted by clip_raster and
+    rasterize_boundary in place of an opened dataset, without encoding the array to a GeoTIFF.
+    """
 
+    def __init__(self, data, transform, crs, nodata=None):
+        """
+        :param data: 2d (rows, cols) or 3d (bands, rows, cols) array, a 2d array is viewed as a single band.
+        :param transform: Affine transform of data.
+        :param crs: Crs of data, as accepted by get_crs.
+        :param nodata: Value of pixels without data, also used to fill masked pixels.
+        """
+        if data.ndim == 2:
+            data = data[np.newaxis]
+        self.data = data
+        self.transform = transform
+        self.crs = get_crs(crs)
+        self.nodata = nodata
+
+    @property
+    def count(self):
+        return self.data.shape[0]
+
+    @property
+    def height(self):
+        return self.data.shape[1]
+
+    @property
+    def width(self):
+        return self.data.shape[2]
+
+    @property
+    def bounds(self):
+        return BoundingBox(*rasterio.transform.array_bounds(self.height, self.width, self.transform))
+
+    def read(self, indexes=None, window=None):
+        """
+        Returns a view of the raster data, same arguments as the rasterio dataset read.
+        """
+        data = self.data
+        if window is not None:
+            (row0, row1), (col0, col1) = window.toranges()
+            data = data[:, max(int(row0), 0):int(row1), max(int(col0), 0):int(col1)]
+        if indexes is None:
+            return data
+        if isinstance(indexes, int):
+            return data[indexes - 1]
+        return data[[i - 1 for i in indexes]]
+
+    def mask(self, shapes, all_touched: bool = False):
+        """
+        Mask the raster to the shapes and crop it to their bounds, as rasterio.mask.mask with crop=True. The crop is a
+        view, only the masked result is copied.
+        :param shapes: Iterable of shapely geometries, or a GeoSeries/GeoDataFrame, in the raster crs.
+        :return: The masked (bands, rows, cols) array, pixels outside the shapes set to nodata (or 0), and its affine
+        transform.
+        """
+        if isinstance(shapes, gpd.GeoDataFrame):
+            shapes = shapes.geometry
+        if isinstance(shapes, gpd.GeoSeries):
+            left, bottom, right, top = shapes.total_bounds
+        else:
+            shapes = list(shapes)
+            bounds = np.array([shape(s).bounds if isinstance(s, dict) else s.bounds for s in shapes])
+            left, bottom = bounds[:, 0].min(), bounds[:, 1].min()
+            right, top = bounds[:, 2].max(), bounds[:, 3].max()
+        inverse = ~self.transform
+        col0, row0 = inverse * (left, top)
+        col1, row1 = inverse * (right, bottom)
+        row0, row1 = max(int(np.floor(min(row0, row1))), 0), min(int(np.ceil(max(row0, row1))), self.height)
+        col0, col1 = max(int(np.floor(min(col0, col1))), 0), min(int(np.ceil(max(col0, col1))), self.width)
+        if row1 <= row0 or col1 <= col0:
+            raise ValueError("Input shapes do not overlap raster.")
+        view = self.data[:, row0:row1, col0:col1]
+        transform = self.transform * Affine.translation(col0, row0)
+        outside = features.geometry_mask(shapes, out_shape=view.shape[1:], transform=transform,
+                                         all_touched=all_touched)
+        masked = np.where(outside, self.nodata if self.nodata is not None else 0, view).astype(view.dtype)
+        return masked, transform
+
+    def close(self):
+        pass
@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import threading
+import sqlite3
+import logging
+import time
+
+from flaskr.geometry import WATERBODY_DBF
+from flaskr.db import DB_FILE
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+_registry = None
+_lock = threading.Lock()
+
+
+def to_python(value):
+    """
+    Convert a numpy/pandas scalar to the python type fiona returns, nulls as None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+class WaterbodyRegistry:
+    """
+    Process wide table of the waterbody attributes, loaded once from the waterbody dbf and the database into columnar
+    arrays, with constant time lookup by OBJECTID.
+    """
+
+    def __init__(self, properties: pd.DataFrame, bounds: pd.DataFrame, elevations: pd.DataFrame):
+        # shapefile FIDs are the dbf row positions
+        self.properties = properties.reset_index(drop=True)
+        self.columns = list(self.properties.columns)
+        self.objectids = self.properties["OBJECTID"].to_numpy(dtype=np.int64)
+        self.fids = np.arange(len(self.properties), dtype=np.int64)
+        self.names = self.properties["GNIS_NAME"].fillna("").to_numpy(dtype=object)
+        self.states = self.properties["STATE_ABBR"].fillna("").to_numpy(dtype=object)
+        self.areas = self.properties["AREASQKM"].to_numpy(dtype=np.float64)
+        self.centroids = self.properties[["c_lat", "c_lng"]].to_numpy(dtype=np.float64)
+        self._positions = {int(objectid): i for i, objectid in enumerate(self.objectids)}
+
+        n = len(self.objectids)
+        self.bounds = np.full((n, 4), np.nan, dtype=np.float64)        # x_min, x_max, y_min, y_max
+        self.elevations = np.full(n, np.nan, dtype=np.float64)         # feet
+        positions = self.get_positions(bounds["OBJECTID"].to_numpy(dtype=np.int64))
+        found = positions >= 0
+        self.bounds[positions[found]] = bounds[["x_min", "x_max", "y_min", "y_max"]].to_numpy(dtype=np.float64)[found]
+        positions = self.get_positions(elevations["OBJECTID"].to_numpy(dtype=np.int64))
+        found = positions >= 0
+        self.elevations[positions[found]] = elevations["elevation"].to_numpy(dtype=np.float64)[found]
+
+    def __len__(self):
+        return len(self.objectids)
+
+    def __contains__(self, objectid):
+        return int(objectid) in self._positions
+
+    def get_position(self, objectid: int):
+        """
+        Returns the row of a waterbody in the registry arrays, None if the OBJECTID is not in the registry.
+        """
+        return self._positions.get(int(objectid))
+
+    def get_positions(self, objectids):
+        """
+        Returns the rows of an array of OBJECTIDs, -1 for OBJECTIDs not in the registry.
+        """
+        return np.array([self._positions.get(int(objectid), -1) for objectid in objectids], dtype=np.int64)
+
+    def get_fid(self, objectid: int):
+        i = self.get_position(objectid)
+        return None if i is None else int(self.fids[i])
+
+    def get_properties(self, objectid: int):
+        """
+        Returns the dbf properties of a waterbody, as returned by geometry.get_waterbody_properties.
+        """
+        i = self.get_position(objectid)
+        if i is None:
+            return {}
+        row = self.properties.iloc[i]
+        return {column: to_python(row[column]) for column in self.columns}
+
+    def get_summary(self, objectid: int):
+        """
+        Returns the name, objectid, centroid, area and state of a waterbody, as returned by geometry.get_waterbody_byID.
+        """
+        i = self.get_position(objectid)
+        if i is None:
+            return None
+        return {
+            "name": self.names[i],
+            "objectid": int(self.objectids[i]),
+            "centroid_lat": float(self.centroids[i][0]),
+            "centroid_lng": float(self.centroids[i][1]),
+            "areasqkm": float(self.areas[i]),
+            "state_abbr": self.states[i]
+        }
+
+    def get_bounds(self, objectid: int):
+        """
+        Returns the (x_min, x_max, y_min, y_max) bounds of a waterbody from the database, None if not set.
+        """
+        i = self.get_position(objectid)
+        if i is None or np.isnan(self.bounds[i]).any():
+            return None
+        return tuple(float(b) for b in self.bounds[i])
+
+    def get_elevation(self, objectid: int, meters: bool = False):
+        """
+        Returns the elevation of a waterbody in feet, or meters, None if the elevation has not been set.
+        """
+        i = self.get_position(objectid)
+        if i is None or np.isnan(self.elevations[i]):
+            return None
+        elevation = float(self.elevations[i])
+        if meters:
+            elevation = round(elevation/3.281, 3)
+        return elevation
+
+
+def load_registry():
+    """
+    Load the waterbody registry from the waterbody dbf attributes, without geometries, and the database tables.
+    """
+    t0 = time.time()
+    properties = gpd.read_file(WATERBODY_DBF, ignore_geometry=True)
+    conn = sqlite3.connect(DB_FILE)
+    bounds = pd.read_sql("SELECT OBJECTID, x_min, x_max, y_min, y_max FROM WaterbodyBounds", conn)
+    try:
+        elevations = pd.read_sql("SELECT OBJECTID, elevation FROM WaterbodyDetails", conn)
+    except Exception:
+        logger.warning("Waterbody database does not have the waterbody details table, elevations are not available")
+        elevations = pd.DataFrame({"OBJECTID": [], "elevation": []})
+    conn.close()
+    registry = WaterbodyRegistry(properties, bounds, elevations)
+    t1 = time.time()
+    logger.info(f"Loaded waterbody registry, {len(registry)} waterbodies, runtime: {round(t1 - t0, 3)} sec")
+    return registry
+
+
+def get_registry():
+    """
+    Returns the waterbody registry, loaded once per process.
+    """
+    global _registry
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                _registry = load_registry()
+    return _registry
+
+
+def reset_registry():
+    """
+    Drop the loaded registry, the next get_registry call reloads it. Called after the bounds or elevations are updated,
+    other processes load the updated tables when they restart.
+    """
+    global _registry
+    with _lock:
+        _registry = None
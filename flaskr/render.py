@@ -0,0 +1,121 @@
+import numpy as np
+from PIL import Image
+from io import BytesIO
+
+
+# Colormap colors
+rgba = {
+    'low': (0, 128, 0, 255),
+    'medium': (200, 200, 0, 255),
+    'high': (255, 165, 0, 255),
+    'vhigh': (255, 0, 0, 255)
+}
+
+OUTSIDE_VALUE = 256         # rasterize_boundary value for pixels outside of the waterbody boundary
+_luts = {}
+
+
+def get_lut(colormap: dict, thresholds: tuple = None, transparent: tuple = (0, 255)):
+    """
+    Returns the 257x4 uint8 RGBA lookup table for DN values 0-255, index 256 is used for pixels outside the waterbody
+    boundary and is always transparent. Tables are built once per colormap, threshold set and transparent values.
+    :param colormap: Dictionary of DN value to RGBA color, such as the colormap of the CyAN images.
+    :param thresholds: Optional (low, med, high) DN thresholds, when provided DN values 1-253 are colored by bin.
+    :param transparent: DN values rendered fully transparent.
+    :return: Read-only 257x4 uint8 numpy array.
+    """
+    key = (tuple(sorted(colormap.items())), thresholds, tuple(transparent))
+    lut = _luts.get(key)
+    if lut is not None:
+        return lut
+    lut = np.zeros((OUTSIDE_VALUE + 1, 4), dtype=np.uint8)
+    for value, color in colormap.items():
+        if 0 <= value < OUTSIDE_VALUE:
+            lut[value] = color
+    if thresholds:
+        low, med, high = [min(max(int(t), 1), 254) for t in thresholds]
+        lut[1:254] = rgba['vhigh']
+        lut[1:high] = rgba['high']
+        lut[1:med] = rgba['medium']
+        lut[1:low] = rgba['low']
+    for value in transparent:
+        lut[value] = (0, 0, 0, 0)
+    lut[OUTSIDE_VALUE] = (0, 0, 0, 0)
+    lut.flags.writeable = False
+    _luts[key] = lut
+    return lut
+
+
+def render_rgba(data, lut):
+    """
+    Map a 2d array of DN values to a (rows, cols, 4) uint8 RGBA array with a single lookup table gather.
+    """
+    if data.dtype != np.uint8:
+        data = np.clip(data, 0, lut.shape[0] - 1)
+    return lut[data]
+
+
+def render_png(data, lut, pnginfo=None):
+    """
+    Render a 2d array of DN values to an in-memory png.
+    :return: BytesIO of the png, positioned at the start.
+    """
+    png_img = Image.fromarray(render_rgba(data, lut), mode='RGBA')
+    png_file = BytesIO()
+    png_img.save(png_file, 'PNG', pnginfo=pnginfo)
+    png_file.seek(0)
+    return png_file
+
+
+# Diverging change colors, decrease to increase in CI between two dates
+diff_rgba = {
+    'decrease': (5, 113, 176, 255),
+    'none': (247, 247, 247, 255),
+    'increase': (202, 0, 32, 255),
+    'land': (159, 81, 44, 255)
+}
+_diff_tables = {}
+
+
+def get_diff_table(land: bool = True):
+    """
+    Returns the (257, 257, 4) uint8 RGBA table of the change between two DN values, indexed [dn_a, dn_b]. Valid values,
+    including 0 below detection, are colored by b - a on a diverging scale. Pixels which are land in either date are
+    colored as land, no data (255) or outside of the waterbody (256) in either date are transparent.
+    :param land: Color land pixels, otherwise land is transparent.
+    """
+    table = _diff_tables.get(land)
+    if table is not None:
+        return table
+    values = np.arange(OUTSIDE_VALUE + 1)
+    diff = values[np.newaxis, :] - values[:, np.newaxis]
+    scale = np.clip(np.abs(diff) / 253.0, 0, 1)[..., np.newaxis]
+    none = np.array(diff_rgba['none'], dtype=np.float64)
+    increase = none + (np.array(diff_rgba['increase']) - none) * scale
+    decrease = none + (np.array(diff_rgba['decrease']) - none) * scale
+    table = np.where((diff > 0)[..., np.newaxis], increase, decrease).round().astype(np.uint8)
+    table[254, :] = diff_rgba['land'] if land else (0, 0, 0, 0)
+    table[:, 254] = diff_rgba['land'] if land else (0, 0, 0, 0)
+    table[255:, :] = 0
+    table[:, 255:] = 0
+    table.flags.writeable = False
+    _diff_tables[land] = table
+    return table
+
+
+def render_diff_png(data_a, data_b, land: bool = True, pnginfo=None):
+    """
+    Render the change between two aligned 2d arrays of DN values, with OUTSIDE_VALUE for pixels outside the waterbody,
+    to an in-memory png with a single table gather.
+    :return: BytesIO of the png, positioned at the start.
+    """
+    table = get_diff_table(land=land)
+    if data_a.dtype != np.uint8:
+        data_a = np.clip(data_a, 0, OUTSIDE_VALUE)
+    if data_b.dtype != np.uint8:
+        data_b = np.clip(data_b, 0, OUTSIDE_VALUE)
+    png_img = Image.fromarray(table[data_a, data_b], mode='RGBA')
+    png_file = BytesIO()
+    png_img.save(png_file, 'PNG', pnginfo=pnginfo)
+    png_file.seek(0)
+    return png_file
@@ -3,18 +3,22 @@ from datetime import datetime, timedelta, date
 import calendar
 from xhtml2pdf import pisa
 from pathlib import Path
-from flaskr.geometry import get_waterbody_properties, get_waterbody, get_county_boundary, get_state_boundary, \
-    get_tribe_boundary, get_waterbody_objectids, get_waterbody_by_fids
+from flaskr.geometry import get_waterbody, get_waterbody_objectids, get_waterbody_by_fids, to_geometries
 from flaskr.aggregate import get_waterbody_raster
 from flaskr.db import get_conus_objectids, get_eparegion_objectids, get_state_objectids, get_tribe_objectids, \
     get_county_objectids, get_waterbody_data, get_group_metrics, get_county_state, get_county_geoid, \
-    get_all_state_counties, get_tribe_geoid, get_state_name, get_states_from_wb, get_all_states, get_waterbody_fid, \
-    set_wb_report_file, get_alpine_objectids, get_elevation
+    get_all_state_counties, get_tribe_geoid, get_state_name, get_states_from_wb, get_all_states, \
+    set_wb_report_file, get_alpine_objectids
 from flaskr.raster import rasterize_boundary
 from flaskr.utils import DEFAULT_RANGE, get_colormap, rgb, convert_dn
+from flaskr.render import get_lut, render_rgba
+from flaskr.image_cache import get_cache_name, get_cached_image, put_cached_image
 from flaskr.metrics import calculate_metrics
 from flaskr.report_tools import upload_report
+from flaskr.registry import get_registry
+from flaskr.boundaries import get_plot_boundary
 import rasterio.plot
+from io import BytesIO
 import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
@@ -23,7 +27,6 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import geopandas as gpd
 import multiprocessing as mp
-from shapely.geometry import Polygon, MultiPolygon
 import time
 import copy
 import uuid
@@ -381,7 +384,7 @@ def get_group_block(report_id: str, year: int, day: int, group_type: str, group_
         mapping_i.append(ra)
 
     group_state = get_county_state(county_id=int(group_id)) if group_type == "County" else None
-    fids = [get_waterbody_fid(int(oid)) for oid in objectids]
+    fids = [get_registry().get_fid(int(oid)) for oid in objectids]
     waterbodies_geos_raster = get_waterbody_collection_raster(groupname=group_name, grouptype=group_type,
                                                               group_id=group_id,
                                                               objectids=objectids, fids=fids,
@@ -448,8 +451,8 @@ def get_waterbody_block(year: int, day: int, objectid: int, report_id: str, rang
         j_env = get_env()
     objectid = int(objectid)
     report_root = os.path.join(STATIC_ROOT, "temp", str(report_id))
-    fid = get_waterbody_fid(objectid=objectid)
-    waterbody_properties = get_waterbody_properties(objectid=objectid, fid=fid)
+    registry = get_registry()
+    waterbody_properties = registry.get_properties(objectid)
     waterbody_name = waterbody_properties["GNIS_NAME"]
     waterbody_properties_cleaned = {}
     wb_area = 0
@@ -463,7 +466,7 @@ def get_waterbody_block(year: int, day: int, objectid: int, report_id: str, rang
             else:
                 waterbody_properties_cleaned[KEEP_PROPERTIES[name][0]] = "NA"
     waterbody_properties_cleaned[" "] = ""
-    waterbody_properties_cleaned["Elevation (m)"] = get_elevation(objectid=objectid, meters=True)
+    waterbody_properties_cleaned["Elevation (m)"] = registry.get_elevation(objectid, meters=True)
     waterbody_properties_cleaned["Bloom Extent"] = f"{extent} %"
     waterbody_properties_cleaned["Bloom Frequency"] = f"{frequency} %"
     waterbody_properties_cleaned["Bloom Magnitude"] = f"{magnitude} cell concentration"
@@ -536,10 +539,9 @@ def get_closing(j_env=None):
 
 def get_report_waterbody_raster(objectid: int, report_id: str, day: int, year: int):
     # report_root = os.path.join(STATIC_ROOT, "temp", str(report_id))
-    raster_root = os.path.join(STATIC_ROOT, "raster_plots")
-    image_file = f"{objectid}-{year}-{day}.png"
-    image_path = os.path.join(raster_root, image_file)
-    if os.path.exists(image_path):
+    cache_name = get_cache_name("report", objectid, year=year, day=day)
+    image_path = get_cached_image(cache_name)
+    if image_path is not None:
         return image_path
     image_data, colormap = get_waterbody_raster(objectid=int(objectid), year=year, day=day, get_bounds=False, reproject=True)
     data = image_data[0]
@@ -548,12 +550,7 @@ def get_report_waterbody_raster(objectid: int, report_id: str, day: int, year: i
     # colormap[0] = (149, 149, 149, 100)
     # colormap[254] = (159, 81, 44, 100)
     # colormap[255] = (0, 0, 0, 100)
-    colormap[256] = (0, 0, 0, 0)
-    mapped_image = [[None for i in range(data.shape[1])] for j in range(data.shape[0])]
-    for y in range(0, data.shape[1]):
-        for x in range(0, data.shape[0]):
-            mapped_image[x][y] = list(colormap[data[x][y]])
-    converted_data = np.array(mapped_image, dtype=np.uint8)
+    converted_data = render_rgba(data, get_lut(colormap, transparent=()))
     fig, ax = plt.subplots()
     fig.suptitle(f'Satellite Imagery for Waterbody', fontsize=12)
     raster_data = rasterio.plot.reshape_as_raster(converted_data)
@@ -562,9 +559,11 @@ def get_report_waterbody_raster(objectid: int, report_id: str, day: int, year: i
     boundary.plot(ax=ax, facecolor='none', edgecolor='#3388ff', linewidth=1.5)
     # plt.show()
     plt.axis('off')
-    plt.savefig(image_path)
+    image_file = BytesIO()
+    plt.savefig(image_file, format='png')
     plt.close(fig)
-    return image_path
+    image_file.seek(0)
+    return put_cached_image(cache_name, image_file)
 
 
 def get_waterbody_collection_raster(groupname: str, grouptype: str, group_id: str, objectids: list, fids: list,
@@ -589,63 +588,34 @@ def get_waterbody_collection_raster(groupname: str, grouptype: str, group_id: st
     ax2.set_xlabel(f"Previous Week Max Occurrence")
 
     if grouptype == "County":
-        county_geo, county_crs = get_county_boundary(geoid=str(group_id))
-        if county_geo["geometry"]["type"] == "MultiPolygon":
-            poly_geos = []
-            for p in county_geo["geometry"]["coordinates"]:
-                poly_geos.append(Polygon(p[0]))
-            county_poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=county_crs)
-        else:
-            county_poly = gpd.GeoSeries(Polygon(county_geo["geometry"]["coordinates"][0]), crs=county_crs)
+        county_poly = get_plot_boundary("counties", str(group_id))
         county_poly.plot(ax=ax1, edgecolor='#a8a79b', color='#a8a79b')
         county_poly.plot(ax=ax2, edgecolor='#a8a79b', color='#a8a79b')
     elif grouptype == "Tribe":
-        tribe_geo, tribe_crs = get_tribe_boundary(tribe=str(group_id))
-        if tribe_geo["geometry"]["type"] == "MultiPolygon":
-            poly_geos = []
-            for p in tribe_geo["geometry"]["coordinates"]:
-                poly_geos.append(Polygon(p[0]))
-            tribe_poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=tribe_crs)
-        else:
-            tribe_poly = gpd.GeoSeries(Polygon(tribe_geo["geometry"]["coordinates"][0]), crs=tribe_crs)
+        tribe_poly = get_plot_boundary("tribes", str(group_id))
         tribe_poly.plot(ax=ax1, edgecolor='#a8a79b', color='#a8a79b')
         tribe_poly.plot(ax=ax2, edgecolor='#a8a79b', color='#a8a79b')
     elif grouptype == "State":
-        state_geo, state_crs = get_state_boundary(state=str(group_id))
-        if state_geo["geometry"]["type"] == "MultiPolygon":
-            poly_geos = []
-            for p in state_geo["geometry"]["coordinates"]:
-                poly_geos.append(Polygon(p[0]))
-            state_poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=state_crs)
-        else:
-            state_poly = gpd.GeoSeries(Polygon(state_geo["geometry"]["coordinates"][0]), crs=state_crs)
+        state_poly = get_plot_boundary("states", str(group_id))
         state_poly.plot(ax=ax1, edgecolor='#a8a79b', color='#a8a79b')
         state_poly.plot(ax=ax2, edgecolor='#a8a79b', color='#a8a79b')
     else:
         states = get_states_from_wb(tuple(objectids))
         for state in states:
-            state_geo, state_crs = get_state_boundary(state=str(state))
-            if state_geo["geometry"]["type"] == "MultiPolygon":
-                poly_geos = []
-                for p in state_geo["geometry"]["coordinates"]:
-                    poly_geos.append(Polygon(p[0]))
-                state_poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=state_crs)
-            else:
-                state_poly = gpd.GeoSeries(Polygon(state_geo["geometry"]["coordinates"][0]), crs=state_crs)
+            state_poly = get_plot_boundary("states", str(state))
             state_poly.plot(ax=ax1, edgecolor='#a8a79b', color='#a8a79b')
             state_poly.plot(ax=ax2, edgecolor='#a8a79b', color='#a8a79b')
         fig.suptitle(f'Waterbody Max Occurrence', fontsize=12)
 
     # boundaries, crs = get_waterbody(objectids=objectids)
     boundaries, crs = get_waterbody_by_fids(fids=fids)
-    for boundary in boundaries:
-        if boundary["geometry"]["type"] == "MultiPolygon":
-            poly_geos = []
-            for p in boundary["geometry"]["coordinates"]:
-                poly_geos.append(Polygon(p[0]))
-            poly = gpd.GeoSeries(MultiPolygon(poly_geos), crs=crs)
-        else:
-            poly = gpd.GeoSeries(Polygon(boundary["geometry"]["coordinates"][0]), crs=crs)
+    geometries = to_geometries(boundaries)
+    polys = []
+    current_colors = []
+    week_colors = []
+    for boundary, geometry in zip(boundaries, geometries):
+        if geometry is None:
+            continue
         objectid = int(boundary["properties"]["OBJECTID"])
         current_color = color_mapping['no detection']
         for current_rating, wbs in current_color_mapping.items():
@@ -656,8 +626,14 @@ def get_waterbody_collection_raster(groupname: str, grouptype: str, group_id: st
         for week_rating, wbs in week_color_mapping.items():
             if objectid in wbs:
                 week_color = color_mapping[week_rating]
-        poly.plot(ax=ax1, facecolor='none', color=current_color, linewidth=1)
-        poly.plot(ax=ax2, facecolor='none', color=week_color, linewidth=1)
+        polys.append(geometry)
+        current_colors.append(current_color)
+        week_colors.append(week_color)
+    if len(polys) > 0:
+        # one collection per axis for all of the waterbodies
+        poly = gpd.GeoSeries(polys, crs=crs)
+        poly.plot(ax=ax1, facecolor='none', color=current_colors, linewidth=1)
+        poly.plot(ax=ax2, facecolor='none', color=week_colors, linewidth=1)
     # plt.axis('off')
     # plt.show()
     plt.tight_layout()
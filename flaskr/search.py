@@ -0,0 +1,164 @@
+import numpy as np
+from collections import defaultdict
+import unicodedata
+import threading
+import logging
+import time
+import re
+
+from flaskr.registry import get_registry
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+MAX_PAGE_SIZE = 500
+MAX_TRIGRAMS = 3         # postings intersected for a query
+
+# Match quality ranks, lower is better
+EXACT = 0
+NAME_PREFIX = 1
+WORD_PREFIX = 2
+SUBSTRING = 3
+
+_index = None
+_lock = threading.Lock()
+
+
+def normalize(name: str):
+    """
+    Lowercase a name, drop accents and punctuation and collapse the whitespace.
+    """
+    if not name:
+        return ""
+    name = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", name).split())
+
+
+def get_trigrams(text: str):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class NameIndex:
+    """
+    In-memory waterbody name index. Names are normalized once, a trigram index narrows the candidates of a query to
+    the names containing all of its trigrams, and a sorted word array resolves short queries by word prefix.
+    """
+
+    def __init__(self, objectids, names, states, areas):
+        self.objectids = objectids
+        self.names = np.array([normalize(n) for n in names], dtype=object)
+        self.areas = np.nan_to_num(np.asarray(areas, dtype=np.float64), nan=0.0)
+
+        # multi-state waterbodies list their states separated by commas
+        state_rows = defaultdict(list)
+        for row, s in enumerate(states):
+            for abbr in set(str(s).upper().replace(" ", "").split(",")) if s else ():
+                if abbr:
+                    state_rows[abbr].append(row)
+        self.state_rows = {abbr: np.array(rows, dtype=np.int32) for abbr, rows in state_rows.items()}
+
+        postings = defaultdict(list)
+        words = []
+        word_rows = []
+        for row, name in enumerate(self.names):
+            for trigram in get_trigrams(name):
+                postings[trigram].append(row)
+            for word in set(name.split(" ")):
+                if word:
+                    words.append(word)
+                    word_rows.append(row)
+        self.postings = {trigram: np.array(rows, dtype=np.int32) for trigram, rows in postings.items()}
+        words = np.array(words, dtype=str)
+        order = np.argsort(words, kind="stable")
+        self.words = words[order]
+        self.word_rows = np.array(word_rows, dtype=np.int32)[order]
+
+    def get_candidates(self, query: str):
+        """
+        Returns the candidate rows of a query, the names containing all of its trigrams, or for queries shorter than a
+        trigram the names with a word starting with the query.
+        """
+        if len(query) < 3:
+            # too short for a trigram, the query has to start a word of the name
+            start = np.searchsorted(self.words, query, side="left")
+            stop = np.searchsorted(self.words, query + "\x7f", side="left")
+            return np.unique(self.word_rows[start:stop])
+        trigram_postings = []
+        for trigram in get_trigrams(query):
+            rows = self.postings.get(trigram)
+            if rows is None:
+                return np.array([], dtype=np.int32)
+            trigram_postings.append(rows)
+        # the rarest trigrams narrow the candidates enough, the substring test in search removes the rest
+        trigram_postings.sort(key=len)
+        rows = trigram_postings[0]
+        for p in trigram_postings[1:MAX_TRIGRAMS]:
+            rows = np.intersect1d(rows, p, assume_unique=True)
+            if len(rows) == 0:
+                break
+        return rows
+
+    def search(self, query: str, state: str = None):
+        """
+        Returns the rows of the names containing the query, ordered by match quality and then by lake area, largest
+        first. Optionally limited to the waterbodies of a state.
+        """
+        query = normalize(query)
+        if not query:
+            return np.array([], dtype=np.int32)
+        rows = self.get_candidates(query)
+        if state and len(rows) > 0:
+            state_rows = self.state_rows.get(str(state).upper().strip(), np.array([], dtype=np.int32))
+            rows = rows[np.isin(rows, state_rows, assume_unique=True)]
+        if len(rows) == 0:
+            return rows
+        names = self.names[rows].astype(str)
+        position = np.char.find(names, query)
+        # trigrams can all be present without the query being a substring
+        found = position >= 0
+        rows, names, position = rows[found], names[found], position[found]
+        ranks = np.full(len(rows), SUBSTRING, dtype=np.int8)
+        ranks[np.char.find(names, f" {query}") >= 0] = WORD_PREFIX
+        ranks[position == 0] = NAME_PREFIX
+        ranks[names == query] = EXACT
+        order = np.lexsort((-self.areas[rows], ranks))
+        return rows[order]
+
+
+def get_name_index():
+    """
+    Returns the waterbody name index, built once per process from the waterbody registry.
+    """
+    global _index
+    if _index is None:
+        with _lock:
+            if _index is None:
+                t0 = time.time()
+                registry = get_registry()
+                _index = NameIndex(registry.objectids, registry.names, registry.states, registry.areas)
+                t1 = time.time()
+                logger.info(f"Built waterbody name index, {len(registry)} waterbodies, runtime: {round(t1 - t0, 3)} sec")
+    return _index
+
+
+def search_waterbodies(name: str, state: str = None, page: int = 1, page_size: int = None):
+    """
+    Search the waterbodies by name, ranked by match quality and lake area.
+    :param name: Name, or part of a name, of the waterbody.
+    :param state: Optional state abbreviation to limit the results to.
+    :param page: Page of the results, starting at 1.
+    :param page_size: Number of results per page, all results when not provided.
+    :return: List of waterbody summaries, as returned by geometry.get_waterbody_byname, and the total number of matches.
+    """
+    index = get_name_index()
+    registry = get_registry()
+    rows = index.search(name, state=state)
+    total = len(rows)
+    if page_size:
+        page_size = min(max(int(page_size), 1), MAX_PAGE_SIZE)
+        start = (max(int(page), 1) - 1) * page_size
+        rows = rows[start:start + page_size]
+    results = []
+    for row in rows:
+        results.append(registry.get_summary(int(index.objectids[row])))
+    return results, total
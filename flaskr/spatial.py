@@ -0,0 +1,155 @@
+import numpy as np
+import geopandas as gpd
+import shapely
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from pyproj import Transformer
+import threading
+import logging
+import time
+
+from flaskr.geometry import WATERBODY_DBF, SHAPELY_2, get_layer_store
+from flaskr.geometry_store import SOURCE_FID
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+BATCH_CHUNK_SIZE = 10000         # points per index query of a batch lookup
+
+_index = None
+_lock = threading.Lock()
+
+
+class WaterbodyIndex:
+    """
+    In-memory STRtree of the waterbody polygons. A point lookup is one tree probe for the polygons whose bounds hold
+    the point and a prepared geometry contains test of those candidates.
+    """
+
+    def __init__(self, geometries, objectids, fids, names, crs):
+        self.geometries = geometries
+        self.objectids = objectids
+        self.fids = fids
+        self.names = names
+        self.crs = crs
+        self.tree = STRtree(geometries)
+        self.transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+        if not SHAPELY_2:
+            # shapely 1.8 trees return the geometries, not their positions, and do not prepare them
+            self._positions = {id(g): i for i, g in enumerate(geometries)}
+            self._prepared = {}
+
+    def _get_prepared(self, i: int):
+        prepared = self._prepared.get(i)
+        if prepared is None:
+            prepared = prep(self.geometries[i])
+            self._prepared[i] = prepared
+        return prepared
+
+    def query(self, lats, lngs):
+        """
+        Find the waterbody containing each point.
+        :param lats: Array of latitudes.
+        :param lngs: Array of longitudes.
+        :return: Array of the waterbody position of each point in the index arrays, -1 where no waterbody contains
+        the point. The first waterbody by FID is used where waterbodies overlap.
+        """
+        x, y = self.transformer.transform(np.asarray(lngs, dtype=np.float64), np.asarray(lats, dtype=np.float64))
+        x = np.atleast_1d(x)
+        y = np.atleast_1d(y)
+        result = np.full(len(x), -1, dtype=np.int64)
+        if SHAPELY_2:
+            points = shapely.points(x, y)
+            point_i, geometry_i = self.tree.query(points, predicate="within")
+            first = np.full(len(x), len(self.geometries), dtype=np.int64)
+            np.minimum.at(first, point_i, geometry_i)
+            found = first < len(self.geometries)
+            result[found] = first[found]
+            return result
+        for n in range(len(x)):
+            point = Point(x[n], y[n])
+            candidates = sorted(self._positions[id(g)] for g in self.tree.query(point))
+            for i in candidates:
+                if self._get_prepared(i).contains(point):
+                    result[n] = i
+                    break
+        return result
+
+    def find(self, lat: float, lng: float):
+        """
+        Returns the objectid, FID and GNIS name of the waterbody containing the point, or (None, None, None).
+        """
+        i = self.query([lat], [lng])[0]
+        if i < 0:
+            return None, None, None
+        return int(self.objectids[i]), int(self.fids[i]), self.names[i]
+
+
+def load_waterbody_index():
+    """
+    Load the waterbody polygons, from the geometry store when built or the shapefile, and build the index.
+    """
+    t0 = time.time()
+    store = get_layer_store("waterbodies")
+    if store is not None:
+        waterbodies = gpd.read_file(store.path)
+        waterbodies = waterbodies.sort_values(SOURCE_FID)
+        fids = waterbodies[SOURCE_FID].to_numpy(dtype=np.int64)
+    else:
+        waterbodies = gpd.read_file(WATERBODY_DBF)
+        fids = np.arange(len(waterbodies), dtype=np.int64)
+    valid = (waterbodies.geometry.notna() & ~waterbodies.geometry.is_empty).to_numpy()
+    index = WaterbodyIndex(
+        geometries=waterbodies.geometry.to_numpy()[valid],
+        objectids=waterbodies["OBJECTID"].to_numpy(dtype=np.int64)[valid],
+        fids=fids[valid],
+        names=waterbodies["GNIS_NAME"].to_numpy(dtype=object)[valid],
+        crs=waterbodies.crs
+    )
+    t1 = time.time()
+    logger.info(f"Built waterbody spatial index, {len(index.objectids)} waterbodies, runtime: {round(t1 - t0, 3)} sec")
+    return index
+
+
+def get_waterbody_index():
+    """
+    Returns the waterbody spatial index, built once per process.
+    """
+    global _index
+    if _index is None:
+        with _lock:
+            if _index is None:
+                _index = load_waterbody_index()
+    return _index
+
+
+def find_waterbodies(lats, lngs, ids=None, chunk_size: int = BATCH_CHUNK_SIZE):
+    """
+    Find the waterbody containing each of many points, with one vectorized index query per chunk of points.
+    :param lats: Array of latitudes.
+    :param lngs: Array of longitudes.
+    :param ids: Optional list of point ids, defaults to the point positions.
+    :param chunk_size: Number of points per query.
+    :return: Generator of lists of results, one list per chunk, with the point id, lat, lng and the objectid, FID and
+    GNIS name of the waterbody, None when the point is not in a waterbody.
+    """
+    index = get_waterbody_index()
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    for start in range(0, len(lats), chunk_size):
+        stop = min(start + chunk_size, len(lats))
+        positions = index.query(lats[start:stop], lngs[start:stop])
+        results = []
+        for n, i in enumerate(positions):
+            lat, lng = lats[start + n], lngs[start + n]
+            name = index.names[i] if i >= 0 else None
+            results.append({
+                "id": ids[start + n] if ids is not None else start + n,
+                "lat": float(lat) if np.isfinite(lat) else None,
+                "lng": float(lng) if np.isfinite(lng) else None,
+                "objectid": int(index.objectids[i]) if i >= 0 else None,
+                "fid": int(index.fids[i]) if i >= 0 else None,
+                "name": name if isinstance(name, str) else None
+            })
+        yield results
@@ -0,0 +1,249 @@
+from collections import OrderedDict
+from osgeo import gdal
+import threading
+import logging
+import rasterio
+import uuid
+import time
+import os
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+IMAGE_DIR = os.getenv('IMAGE_DIR', "D:\\data\cyan_rare\\mounts\\images")
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "local")             # 'local' or 's3'
+IMAGE_BUCKET = os.getenv("IMAGE_BUCKET")
+IMAGE_PREFIX = os.getenv("IMAGE_PREFIX", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")                  # S3 compatible endpoint, such as a MinIO server
+VSI_CACHE_SIZE = int(os.getenv("VSI_CACHE_SIZE", 64 * 1024 ** 2))            # bytes of GDAL's per file range cache
+CURL_CACHE_SIZE = int(os.getenv("CPL_VSIL_CURL_CACHE_SIZE", 512 * 1024 ** 2))  # bytes of GDAL's shared range cache
+STORAGE_CACHE_DIR = os.getenv("STORAGE_CACHE_DIR", os.path.join("static", "storage_cache"))
+STORAGE_CACHE_MAX_BYTES = int(os.getenv("STORAGE_CACHE_MAX_BYTES", 8 * 1024 ** 3))  # 0 reads with range requests only
+LISTING_TTL = 60            # seconds the S3 image listing is reused for
+
+_storage = None
+
+
+def get_image_name(path: str):
+    """
+    Returns the image file name of a local, /vsis3/ or storage path.
+    """
+    return os.path.basename(str(path).replace("\\", "/"))
+
+
+class LocalStorage:
+    """
+    Images on the local filesystem, in IMAGE_DIR.
+    """
+
+    def __init__(self, image_dir: str = None):
+        self.image_dir = image_dir if image_dir else IMAGE_DIR
+
+    def list_images(self):
+        return os.listdir(self.image_dir)
+
+    def get_path(self, name: str):
+        if os.path.dirname(name):
+            return name
+        return str(os.path.join(self.image_dir, name))
+
+    def exists(self, name: str):
+        return os.path.exists(self.get_path(name))
+
+    def resolve(self, name: str):
+        return self.get_path(name)
+
+    def open(self, name: str):
+        return rasterio.open(self.get_path(name))
+
+
+class DiskCache:
+    """
+    Least recently used cache of files in a directory, bounded by max_bytes. The directory is shared by all the
+    processes of the host and kept across restarts, each process tracks the files it has used.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._index = None          # file name -> size in bytes, least recently used first
+        self._index_bytes = 0
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for f in os.scandir(self.cache_dir):
+            if f.is_file() and not f.name.endswith(".tmp"):
+                stat = f.stat()
+                entries.append((stat.st_atime, f.name, stat.st_size))
+        self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._index_bytes = sum(self._index.values())
+        return self._index
+
+    def _remove(self, name: str):
+        self._index_bytes -= self._index.pop(name, 0)
+        path = os.path.join(self.cache_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def get(self, name: str):
+        """
+        Returns the path of a cached file, or None if the file is not in the cache.
+        """
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            index = self._load_index()
+            if not os.path.exists(path):
+                # not cached, or evicted by another process
+                if name in index:
+                    self._remove(name)
+                return None
+            if name not in index:
+                # cached by another process
+                index[name] = os.path.getsize(path)
+                self._index_bytes += index[name]
+            index.move_to_end(name)
+        os.utime(path)
+        return path
+
+    def put(self, name: str, write):
+        """
+        Add a file to the cache, evicting the least recently used files when over max_bytes.
+        :param name: Cache file name.
+        :param write: Function writing the file to the temporary path it is given.
+        :return: Path to the cached file.
+        """
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            self._load_index()
+        tmp_path = os.path.join(self.cache_dir, f"{uuid.uuid4()}.tmp")
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            index = self._load_index()
+            if name in index:
+                self._index_bytes -= index[name]
+            index[name] = os.path.getsize(path)
+            index.move_to_end(name)
+            self._index_bytes += index[name]
+            while self._index_bytes > self.max_bytes and len(index) > 1:
+                self._remove(next(iter(index)))
+        return path
+
+
+class S3Storage:
+    """
+    Images in an S3 compatible bucket. The images are mirrored to STORAGE_CACHE_DIR on first use, a least recently used
+    disk cache bounded by STORAGE_CACHE_MAX_BYTES and shared by the processes of the host, so each image is downloaded
+    once per host rather than read over the network by every process. With the cache disabled, or for images larger
+    than the cache, GDAL reads the images with ranged requests through /vsis3/, the ranges are cached in memory by GDAL,
+    per open file with VSI_CACHE and across files with the /vsicurl/ cache.
+    """
+
+    def __init__(self, bucket: str = None, prefix: str = None, endpoint_url: str = None):
+        if boto3 is None:
+            raise ImportError("S3 image storage requires boto3")
+        self.bucket = bucket if bucket else IMAGE_BUCKET
+        self.prefix = prefix if prefix is not None else IMAGE_PREFIX
+        self.endpoint_url = endpoint_url if endpoint_url else S3_ENDPOINT_URL
+        self.client = boto3.client("s3", endpoint_url=self.endpoint_url)
+        self._listing = None
+        self._listing_time = 0
+        self._lock = threading.Lock()
+        self.cache = DiskCache(STORAGE_CACHE_DIR, STORAGE_CACHE_MAX_BYTES) if STORAGE_CACHE_MAX_BYTES > 0 else None
+        if self.endpoint_url:
+            endpoint = self.endpoint_url.split("://")[-1]
+            gdal.SetConfigOption("AWS_S3_ENDPOINT", endpoint)
+            gdal.SetConfigOption("AWS_HTTPS", "NO" if self.endpoint_url.startswith("http://") else "YES")
+            gdal.SetConfigOption("AWS_VIRTUAL_HOSTING", "FALSE")
+        gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+        gdal.SetConfigOption("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".tif")
+        gdal.SetConfigOption("VSI_CACHE", "TRUE")
+        gdal.SetConfigOption("VSI_CACHE_SIZE", str(VSI_CACHE_SIZE))
+        gdal.SetConfigOption("CPL_VSIL_CURL_CACHE_SIZE", str(CURL_CACHE_SIZE))
+
+    def _key(self, name: str):
+        return f"{self.prefix}{get_image_name(name)}"
+
+    def _get_listing(self):
+        with self._lock:
+            if self._listing is None or time.time() - self._listing_time > LISTING_TTL:
+                listing = {}
+                paginator = self.client.get_paginator("list_objects_v2")
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+                    for obj in page.get("Contents", []):
+                        listing[obj["Key"][len(self.prefix):]] = (obj["Size"], obj["ETag"].strip('"'))
+                self._listing = listing
+                self._listing_time = time.time()
+            return self._listing
+
+    def list_images(self):
+        return list(self._get_listing().keys())
+
+    def get_path(self, name: str):
+        return f"/vsis3/{self.bucket}/{self._key(name)}"
+
+    def exists(self, name: str):
+        return get_image_name(name) in self._get_listing()
+
+    def resolve(self, name: str):
+        """
+        Returns the path GDAL reads an image from, the cached copy of the image, downloading it on first use, or its
+        /vsis3/ path if the image is not cached.
+        """
+        image_name = get_image_name(name)
+        entry = self._get_listing().get(image_name)
+        if self.cache is None or entry is None or entry[0] > self.cache.max_bytes:
+            return self.get_path(name)
+        # the etag is part of the name so a replaced image is downloaded again
+        cache_name = f"{entry[1].replace('-', '_')}-{image_name}"
+        path = self.cache.get(cache_name)
+        if path is None:
+            t0 = time.time()
+            path = self.cache.put(cache_name, lambda tmp_path: self.client.download_file(self.bucket, self._key(name),
+                                                                                         tmp_path))
+            logger.info(f"Cached image: {image_name}, {entry[0]} bytes, runtime: {round(time.time() - t0, 3)} sec")
+        return path
+
+    def open(self, name: str):
+        return rasterio.open(self.resolve(name))
+
+
+def get_storage():
+    """
+    Returns the image storage backend selected by IMAGE_STORAGE, created once per process.
+    """
+    global _storage
+    if _storage is None:
+        if IMAGE_STORAGE == "s3":
+            _storage = S3Storage()
+        else:
+            _storage = LocalStorage()
+        logger.info(f"Image storage: {IMAGE_STORAGE}")
+    return _storage
+
+
+def resolve_image(path):
+    """
+    Returns the path GDAL reads an image path, from get_images or the storage backend, from.
+    """
+    return get_storage().resolve(str(path))
+
+
+def open_image(path):
+    """
+    Open an image path, from get_images or the storage backend, as a rasterio dataset.
+    """
+    return get_storage().open(str(path))
@@ -0,0 +1,146 @@
+import numpy as np
+from PIL import Image
+import logging
+import shutil
+import math
+import uuid
+import os
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+TILE_ROOT = os.path.join("static", "tiles")
+TILE_SIZE = 256
+MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", 10))
+EMPTY_TILE = os.path.join(TILE_ROOT, "empty.png")
+
+# Web Mercator (EPSG:3857) half extent in meters
+ORIGIN_SHIFT = 20037508.342789244
+
+
+def get_tile_dir(year: int, day: int, daily: bool = True, product: str = None):
+    """
+    Returns the root directory of a tile pyramid.
+    :param year: Year of the imagery.
+    :param day: Day of the year of the imagery.
+    :param daily: Daily or weekly imagery.
+    :param product: Optional product name, defaults to the daily/weekly period.
+    :return: Path to the {z}/{x}/{y}.png directory tree.
+    """
+    if product is None:
+        product = 'daily' if daily else 'weekly'
+    return os.path.join(TILE_ROOT, product, str(year), str(day))
+
+
+def get_tile_path(year: int, day: int, z: int, x: int, y: int, daily: bool = True, product: str = None):
+    """
+    Returns the path of a single tile in a pyramid, falling back to the shared empty tile if the pyramid exists but the
+    tile was deduplicated as empty.
+    :return: Path to the tile png or None if the pyramid has not been generated.
+    """
+    tile_dir = get_tile_dir(year=year, day=day, daily=daily, product=product)
+    if not os.path.exists(tile_dir):
+        return None
+    tile_path = os.path.join(tile_dir, str(z), str(x), f"{y}.png")
+    if os.path.exists(tile_path):
+        return tile_path
+    if 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z:
+        return get_empty_tile()
+    return None
+
+
+def get_empty_tile():
+    """
+    Returns the path to the single transparent tile shared by all pyramids.
+    """
+    if not os.path.exists(EMPTY_TILE):
+        os.makedirs(TILE_ROOT, exist_ok=True)
+        Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(EMPTY_TILE, 'PNG')
+    return EMPTY_TILE
+
+
+def get_tile_range(bounds, z: int):
+    """
+    XYZ tile index range covering the bounds, given in EPSG:3857 (left, bottom, right, top).
+    """
+    n = 2 ** z
+    tile_m = 2 * ORIGIN_SHIFT / n
+    x0 = max(int(math.floor((bounds[0] + ORIGIN_SHIFT) / tile_m)), 0)
+    x1 = min(int(math.floor((bounds[2] + ORIGIN_SHIFT) / tile_m)), n - 1)
+    y0 = max(int(math.floor((ORIGIN_SHIFT - bounds[3]) / tile_m)), 0)
+    y1 = min(int(math.floor((ORIGIN_SHIFT - bounds[1]) / tile_m)), n - 1)
+    return x0, x1, y0, y1
+
+
+def generate_tiles(data, transform, lut, year: int, day: int, daily: bool = True, product: str = None,
+                   max_zoom: int = None):
+    """
+    Generate the XYZ png tile pyramid, z0 to max_zoom, for a raster in EPSG:3857. Each tile is sampled by nearest
+    neighbour directly from the source array and colored through the lookup table. Fully transparent tiles are not
+    written, those are served from the shared empty tile. The pyramid is built in a temporary directory next to the
+    tile directory and swapped in once complete, so a pyramid being regenerated keeps serving its previous tiles.
+    :param data: 2d array of values in EPSG:3857, used as indices into the lookup table.
+    :param transform: Affine transform of data.
+    :param lut: Nx4 uint8 RGBA lookup table.
+    :param year: Year of the imagery.
+    :param day: Day of the year of the imagery.
+    :param daily: Daily or weekly imagery.
+    :param product: Optional product name, defaults to the daily/weekly period.
+    :param max_zoom: Max zoom level of the pyramid, defaults to TILE_MAX_ZOOM.
+    :return: Number of tiles written.
+    """
+    if max_zoom is None:
+        max_zoom = MAX_ZOOM
+    tile_dir = get_tile_dir(year=year, day=day, daily=daily, product=product)
+    build_dir = f"{tile_dir}.{uuid.uuid4()}.tmp"
+    os.makedirs(build_dir)
+    get_empty_tile()
+
+    height, width = data.shape
+    left = transform.c
+    top = transform.f
+    bounds = (left, top + height * transform.e, left + width * transform.a, top)
+
+    n_tiles = 0
+    for z in range(0, max_zoom + 1):
+        tile_m = 2 * ORIGIN_SHIFT / 2 ** z
+        res = tile_m / TILE_SIZE
+        x0, x1, y0, y1 = get_tile_range(bounds, z)
+        # source column/row for every output pixel of the zoom level span, computed once per zoom
+        xs = -ORIGIN_SHIFT + x0 * tile_m + (np.arange((x1 - x0 + 1) * TILE_SIZE) + 0.5) * res
+        ys = ORIGIN_SHIFT - y0 * tile_m - (np.arange((y1 - y0 + 1) * TILE_SIZE) + 0.5) * res
+        cols = np.floor((xs - left) / transform.a).astype(np.int64)
+        rows = np.floor((ys - top) / transform.e).astype(np.int64)
+        valid_cols = (cols >= 0) & (cols < width)
+        valid_rows = (rows >= 0) & (rows < height)
+        cols = np.clip(cols, 0, width - 1)
+        rows = np.clip(rows, 0, height - 1)
+        for ty in range(y0, y1 + 1):
+            r0 = (ty - y0) * TILE_SIZE
+            t_rows = rows[r0:r0 + TILE_SIZE]
+            t_vrows = valid_rows[r0:r0 + TILE_SIZE]
+            if not t_vrows.any():
+                continue
+            for tx in range(x0, x1 + 1):
+                c0 = (tx - x0) * TILE_SIZE
+                t_vcols = valid_cols[c0:c0 + TILE_SIZE]
+                if not t_vcols.any():
+                    continue
+                tile = lut[data[np.ix_(t_rows, cols[c0:c0 + TILE_SIZE])]]
+                tile[~np.outer(t_vrows, t_vcols)] = 0
+                if not tile[:, :, 3].any():
+                    continue
+                tile_path = os.path.join(build_dir, str(z), str(tx))
+                os.makedirs(tile_path, exist_ok=True)
+                Image.fromarray(tile, mode='RGBA').save(os.path.join(tile_path, f"{ty}.png"), 'PNG')
+                n_tiles += 1
+    # a directory can only be renamed over an empty directory, the previous pyramid is moved aside first
+    old_dir = None
+    if os.path.exists(tile_dir):
+        old_dir = f"{tile_dir}.{uuid.uuid4()}.old"
+        os.replace(tile_dir, old_dir)
+    os.replace(build_dir, tile_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    logger.info(f"Generated {n_tiles} tiles, z0-{max_zoom}, in {tile_dir}")
+    return n_tiles
@@ -0,0 +1,141 @@
+import numpy as np
+from rasterio import features
+from rasterio.errors import WindowError
+from affine import Affine
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+from io import BytesIO
+import datetime
+import logging
+import math
+import json
+import os
+
+from flaskr.raster import get_tile_timeseries, get_image_path, reproject_nearest
+from flaskr.geometry import get_waterbody_by_fids, to_geoseries
+from flaskr.db import get_tile_names_by_objectid
+from flaskr.render import get_lut, render_rgba
+from flaskr.storage import get_storage, open_image
+from flaskr.registry import get_registry
+
+
+logger = logging.getLogger("cyan-waterbody")
+
+MAX_FRAMES = int(os.getenv("TIMELAPSE_MAX_FRAMES", 366))
+MAX_FPS = 30
+DST_CRS = {'init': 'epsg:3857'}
+FORMATS = ("png", "webp", "sprite", "index")
+
+
+def get_timelapse_frames(objectid: int, start_year: int, start_day: int, end_year: int, end_day: int,
+                         daily: bool = True):
+    """
+    Extract every frame of a waterbody for a date range. The waterbody geometry and tiles are looked up once, the
+    window of each tile is located once and read for all dates, and the frames are reprojected together with a single
+    reprojection index map.
+    :return: List of (year, day) dates, a (dates, rows, cols) uint8 array in EPSG:3857 with 0 outside the waterbody,
+    its affine transform and the image colormap. None if there are no images for the waterbody in the date range.
+    """
+    fid = get_registry().get_fid(objectid)
+    if fid is None:
+        return None
+    wb_features, crs = get_waterbody_by_fids(fid=fid)
+    if len(wb_features) == 0:
+        return None
+    poly = to_geoseries(wb_features[0], crs)
+
+    start_date = datetime.date(start_year, 1, 1) + datetime.timedelta(days=start_day - 1)
+    end_date = datetime.date(end_year, 1, 1) + datetime.timedelta(days=end_day - 1)
+    parts = []
+    colormap = None
+    tile_crs = None
+    for tile in get_tile_names_by_objectid(objectid):
+        # the tile grid is the same for all dates, the window is located from the first image of the tile in the range
+        image_path = None
+        current_date = start_date
+        while current_date <= end_date:
+            path = get_image_path(tile, year=current_date.year, day=current_date.timetuple().tm_yday, daily=daily)
+            if get_storage().exists(path):
+                image_path = path
+                break
+            current_date += datetime.timedelta(days=1)
+        if image_path is None:
+            continue
+        with open_image(image_path) as src:
+            tile_crs = src.crs
+            try:
+                window = features.geometry_window(src, poly.to_crs(src.crs))
+            except WindowError:
+                continue
+            if colormap is None:
+                colormap = src.colormap(1)
+        dates, data, transform, _ = get_tile_timeseries(tile, start_year, start_day, end_year, end_day,
+                                                        window=window, daily=daily)
+        if data is not None and len(dates) > 0:
+            parts.append((dates, data, transform))
+    if len(parts) == 0:
+        return None
+
+    # merge the tile windows into a single frame stack on the shared tile grid
+    all_dates = sorted(set(d for part in parts for d in part[0]))
+    date_index = {d: i for i, d in enumerate(all_dates)}
+    res_x = parts[0][2].a
+    res_y = parts[0][2].e
+    left = min(t.c for _, _, t in parts)
+    top = max(t.f for _, _, t in parts)
+    right = max(t.c + d.shape[2] * t.a for _, d, t in parts)
+    bottom = min(t.f + d.shape[1] * t.e for _, d, t in parts)
+    width = int(round((right - left) / res_x))
+    height = int(round((bottom - top) / res_y))
+    transform = Affine(res_x, 0.0, left, 0.0, res_y, top)
+    frames = np.zeros((len(all_dates), height, width), dtype=np.uint8)
+    for dates, data, part_transform in parts:
+        col = int(round((part_transform.c - left) / res_x))
+        row = int(round((part_transform.f - top) / res_y))
+        frames[[date_index[d] for d in dates], row:row + data.shape[1], col:col + data.shape[2]] = data
+    inside = features.geometry_mask(poly.to_crs(tile_crs), out_shape=(height, width), transform=transform, invert=True)
+    frames[:, ~inside] = 0
+    frames, transform = reproject_nearest(frames, src_crs=tile_crs, src_transform=transform, dst_crs=DST_CRS)
+    return all_dates, frames, transform, colormap
+
+
+def render_timelapse(dates: list, frames, colormap: dict, thresholds: tuple = None, image_format: str = "png",
+                     fps: int = 4):
+    """
+    Render the frames of a time-lapse.
+    :param dates: List of (year, day) dates of the frames.
+    :param frames: (dates, rows, cols) array of DN values.
+    :param colormap: Colormap of the images.
+    :param thresholds: Optional (low, med, high) DN thresholds, see render.get_lut.
+    :param image_format: 'png' for an animated png, 'webp' for an animated webp or 'sprite' for a png sprite sheet.
+    :param fps: Frames per second of the animation.
+    :return: BytesIO of the image and the frame index, a list of the frame dates and their sprite sheet position.
+    """
+    lut = get_lut(colormap, thresholds=thresholds)
+    height, width = frames.shape[1:]
+    index = []
+    for year, day in dates:
+        date = datetime.date(year, 1, 1) + datetime.timedelta(days=day - 1)
+        index.append({"year": year, "day": day, "date": date.isoformat()})
+    image_file = BytesIO()
+    if image_format == "sprite":
+        n_cols = int(math.ceil(math.sqrt(len(frames))))
+        n_rows = int(math.ceil(len(frames) / n_cols))
+        sheet = np.zeros((n_rows * height, n_cols * width, 4), dtype=np.uint8)
+        for i, frame in enumerate(frames):
+            row, col = divmod(i, n_cols)
+            sheet[row * height:(row + 1) * height, col * width:(col + 1) * width] = render_rgba(frame, lut)
+            index[i].update({"x": col * width, "y": row * height, "width": width, "height": height})
+        png_info = PngInfo()
+        png_info.add_text("frames", json.dumps(index))
+        Image.fromarray(sheet, mode='RGBA').save(image_file, 'PNG', pnginfo=png_info)
+    else:
+        images = [Image.fromarray(render_rgba(frame, lut), mode='RGBA') for frame in frames]
+        duration = int(1000 / fps)
+        if image_format == "webp":
+            images[0].save(image_file, 'WEBP', save_all=True, append_images=images[1:], duration=duration, loop=0,
+                           lossless=True)
+        else:
+            images[0].save(image_file, 'PNG', save_all=True, append_images=images[1:], duration=duration, loop=0)
+    image_file.seek(0)
+    return image_file, index
@@ -3,10 +3,11 @@ import os
 import sqlite3
 from tqdm import tqdm
 import numpy as np
-import multiprocessing as mp
-from flaskr.aggregate import get_waterbody_raster
-from flaskr.geometry import get_waterbody_fids
+from flaskr.geometry import get_waterbody_fids, read_waterbody_geometries
+from flaskr.render import rgba
+from flaskr.registry import reset_registry
 import logging
+import time
 
 
 logging.basicConfig(level=logging.INFO)
@@ -25,12 +26,6 @@ colormap_rgb = {
 }
 
 # Colormap colors
-rgba = {
-    'low': (0, 128, 0, 255),
-    'medium': (200, 200, 0, 255),
-    'high': (255, 165, 0, 255),
-    'vhigh': (255, 0, 0, 255)
-}
 rgb = {
     'low': (0, 128, 0),
     'medium': (200, 200, 0),
@@ -71,56 +66,31 @@ def get_colormap(low: int = 100, med: int = 140, high: int = 183, transparency:
     return new_colormap
 
 
-def update_geometry_bounds(day: int, year: int):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    query = "SELECT OBJECTID FROM GeometryIndex"
-    cur.execute(query)
-    objectids = cur.fetchall()
-    cur.execute("BEGIN")
-    for i in tqdm(range(len(objectids)), desc="Settings geometry bounds in db...", ascii=False):
-        objectid = objectids[i][0]
-        data, cm = get_waterbody_raster(objectid=objectid, day=day, year=year)
-        raster, trans, crs, bounds = data
-        query = "UPDATE WaterbodyBounds Set x_min=?, x_max=?, y_min=?, y_max=? WHERE OBJECTID=?"
-        values = (bounds[1][1], bounds[0][1], bounds[0][0], bounds[1][0], objectid,)
-        cur.execute(query, values)
-    cur.execute("COMMIT")
-
-
-def p_update_geometry_bounds(day: int, year: int):
+def update_geometry_bounds(objectids: list = None):
+    """
+    Set the EPSG:4326 bounds of the waterbodies in WaterbodyBounds, from the waterbody polygons. The polygons are read
+    once and reprojected and bounded together, and the table is updated with a single executemany.
+    :param objectids: Optional list of OBJECTIDs to update, defaults to all waterbodies.
+    :return: Number of waterbodies updated.
+    """
+    t0 = time.time()
+    all_objectids, fids, geometries = read_waterbody_geometries()
+    valid = (geometries.notna() & ~geometries.is_empty).to_numpy()
+    if objectids is not None:
+        valid = valid & np.isin(all_objectids, np.asarray(objectids, dtype=np.int64))
+    bounds = geometries[valid].to_crs(4326).bounds
+    values = zip(bounds["minx"].tolist(), bounds["maxx"].tolist(), bounds["miny"].tolist(), bounds["maxy"].tolist(),
+                 all_objectids[valid].tolist())
     conn = sqlite3.connect(DB_FILE)
     cur = conn.cursor()
-    query = "SELECT OBJECTID FROM GeometryIndex"
-    cur.execute(query)
-    objectids = cur.fetchall()
-
-    cpus = mp.cpu_count() - 2 if mp.cpu_count() - 2 >= 2 else mp.cpu_count()
-    pool = mp.Pool(cpus)
-    logger.info("Running async, cores: {}".format(cpus))
-    results = {}
-    results_objects = [pool.apply_async(p_get_geometry_bounds, args=(objectid[0], day, year)) for objectid in objectids]
-    for i in tqdm(range(len(results_objects)), desc="Settings geometry bounds in db...", ascii=False):
-        r = results_objects[i].get()
-        results[r[4]] = [r[0], r[1], r[2], r[3]]
-    cur.execute("BEGIN")
-    i = 0
-    for objectid, bounds in results.items():
-        query = "UPDATE WaterbodyBounds Set x_min=?, x_max=?, y_min=?, y_max=? WHERE OBJECTID=?"
-        values = (bounds[0], bounds[1], bounds[2], bounds[3], objectid,)
-        cur.execute(query, values)
-        if i % 400 == 0:
-            cur.execute("COMMIT")
-            cur.execute("BEGIN")
-        i += 1
-    cur.execute("COMMIT")
-
-
-def p_get_geometry_bounds(objectid, day, year):
-    data, cm = get_waterbody_raster(objectid=objectid, day=day, year=year)
-    raster, trans, crs, bounds = data
-    values = (bounds[1][1], bounds[0][1], bounds[0][0], bounds[1][0], objectid,)
-    return values
+    query = "UPDATE WaterbodyBounds Set x_min=?, x_max=?, y_min=?, y_max=? WHERE OBJECTID=?"
+    cur.executemany(query, values)
+    conn.commit()
+    conn.close()
+    reset_registry()
+    t1 = time.time()
+    logger.info(f"Updated waterbody bounds for {int(valid.sum())} waterbodies, runtime: {round(t1 - t0, 3)} sec")
+    return int(valid.sum())
 
 
 def convert_dn(dn, round=2):
@@ -4,12 +4,16 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 import os
 import argparse
 import time
-from flaskr.db import p_set_geometry_tiles, set_geometry_tiles, save_data, get_waterbody_data, set_tile_bounds, set_index, set_waterbody_details_table, export_waterbody_details_table
-from flaskr.utils import update_geometry_bounds, p_update_geometry_bounds, update_waterbody_fids
+from flaskr.db import set_geometry_tiles, save_data, get_waterbody_data, set_tile_bounds, set_index, set_waterbody_details_table, export_waterbody_details_table
+from flaskr.utils import update_geometry_bounds, update_waterbody_fids
 from flaskr.aggregate import aggregate, retry_failed, p_aggregate, get_images, generate_conus_image
 from flaskr.report import generate_state_reports, generate_alpinelake_report
-from flaskr.geometry import get_waterbody
+from flaskr.geometry import get_waterbody, GEOMETRY_LAYERS
+from flaskr.geometry_store import build_geometry_store
 from flaskr.raster import mosaic_rasters, get_colormap, clip_raster
+from flaskr.datacube import append_images, datacube_enabled
+from flaskr.lake_index import build_lake_index, generate_category_image
+from flaskr.elevation import set_dem_elevations
 import logging
 import datetime
 
@@ -28,14 +32,18 @@ parser.add_argument('--weekly', default=False, type=bool, help="Process weekly d
 parser.add_argument('--objectid', default=None, type=int, help="OBJECTID of a waterbody for a single waterbody aggregation")
 parser.add_argument('--aggregate', default=False, type=bool, help='Save the aggregated data for the images in image_dir to the database.')
 parser.add_argument('--retry', default=False, type=bool, help='Retry failed aggregation attempts')
-parser.add_argument('--set_wb_bounds', default=False, type=bool, help='Reset the waterbody bounds in the database from clipped rasters.')
+parser.add_argument('--set_wb_bounds', default=False, type=bool, help='Reset the waterbody bounds in the database from the waterbody polygons.')
 parser.add_argument('--generate-state-reports', action='store_true', help='Generate reports for all CONUS states')
 parser.add_argument('--generate-alpine-lake-report', action='store_true', help='Generate a report for all alpine lakes in CONUS, elevation of >= 5000ft')
 parser.add_argument('--add_waterbody_fids', action='store_true', help='Update Waterbody database to include the FID column')
 parser.add_argument('--add_waterbody_elevation', action='store_true', help='Update Waterbody database to include waterbody elevation data from USGS')
 parser.add_argument('--export_waterbody_elevation', action='store_true', help='Export the waterbody elevation data table to csv')
+parser.add_argument('--dem', type=str, help="Path to a local DEM GeoTIFF, or VRT, used by --add_waterbody_elevation instead of the USGS elevation service.")
 parser.add_argument('--file', type=str, help="File path for input or output depending on the primary argument.")
 parser.add_argument('--generate_conus_image', action='store_true', help='Test generating cyan image for day/year for all CONUS masking out all non-wb pixels.')
+parser.add_argument('--build_geometry_store', action='store_true', help='Convert the waterbody and boundary shapefiles to the indexed FlatGeobuf geometry store.')
+parser.add_argument('--build_lake_index', action='store_true', help='Build the national waterbody index raster used for the waterbody category images.')
+parser.add_argument('--update_datacube', action='store_true', help='Append the images for year/day to the tile datacubes in DATACUBE_DIR.')
 
 PARALLEL = True
 
@@ -53,6 +61,8 @@ def async_aggregate(year: int, day: int, daily: bool):
                 data, offset, completed = aggregate(year, day, daily, offset=offset)
             save_data(year, day, data=data, daily=daily)
         logger.info("Completed processing waterbody aggregation for year: {}, day: {}, {}".format(year, day, "daily" if daily else "weekly"))
+        if datacube_enabled():
+            append_images(get_images(year=year, day=day, daily=daily), year=year, day=day, daily=daily)
     except Exception as e:
         logger.critical("ERROR processing data for waterbody aggregation. Message: {}".format(e))
     t1 = time.time()
@@ -60,6 +70,7 @@ def async_aggregate(year: int, day: int, daily: bool):
     generate_conus_image(day=int(day), year=int(year), daily=daily)
     t2 = time.time()
     logger.info(f"Completed generating conus {'daily' if daily else 'weekly'} image for year: {year}, day: {day}, runtime: {round(t2 - t1, 4)} sec")
+    generate_category_image(day=int(day), year=int(year), daily=daily)
 
 
 def async_retry():
@@ -76,10 +87,7 @@ if __name__ == "__main__":
         if args.year is None or args.day is None:
             print("Mapping geometries to tiles requires reference tif, determined by year and day parameters.")
             exit()
-        if PARALLEL:
-            p_set_geometry_tiles(args.year, args.day, args.objectid)           # cpus=14 => 1:17:19
-        else:
-            set_geometry_tiles(args.year, args.day)
+        set_geometry_tiles(args.year, args.day, objectids=[args.objectid] if args.objectid else None)
         logger.info("Completed setting waterbody to tile mapping.")
     elif args.aggregate:
         logger.info("Aggregating waterbodies for year: {}, day: {}, {}".format(args.year, args.day, "daily" if daily else "weekly"))
@@ -95,6 +103,8 @@ if __name__ == "__main__":
                 exit()
             save_data(args.year, args.day, data=data, daily=daily)
         logger.info("Completed waterbody aggregation")
+        if datacube_enabled():
+            append_images(get_images(year=args.year, day=args.day, daily=daily), year=args.year, day=args.day, daily=daily)
     elif args.get_data:
         data = get_waterbody_data(objectid=args.objectid, daily=daily)
         logger.info("Data: {}".format(data))
@@ -103,10 +113,7 @@ if __name__ == "__main__":
         retry_failed(daily=False)
         logger.info("Completed retry failed aggregations.")
     elif args.set_wb_bounds:
-        if args.year is None or args.day is None:
-            print("Setting waterbody bounds requires reference tif, determined by year and day parameters.")
-            exit()
-        p_update_geometry_bounds(day=args.day, year=args.year)
+        update_geometry_bounds(objectids=[args.objectid] if args.objectid else None)
         logger.info("Completed updating waterbody geometry bounds")
     elif args.set_tile_bounds:
         if args.year is None or args.day is None:
@@ -119,6 +126,9 @@ if __name__ == "__main__":
         exit()
     elif args.add_waterbody_elevation:
         print("Updating Waterbody details table with elevation data")
+        if args.dem:
+            set_dem_elevations(dem_file=args.dem)
+            exit()
         input_file = None
         if args.file:
             if os.path.exists(args.file):
@@ -158,6 +168,18 @@ if __name__ == "__main__":
             daily = bool(args.daily)
         print("Daily: {}".format(daily))
         generate_conus_image(day=day, year=year, daily=daily)
+    elif args.build_geometry_store:
+        build_geometry_store(GEOMETRY_LAYERS)
+    elif args.build_lake_index:
+        build_lake_index()
+    elif args.update_datacube:
+        if args.year is None or args.day is None:
+            print("Updating the datacube requires the year and day parameters.")
+            exit()
+        if not datacube_enabled():
+            print("Datacube store requires h5py and the DATACUBE_DIR env variable.")
+            exit()
+        append_images(get_images(year=args.year, day=args.day, daily=daily), year=args.year, day=args.day, daily=daily)
     else:
         print("")
         logger.info("Invalid input arguments\n")
@@ -3,24 +3,36 @@ import numpy as np
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-from flask import Flask, request, send_file, make_response, send_from_directory, g
+from flask import Flask, request, send_file, make_response, send_from_directory, g, Response, stream_with_context
 from flaskr.db import get_waterbody_data, get_waterbody_bypoint, get_waterbody, check_status, check_overall_status, \
-    check_images, get_all_states, get_all_state_counties, get_all_tribes, get_waterbody_bounds, get_waterbody_fid, get_waterbody_by_fids, get_elevation
-from flaskr.geometry import get_waterbody_byname, get_waterbody_properties, get_waterbody_byID
+    check_images, get_all_states, get_all_state_counties, get_all_tribes, get_waterbody_by_fids
 from flaskr.aggregate import get_waterbody_raster, get_conus_file
+from flaskr.tiles import get_tile_path
+from flaskr.composite import get_composite_file, get_product, COMPOSITE_DAYS
+from flaskr.lake_index import get_category_file, PRODUCT as CATEGORY_PRODUCT
 from flaskr.report import generate_report, get_report_path
-from flaskr.utils import convert_cc, convert_dn
+from flaskr.utils import convert_cc, convert_dn, DEFAULT_RANGE
+from flaskr.render import get_lut, render_png
+from flaskr.image_cache import get_cache_name, get_cached_image, put_cached_image
+from flaskr.timelapse import get_timelapse_frames, render_timelapse, MAX_FRAMES, MAX_FPS, FORMATS
+from flaskr.diff import get_waterbody_diff, get_conus_diff
+from flaskr.pixel import get_pixel_timeseries
+from flaskr.registry import get_registry
+from flaskr.search import search_waterbodies
+from flaskr.spatial import find_waterbodies
+from flaskr.geometry_encoding import get_encoded_geometry, GEOMETRY_FORMATS
 from flaskr.metrics import calculate_metrics
 from flask_cors import CORS
 from main import async_aggregate, async_retry
-from PIL import Image, ImageCms
-from io import BytesIO
+from io import BytesIO, StringIO
 import pandas as pd
 import datetime
 import threading
+import os
 import logging
 import json
 import uuid
+import csv
 import time
 from celery_tasks import CeleryHandler
 
@@ -35,6 +47,9 @@ cors = CORS(app, origins=["http://localhost:4200"])
 
 celery_handler = CeleryHandler()
 
+TILE_MAX_AGE = 604800
+MAX_BATCH_POINTS = int(os.getenv("MAX_BATCH_POINTS", 1000000))
+
 
 @app.route('/')
 def status_check():
@@ -173,13 +188,18 @@ def get_objectid():
     if len(error) > 0:
         return ", ".join(error), 200
     if gnis is not None:
-        data = get_waterbody_byname(gnis_name=gnis)
-        results = {"waterbodies": data if len(data) > 0 else "NA"}
+        data, total = search_waterbodies(name=gnis, state=args.get("state"), page=int(args.get("page", 1)),
+                                         page_size=int(args["page_size"]) if "page_size" in args else None)
+        results = {"waterbodies": data if len(data) > 0 else "NA", "total": total}
+        if "page_size" in args:
+            results["page"] = int(args.get("page", 1))
+            results["page_size"] = int(args["page_size"])
         objectid = "NA"
     else:
         objectid, fid, gnis = get_waterbody_bypoint(lat=lat, lng=lng, return_fid=True)
         if objectid is not None:
-            data = get_waterbody_byID(id=objectid, fid=int(fid))
+            summary = get_registry().get_summary(objectid)
+            data = [summary] if summary else []
             # data = get_waterbody_byname(gnis)
             results = {"lat": lat, "lng": lng,
                        "waterbodies": data if len(data) > 0 else "NA"}
@@ -190,6 +210,96 @@ def get_objectid():
     return results, 200
 
 
+def get_batch_points():
+    """
+    Returns the lats, lngs and ids of the points of a batch search request, from a csv body or uploaded file with lat
+    and lng columns and an optional id column, or a json list of [lat, lng] pairs or {"lat", "lng", "id"} objects.
+    Points without an id use their position. The error message is set if the points could not be read.
+    """
+    csv_data = None
+    if "file" in request.files:
+        csv_data = request.files["file"].read()
+    elif request.mimetype in ("text/csv", "text/plain"):
+        csv_data = request.get_data()
+    if csv_data is not None:
+        try:
+            points = pd.read_csv(BytesIO(csv_data))
+        except Exception as e:
+            return None, f"Unable to read the points csv: {e}"
+        columns = {str(c).lower().strip(): c for c in points.columns}
+        lat_column = columns.get("lat", columns.get("latitude"))
+        lng_column = columns.get("lng", columns.get("longitude"))
+        if lat_column is None or lng_column is None:
+            return None, "Points csv requires 'lat' and 'lng' columns"
+        lats = pd.to_numeric(points[lat_column], errors="coerce").to_numpy()
+        lngs = pd.to_numeric(points[lng_column], errors="coerce").to_numpy()
+        ids = points[columns["id"]].tolist() if "id" in columns else list(range(len(points)))
+        return (lats, lngs, ids), None
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get("points")
+    if not isinstance(data, list):
+        return None, "Missing required points, a json list of [lat, lng] or {\"lat\", \"lng\"} points or a csv"
+    lats, lngs, ids = [], [], []
+    for i, point in enumerate(data):
+        point_id = i
+        if isinstance(point, dict):
+            lat, lng = point.get("lat"), point.get("lng")
+            point_id = point.get("id", i)
+        elif isinstance(point, (list, tuple)) and len(point) >= 2:
+            lat, lng = point[0], point[1]
+        else:
+            lat, lng = None, None
+        try:
+            lats.append(float(lat))
+            lngs.append(float(lng))
+        except (TypeError, ValueError):
+            lats.append(np.nan)
+            lngs.append(np.nan)
+        ids.append(point_id)
+    return (lats, lngs, ids), None
+
+
+@app.route('/waterbody/search/batch', methods=['POST'], strict_slashes=False)
+def get_objectid_batch():
+    t0 = time.time()
+    points, error = get_batch_points()
+    if error:
+        return error, 200
+    lats, lngs, ids = points
+    if len(lats) > MAX_BATCH_POINTS:
+        return f"Too many points: {len(lats)}, the maximum per request is {MAX_BATCH_POINTS}", 200
+    chunks = find_waterbodies(lats, lngs, ids=ids)
+    if request.args.get("format", "json").lower() == "csv":
+        def generate():
+            yield "id,lat,lng,objectid,fid,name\n"
+            for results in chunks:
+                buffer = StringIO()
+                writer = csv.writer(buffer, lineterminator="\n")
+                for r in results:
+                    writer.writerow([r["id"], r["lat"], r["lng"], r["objectid"] if r["objectid"] is not None else "",
+                                     r["fid"] if r["fid"] is not None else "", r["name"] if r["name"] else ""])
+                yield buffer.getvalue()
+            t1 = time.time()
+            print(f"Waterbody Batch Search Request complete, points: {len(lats)}, runtime: {round(t1-t0, 4)} sec")
+        response = Response(stream_with_context(generate()), mimetype="text/csv")
+        response.headers["Content-Disposition"] = "attachment; filename=waterbody_search.csv"
+    else:
+        def generate():
+            yield f'{{"count": {len(lats)}, "results": ['
+            first = True
+            for results in chunks:
+                if len(results) == 0:
+                    continue
+                yield ("" if first else ",") + ",".join(json.dumps(r) for r in results)
+                first = False
+            yield "]}"
+            t1 = time.time()
+            print(f"Waterbody Batch Search Request complete, points: {len(lats)}, runtime: {round(t1-t0, 4)} sec")
+        response = Response(stream_with_context(generate()), mimetype="application/json")
+    return response
+
+
 @app.route('/waterbody/properties/')
 def get_properties():
     t0 = time.time()
@@ -201,16 +311,18 @@ def get_properties():
         objectid = int(args["objectid"])
     else:
         return "Missing required waterbody objectid parameter 'OBJECTID'", 200
-    fid = get_waterbody_fid(objectid=objectid)
-    data = get_waterbody_properties(objectid=objectid, fid=fid)
-    data["ELEVATION"] = get_elevation(objectid=objectid, meters=True)
-    del data["path"]
-    bounds = get_waterbody_bounds(objectid)
-
-    data["x_min"] = bounds[1]
-    data["x_max"] = bounds[2]
-    data["y_min"] = bounds[3]
-    data["y_max"] = bounds[4]
+    registry = get_registry()
+    if objectid not in registry:
+        return f"No waterbody found for objectid: {objectid}", 404
+    data = registry.get_properties(objectid)
+    data["ELEVATION"] = registry.get_elevation(objectid, meters=True)
+    data.pop("path", None)
+    bounds = registry.get_bounds(objectid)
+
+    data["x_min"] = bounds[0] if bounds else None
+    data["x_max"] = bounds[1] if bounds else None
+    data["y_min"] = bounds[2] if bounds else None
+    data["y_max"] = bounds[3] if bounds else None
 
     result = {"objectid": objectid, "properties": data}
     t1 = time.time()
@@ -229,12 +341,63 @@ def get_geometry():
         objectid = int(args["objectid"])
     else:
         return "Missing required waterbody objectid parameter 'OBJECTID'", 200
-    fid = get_waterbody_fid(objectid=objectid)
-    data = get_waterbody_by_fids(fid=fid)
-    results = {"objectid": objectid, "geojson": data}
+    if objectid not in get_registry():
+        return f"No waterbody found for objectid: {objectid}", 404
+    if not any(p in args for p in ("format", "tolerance", "zoom")):
+        fid = get_registry().get_fid(objectid)
+        data = get_waterbody_by_fids(fid=fid)
+        results = {"objectid": objectid, "geojson": data}
+        t1 = time.time()
+        print(f"Waterbody Geometry Request complete, objectid: {objectid}, runtime: {round(t1-t0, 4)} sec")
+        return results, 200
+    geometry_format = str(args.get("format", "geojson")).lower()
+    if geometry_format not in GEOMETRY_FORMATS:
+        return f"Invalid geometry format: {geometry_format}, valid formats: {', '.join(GEOMETRY_FORMATS)}", 200
+    try:
+        tolerance = float(args["tolerance"]) if "tolerance" in args else None
+        zoom = float(args["zoom"]) if "zoom" in args else None
+    except ValueError:
+        return "Invalid tolerance or zoom parameter, must be a number", 200
+    geometry_path = get_encoded_geometry(objectid, format=geometry_format, tolerance=tolerance, zoom=zoom)
+    if geometry_path is None:
+        return f"No geometry found for objectid: {objectid}", 200
+    response = make_response(
+        send_file(
+            geometry_path,
+            mimetype='application/geo+json' if geometry_format == "geojson" else 'application/json',
+            max_age=TILE_MAX_AGE,
+            etag=True,
+            conditional=True
+        )
+    )
     t1 = time.time()
-    print(f"Waterbody Geometry Request complete, objectid: {objectid}, runtime: {round(t1-t0, 4)} sec")
-    return results, 200
+    print(f"Waterbody Geometry Request complete, objectid: {objectid}, format: {geometry_format}, "
+          f"runtime: {round(t1-t0, 4)} sec")
+    return response
+
+
+def get_thresholds(args):
+    """
+    Returns the (low, med, high) DN color thresholds from the request arguments, None for the image colormap.
+    """
+    colors = {}
+    use_custom = False
+    if 'low' in args:
+        use_custom = True
+        colors['low'] = convert_cc(int(args['low']))
+    if 'med' in args:
+        use_custom = True
+        colors['med'] = convert_cc(int(args['med']))
+    if 'high' in args:
+        use_custom = True
+        colors['high'] = convert_cc(int(args['high']))
+    if 'use_bin' in args:
+        use_custom = True
+    thresholds = None
+    if use_custom:
+        thresholds = (colors.get('low', DEFAULT_RANGE[1][0]), colors.get('med', DEFAULT_RANGE[2][0]),
+                      colors.get('high', DEFAULT_RANGE[2][1]))
+    return thresholds
 
 
 @app.route('/waterbody/image/')
@@ -264,52 +427,264 @@ def get_image():
         daily = bool(str(args["daily"]).lower() == "true")
     if len(missing) > 0:
         return ", ".join(missing), 200
-    colors = {}
-    use_custom = False
-    if 'low' in args:
-        use_custom = True
-        colors['low'] = convert_cc(int(args['low']))
-    if 'med' in args:
-        use_custom = True
-        colors['med'] = convert_cc(int(args['med']))
-    if 'high' in args:
-        use_custom = True
-        colors['high'] = convert_cc(int(args['high']))
-    if 'use_bin' in args:
-        use_custom = True
-    raster, colormap = get_waterbody_raster(objectid=objectid, year=year, day=day, get_bounds=False, daily=daily)
+    if objectid not in get_registry():
+        return f"No waterbody found for objectid: {objectid}", 404
+    thresholds = get_thresholds(args)
+
+    cache_name = get_cache_name("image", objectid, year=year, day=day, daily=daily,
+                                variant="-".join(str(t) for t in thresholds) if thresholds else None)
+    image_path = get_cached_image(cache_name)
+    if image_path is None:
+        raster, colormap = get_waterbody_raster(objectid=objectid, year=year, day=day, get_bounds=False, daily=daily)
+        if raster is None:
+            return f"No image found for waterbody: {objectid}, year: {year}, and day: {day}, daily: {daily}", 200
+        data, trans, crs, bounds, geom = raster
+        png_file = render_png(data, get_lut(colormap, thresholds=thresholds))
+        image_path = put_cached_image(cache_name, png_file)
+
+    # RETURNS IMAGE AS image/png, with an etag for conditional requests:
+    response = make_response(
+        send_file(
+            image_path,
+            as_attachment=True,
+            download_name=f"{objectid}_{year}-{day}.png",
+            mimetype='image/png',
+            etag=True,
+            conditional=True
+        )
+    )
+    t1 = time.time()
+    print(f"Waterbody Image Request complete, objectid: {objectid}, runtime: {round(t1-t0, 4)} sec")
+    return response
 
-    if raster is None:
-        return f"No image found for waterbody: {objectid}, year: {year}, and day: {day}, daily: {daily}", 200
-    data, trans, crs, bounds, geom = raster
 
-    colormap[0] = (0, 0, 0, 0)
-    colormap[255] = (0, 0, 0, 0)
-    converted_data = [[None for i in range(data.shape[1])] for j in range(data.shape[0])]
-    for y in range(0, data.shape[1]):
-        for x in range(0, data.shape[0]):
-            converted_data[x][y] = list(colormap[data[x][y]])
+def get_diff_dates(args, missing: list):
+    """
+    Returns the (date_a, date_b) ISO date arguments of a change request, appending to missing when not valid.
+    """
+    dates = []
+    for name in ("date_a", "date_b"):
+        try:
+            dates.append(datetime.date.fromisoformat(args[name]))
+        except (KeyError, ValueError):
+            dates.append(None)
+            missing.append(f"Missing or invalid date parameter '{name}', as YYYY-MM-DD")
+    return dates
 
-    converted_data = np.array(converted_data, dtype=np.uint8)
-    png_img = Image.fromarray(converted_data, mode='RGBA')
-    png_file = BytesIO()
-    png_img.save(png_file, 'PNG')
-    png_file.seek(0)
 
-    # RETURNS IMAGE AS image/png:
+def get_diff_response(cache_name: str, get_diff, download_name: str):
+    """
+    Returns the cached change image, rendering and caching it with get_diff if not cached. None if get_diff has no image.
+    """
+    image_path = get_cached_image(cache_name)
+    if image_path is None:
+        png_file = get_diff()
+        if png_file is None:
+            return None
+        image_path = put_cached_image(cache_name, png_file)
+    return make_response(
+        send_file(
+            image_path,
+            as_attachment=True,
+            download_name=download_name,
+            mimetype='image/png',
+            etag=True,
+            conditional=True
+        )
+    )
+
+
+def get_diff_cache_name(objectid, date_a, date_b, daily: bool):
+    # named by the range between the dates, so re-aggregating either date invalidates the image
+    start, end = min(date_a, date_b), max(date_a, date_b)
+    return get_cache_name("diff", objectid, year=start.year, day=start.timetuple().tm_yday, daily=daily,
+                          variant="forward" if date_a <= date_b else "reverse", end_year=end.year,
+                          end_day=end.timetuple().tm_yday)
+
+
+@app.route('/waterbody/image/diff/')
+def get_image_diff():
+    t0 = time.time()
+    args = request.args
+    objectid = None
+    daily = True
+    missing = []
+    if "OBJECTID" in args:
+        objectid = int(args["OBJECTID"])
+    elif "objectid" in args:
+        objectid = int(args["objectid"])
+    else:
+        missing.append("Missing required waterbody objectid parameter 'OBJECTID'")
+    date_a, date_b = get_diff_dates(args, missing)
+    if "daily" in args:
+        daily = bool(str(args["daily"]).lower() == "true")
+    if len(missing) > 0:
+        return ", ".join(missing), 200
+    if objectid not in get_registry():
+        return f"No waterbody found for objectid: {objectid}", 404
+
+    response = get_diff_response(
+        get_diff_cache_name(objectid, date_a, date_b, daily),
+        lambda: get_waterbody_diff(objectid=objectid, year_a=date_a.year, day_a=date_a.timetuple().tm_yday,
+                                   year_b=date_b.year, day_b=date_b.timetuple().tm_yday, daily=daily),
+        f"{objectid}_{date_a}_{date_b}_diff.png"
+    )
+    if response is None:
+        return f"No image found for waterbody: {objectid}, date_a: {date_a}, date_b: {date_b}, daily: {daily}", 200
+    t1 = time.time()
+    print(f"Waterbody Image Diff Request complete, objectid: {objectid}, runtime: {round(t1-t0, 4)} sec")
+    return response
+
+
+@app.route('/waterbody/conus_image/diff/')
+def get_conus_image_diff():
+    t0 = time.time()
+    args = request.args
+    daily = True
+    missing = []
+    date_a, date_b = get_diff_dates(args, missing)
+    if "daily" in args:
+        daily = bool(str(args["daily"]).lower() == "true")
+    if len(missing) > 0:
+        return ", ".join(missing), 200
+
+    response = get_diff_response(
+        get_diff_cache_name("conus", date_a, date_b, daily),
+        lambda: get_conus_diff(year_a=date_a.year, day_a=date_a.timetuple().tm_yday, year_b=date_b.year,
+                               day_b=date_b.timetuple().tm_yday, daily=daily),
+        f"conus_{date_a}_{date_b}_diff.png"
+    )
+    if response is None:
+        return {"date_a": str(date_a), "date_b": str(date_b), "daily": daily, "message": "No conus images found for the inputs provided."}
+    t1 = time.time()
+    print(f"Waterbody Conus Image Diff Request complete, runtime: {round(t1-t0, 4)} sec")
+    return response
+
+
+@app.route('/waterbody/timelapse/')
+def get_timelapse():
+    t0 = time.time()
+    args = request.args
+    objectid = None
+    daily = True
+    missing = []
+    if "OBJECTID" in args:
+        objectid = int(args["OBJECTID"])
+    elif "objectid" in args:
+        objectid = int(args["objectid"])
+    else:
+        missing.append("Missing required waterbody objectid parameter 'OBJECTID'")
+    try:
+        if "start" in args:
+            start_date = datetime.date.fromisoformat(args["start"])
+        else:
+            start_date = datetime.date(int(args["start_year"]), 1, 1) + datetime.timedelta(days=int(args["start_day"]) - 1)
+        if "end" in args:
+            end_date = datetime.date.fromisoformat(args["end"])
+        else:
+            end_date = datetime.date(int(args["end_year"]), 1, 1) + datetime.timedelta(days=int(args["end_day"]) - 1)
+    except (KeyError, ValueError):
+        start_date, end_date = None, None
+        missing.append("Missing or invalid date range parameters 'start' and 'end', as YYYY-MM-DD")
+    if "daily" in args:
+        daily = bool(str(args["daily"]).lower() == "true")
+    image_format = str(args.get("format", "png")).lower()
+    if image_format not in FORMATS:
+        missing.append(f"Invalid format parameter 'format', must be one of: {', '.join(FORMATS)}")
+    try:
+        fps = int(args.get("fps", 4))
+    except ValueError:
+        fps = None
+    if fps is None or not 1 <= fps <= MAX_FPS:
+        missing.append(f"Invalid frame rate parameter 'fps', must be an integer from 1 to {MAX_FPS}")
+    if len(missing) > 0:
+        return ", ".join(missing), 200
+    if objectid not in get_registry():
+        return f"No waterbody found for objectid: {objectid}", 404
+    if end_date < start_date:
+        return "Invalid date range, 'end' is before 'start'", 200
+    if (end_date - start_date).days + 1 > MAX_FRAMES * (1 if daily else 7):
+        return f"Date range exceeds the maximum of {MAX_FRAMES} frames", 200
+    thresholds = get_thresholds(args)
+
+    start_year, start_day = start_date.year, start_date.timetuple().tm_yday
+    end_year, end_day = end_date.year, end_date.timetuple().tm_yday
+    variant = "-".join([str(i) for i in thresholds] if thresholds else ["default"]) + f"-{fps}fps"
+    # the frame index is generated, and cached, with the sprite sheet
+    cache_format = "sprite" if image_format == "index" else image_format
+    cache_names = {
+        f: get_cache_name("timelapse", objectid, year=start_year, day=start_day, daily=daily,
+                          variant=f"{f}-{variant}", end_year=end_year, end_day=end_day,
+                          ext="json" if f == "index" else ("webp" if f == "webp" else "png"))
+        for f in ((cache_format, "index") if cache_format == "sprite" else (cache_format,))
+    }
+    image_path = get_cached_image(cache_names[image_format])
+    if image_path is None:
+        frames = get_timelapse_frames(objectid=objectid, start_year=start_year, start_day=start_day,
+                                      end_year=end_year, end_day=end_day, daily=daily)
+        if frames is None:
+            return f"No images found for waterbody: {objectid}, start: {start_date}, end: {end_date}, daily: {daily}", 200
+        dates, data, trans, colormap = frames
+        image_file, index = render_timelapse(dates, data, colormap, thresholds=thresholds,
+                                             image_format=cache_format, fps=fps)
+        image_path = put_cached_image(cache_names[cache_format], image_file)
+        if cache_format == "sprite":
+            index_path = put_cached_image(cache_names["index"], json.dumps(index).encode())
+            if image_format == "index":
+                image_path = index_path
+
+    mimetype = {"png": "image/png", "sprite": "image/png", "webp": "image/webp", "index": "application/json"}
     response = make_response(
         send_file(
-            png_file,
+            image_path,
             as_attachment=True,
-            download_name=f"{objectid}_{year}-{day}.png",
-            mimetype='image/png'
+            download_name=f"{objectid}_{start_date}_{end_date}.{image_path.split('.')[-1]}",
+            mimetype=mimetype[image_format],
+            etag=True,
+            conditional=True
         )
     )
     t1 = time.time()
-    print(f"Waterbody Image Request complete, objectid: {objectid}, runtime: {round(t1-t0, 4)} sec")
+    print(f"Waterbody Time-lapse Request complete, objectid: {objectid}, runtime: {round(t1-t0, 4)} sec")
     return response
 
 
+@app.route('/waterbody/pixel/')
+def get_pixel():
+    t0 = time.time()
+    args = request.args
+    daily = True
+    missing = []
+    try:
+        lat = float(args["lat"])
+        lng = float(args["lng"])
+    except (KeyError, ValueError):
+        lat, lng = None, None
+        missing.append("Missing or invalid location parameters 'lat' and 'lng'")
+    try:
+        start_date = datetime.date.fromisoformat(args["start"])
+        end_date = datetime.date.fromisoformat(args["end"])
+    except (KeyError, ValueError):
+        start_date, end_date = None, None
+        missing.append("Missing or invalid date range parameters 'start' and 'end', as YYYY-MM-DD")
+    if "daily" in args:
+        daily = bool(str(args["daily"]).lower() == "true")
+    if len(missing) > 0:
+        return ", ".join(missing), 200
+    if end_date < start_date:
+        return "Invalid date range, 'end' is before 'start'", 200
+
+    results = get_pixel_timeseries(lat=lat, lng=lng, start_year=start_date.year,
+                                   start_day=start_date.timetuple().tm_yday, end_year=end_date.year,
+                                   end_day=end_date.timetuple().tm_yday, daily=daily)
+    if results is None:
+        return {"lat": lat, "lng": lng, "message": "No images found for the location and date range provided."}
+    results.update({"lat": lat, "lng": lng, "daily": daily})
+    t1 = time.time()
+    print(f"Waterbody Pixel Request complete, lat: {lat}, lng: {lng}, runtime: {round(t1-t0, 4)} sec")
+    return results, 200
+
+
 @app.route('/waterbody/conus_image/')
 def get_conus_image():
     t0 = time.time()
@@ -356,6 +731,96 @@ def get_conus_image():
     return response
 
 
+@app.route('/waterbody/conus_composite/')
+def get_conus_composite():
+    t0 = time.time()
+    args = request.args
+    current_date = datetime.datetime.now()
+    if "year" in args:
+        year = int(args["year"])
+    else:
+        year = current_date.year
+    if "day" in args:
+        day = int(args["day"])
+    else:
+        day = current_date.timetuple().tm_yday
+    n_days = int(args.get("days", COMPOSITE_DAYS[0]))
+    if n_days not in COMPOSITE_DAYS:
+        return f"Invalid composite days: {n_days}, must be one of: {', '.join(str(n) for n in COMPOSITE_DAYS)}", 200
+
+    composite_file_path = get_composite_file(year=year, day=day, n_days=n_days)
+    if composite_file_path is None:
+        return {"year": year, "day": day, "days": n_days, "message": "No conus composite image found for the inputs provided."}
+
+    # RETURNS IMAGE AS image/png:
+    response = make_response(
+        send_file(
+            composite_file_path,
+            as_attachment=True,
+            download_name=f"{composite_file_path}",
+            mimetype='image/png'
+        )
+    )
+    t1 = time.time()
+    print(f"Waterbody Conus Composite Request complete, image: {composite_file_path}, runtime: {round(t1-t0, 4)} sec")
+    return response
+
+
+@app.route('/waterbody/conus_categories/')
+def get_conus_categories():
+    t0 = time.time()
+    args = request.args
+    current_date = datetime.datetime.now()
+    daily = True
+    if "year" in args:
+        year = int(args["year"])
+    else:
+        year = current_date.year
+    if "day" in args:
+        day = int(args["day"])
+    else:
+        day = current_date.timetuple().tm_yday
+    if "daily" in args:
+        daily = (args["daily"] == "True")
+
+    category_file_path = None
+    date = datetime.date(year, 1, 1) + datetime.timedelta(days=day - 1)
+    for i in range(3 if daily else 8):
+        c_date = date - datetime.timedelta(days=i)
+        c_path = get_category_file(year=c_date.year, day=c_date.timetuple().tm_yday, daily=daily)
+        if os.path.exists(c_path):
+            category_file_path = c_path
+            break
+    if category_file_path is None:
+        return {"year": year, "day": day, "daily": daily, "message": "No conus waterbody category image found for the inputs provided."}
+
+    # RETURNS IMAGE AS image/png:
+    response = make_response(
+        send_file(
+            category_file_path,
+            as_attachment=True,
+            download_name=f"{category_file_path}",
+            mimetype='image/png'
+        )
+    )
+    t1 = time.time()
+    print(f"Waterbody Conus Category Request complete, image: {category_file_path}, runtime: {round(t1-t0, 4)} sec")
+    return response
+
+
+@app.route('/waterbody/tiles/<period>/<int:year>/<int:day>/<int:z>/<int:x>/<int:y>.png')
+def get_conus_tile(period, year, day, z, x, y):
+    products = [get_product(n) for n in COMPOSITE_DAYS] + [CATEGORY_PRODUCT]
+    if period not in ["daily", "weekly"] + products:
+        return f"Invalid tile period: {period}, must be one of: daily, weekly, {', '.join(products)}", 404
+    tile_path = get_tile_path(year=year, day=day, z=z, x=x, y=y, daily=(period == "daily"),
+                              product=period if period in products else None)
+    if tile_path is None:
+        return f"No conus tile found for period: {period}, year: {year}, day: {day}, z: {z}, x: {x}, y: {y}", 404
+    # tiles for a date only change if the date is re-aggregated, allow clients to cache them for a week
+    return send_file(tile_path, mimetype='image/png', max_age=TILE_MAX_AGE)
+
+
 @app.route('/waterbody/aggregate/')
 def aggregate():
     args = request.args